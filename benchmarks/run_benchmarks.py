@@ -0,0 +1,362 @@
+"""
+Time the stages of EnsembleTR on synthetic data and compare
+the results against a baseline
+
+Benchmarks:
+
+- readers: advance the readers and build the record clusters
+- cluster_graph: build the ClusterGraph of each record cluster
+- resolve: RecordResolver.Resolve of each record cluster
+- write: Writer.WriteRecord of each resolved record cluster (.vcf)
+- write_gz: same, to a bgzipped and indexed .vcf.gz
+- end_to_end: full EnsembleTR run (new process)
+
+# Usage
+python benchmarks/run_benchmarks.py --out results.json --baseline benchmarks/baseline.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import cyvcf2
+import numpy as np
+from pyfaidx import Fasta
+
+from ensembletr import vcfio
+from ensembletr import recordcluster
+from ensembletr import __version__
+import synthetic
+
+BENCHMARKS = ["readers", "cluster_graph", "resolve", "write", "write_gz", "end_to_end"]
+# Version of the results format
+RESULTS_VERSION = 1
+# Relative slowdown above which a benchmark is reported as a regression
+TOLERANCE = 0.2
+
+def BenchReaders(dataset):
+    r"""
+    Advance the readers over all records and build the record clusters
+
+    Parameters
+    ----------
+    dataset : dict
+       Paths returned by synthetic.GenerateDataset
+
+    Returns
+    -------
+    seconds : float
+       Elapsed time
+    clusters : list of recordcluster.RecordCluster
+       Record clusters, in merge order
+    readers : vcfio.Readers
+       Readers, at the end of the files
+    """
+    start = time.perf_counter()
+    readers = vcfio.Readers(dataset["vcfs"], Fasta(dataset["ref"]))
+    clusters = []
+    while not readers.done:
+        rc_list = readers.getMergableCalls().RecordClusters
+        rc_list.sort(key=lambda x: x.first_pos)
+        for rc in rc_list:
+            clusters.append(rc)
+            readers.goToNext(rc.vcf_types)
+    return time.perf_counter() - start, clusters, readers
+
+def BenchClusterGraph(clusters):
+    r"""
+    Build the allele graph of each record cluster
+
+    Parameters
+    ----------
+    clusters : list of recordcluster.RecordCluster
+       Record clusters
+
+    Returns
+    -------
+    seconds : float
+       Elapsed time
+    """
+    start = time.perf_counter()
+    for rc in clusters:
+        recordcluster.ClusterGraph(rc)
+    return time.perf_counter() - start
+
+def BenchResolve(clusters):
+    r"""
+    Resolve each record cluster
+
+    Parameters
+    ----------
+    clusters : list of recordcluster.RecordCluster
+       Record clusters
+
+    Returns
+    -------
+    seconds : float
+       Elapsed time, not counting the construction of the resolvers
+    resolvers : list of recordcluster.RecordResolver
+       Resolved record clusters
+    """
+    resolvers = [recordcluster.RecordResolver(rc) for rc in clusters]
+    start = time.perf_counter()
+    for resolver in resolvers:
+        resolver.Resolve()
+    return time.perf_counter() - start, resolvers
+
+def BenchWrite(resolvers, readers, out_path):
+    r"""
+    Write the resolved record clusters
+
+    Parameters
+    ----------
+    resolvers : list of recordcluster.RecordResolver
+       Resolved record clusters
+    readers : vcfio.Readers
+       Readers the clusters come from
+    out_path : str
+       Output VCF path (.vcf or .vcf.gz)
+
+    Returns
+    -------
+    seconds : float
+       Elapsed time, closing the output included
+    """
+    start = time.perf_counter()
+    writer = vcfio.Writer(out_path, readers.samples, "benchmark", chroms=readers.chroms,
+                          tmpdir=os.path.dirname(out_path),
+                          index="tbi" if out_path.endswith(".gz") else None)
+    for resolver in resolvers:
+        writer.WriteRecord(resolver)
+    writer.Close()
+    return time.perf_counter() - start
+
+def BenchEndToEnd(dataset, out_path):
+    r"""
+    Run EnsembleTR on the dataset in a new process
+
+    Parameters
+    ----------
+    dataset : dict
+       Paths returned by synthetic.GenerateDataset
+    out_path : str
+       Output VCF path
+
+    Returns
+    -------
+    seconds : float
+       Elapsed time, interpreter startup included
+    """
+    command = [sys.executable, "-m", "ensembletr.main", "--vcfs", ",".join(dataset["vcfs"]),
+               "--ref", dataset["ref"], "--out", out_path]
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")] + \
+                                        ([env["PYTHONPATH"]] if "PYTHONPATH" in env else []))
+    start = time.perf_counter()
+    subprocess.run(command, check=True, env=env, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+def RunBenchmarks(dataset, workdir, repeat=3, benchmarks=BENCHMARKS):
+    r"""
+    Run the benchmarks several times
+
+    Parameters
+    ----------
+    dataset : dict
+       Paths returned by synthetic.GenerateDataset
+    workdir : str
+       Directory of the outputs
+    repeat : int, optional
+       Number of runs of each benchmark
+    benchmarks : list of str, optional
+       Benchmarks to run, from BENCHMARKS
+
+    Returns
+    -------
+    results : dict of str: dict
+       For each benchmark, the seconds of each run, the fastest
+       and median run, the number of record clusters (items)
+       and the number of items per second of the fastest run
+    """
+    times = {name: [] for name in benchmarks}
+    num_clusters = 0
+    for i in range(repeat):
+        # Clusters cache some of their calls, build them again for each run
+        seconds, clusters, readers = BenchReaders(dataset)
+        num_clusters = len(clusters)
+        if "readers" in times:
+            times["readers"].append(seconds)
+        if "cluster_graph" in times:
+            times["cluster_graph"].append(BenchClusterGraph(clusters))
+        if any(name in times for name in ["resolve", "write", "write_gz"]):
+            seconds, resolvers = BenchResolve(clusters)
+            if "resolve" in times:
+                times["resolve"].append(seconds)
+            if "write" in times:
+                times["write"].append(BenchWrite(resolvers, readers, os.path.join(workdir, "write.vcf")))
+            if "write_gz" in times:
+                times["write_gz"].append(BenchWrite(resolvers, readers, os.path.join(workdir, "write.vcf.gz")))
+        if "end_to_end" in times:
+            times["end_to_end"].append(BenchEndToEnd(dataset, os.path.join(workdir, "end_to_end.vcf.gz")))
+    results = {}
+    for name in benchmarks:
+        fastest = min(times[name])
+        results[name] = {"runs": times[name],
+                         "seconds": fastest,
+                         "median": statistics.median(times[name]),
+                         "items": num_clusters,
+                         "items_per_second": num_clusters / fastest if fastest > 0 else None}
+    return results
+
+def CompareResults(results, baseline, tolerance=TOLERANCE):
+    r"""
+    Compare benchmark results against a baseline
+
+    Parameters
+    ----------
+    results : dict
+       Results of the current run (see main)
+    baseline : dict
+       Results of the baseline run
+    tolerance : float, optional
+       Relative slowdown of the fastest run above
+       which a benchmark is a regression
+
+    Returns
+    -------
+    comparison : dict of str: dict
+       For each benchmark in both, baseline and current clusters per
+       second of the fastest run, the slowdown (baseline over current
+       throughput) and whether it is a regression
+
+    Raises
+    ------
+    ValueError
+       If the baseline was run with a different configuration
+    """
+    if results["config"] != baseline["config"]:
+        raise ValueError("The baseline was run with a different configuration")
+    comparison = {}
+    for name, result in results["results"].items():
+        if name not in baseline["results"] or not baseline["results"][name]["items_per_second"] \
+           or not result["items_per_second"]:
+            continue
+        base_throughput = baseline["results"][name]["items_per_second"]
+        ratio = base_throughput / result["items_per_second"]
+        comparison[name] = {"baseline": base_throughput,
+                            "current": result["items_per_second"],
+                            "ratio": ratio,
+                            "regression": ratio > 1 + tolerance}
+    return comparison
+
+def GetEnvironment():
+    r"""
+    Describe the machine and software the benchmarks ran with
+
+    Returns
+    -------
+    environment : dict of str: str
+       Versions of Python, EnsembleTR and its dependencies
+    """
+    return {"python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "ensembletr": __version__,
+            "numpy": np.__version__,
+            "cyvcf2": cyvcf2.__version__}
+
+def getargs(): # pragma: no cover
+    parser = argparse.ArgumentParser(__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--out", help="Output JSON file of the results", type=str, required=True)
+    parser.add_argument("--baseline", help="JSON results to compare against. Exit with "
+                        "status 1 if a benchmark is slower than the tolerance", type=str)
+    parser.add_argument("--tolerance", help="Relative slowdown reported as a regression",
+                        type=float, default=TOLERANCE)
+    parser.add_argument("--benchmarks", help="Comma-separated list of benchmarks to run",
+                        type=str, default=",".join(BENCHMARKS))
+    parser.add_argument("--repeat", help="Number of runs of each benchmark", type=int, default=3)
+    parser.add_argument("--data", help="Directory of the synthetic data. Reused if it "
+                        "exists with the same configuration", type=str)
+    parser.add_argument("--samples", help="Number of samples", type=int, default=100)
+    parser.add_argument("--loci", help="Number of TR loci", type=int, default=2000)
+    parser.add_argument("--chroms", help="Number of chromosomes", type=int, default=2)
+    parser.add_argument("--diversity", help="Number of alternate allele lengths "
+                        "drawn at each locus", type=int, default=4)
+    parser.add_argument("--disagreement", help="Probability that a caller reports "
+                        "a different allele", type=float, default=0.1)
+    parser.add_argument("--missing", help="Probability of a missing call", type=float, default=0.05)
+    parser.add_argument("--skip", help="Probability that a caller has no record "
+                        "for a locus", type=float, default=0.15)
+    parser.add_argument("--seed", help="Random seed", type=int, default=1)
+    return parser.parse_args()
+
+def main(args):
+    benchmarks = args.benchmarks.split(",")
+    for name in benchmarks:
+        if name not in BENCHMARKS:
+            sys.stderr.write("Error: unknown benchmark %s\n"%name)
+            return 1
+    if args.repeat < 1:
+        sys.stderr.write("Error: --repeat must be at least 1\n")
+        return 1
+    config = {"samples": args.samples, "loci": args.loci, "chroms": args.chroms,
+              "diversity": args.diversity, "disagreement": args.disagreement,
+              "missing": args.missing, "skip": args.skip, "seed": args.seed}
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        # Timings of different data are not comparable, fail before running
+        if baseline["config"] != config:
+            sys.stderr.write("Error: the baseline was run with a different configuration. "
+                             "Rerun with the same settings or record a new baseline\n")
+            return 1
+    workdir = tempfile.mkdtemp(prefix="ensembletr-benchmark-")
+    try:
+        datadir = args.data if args.data is not None else os.path.join(workdir, "data")
+        config_path = os.path.join(datadir, "config.json")
+        dataset = None
+        if os.path.exists(config_path):
+            with open(config_path, "r") as f:
+                saved = json.load(f)
+            if saved["config"] == config:
+                dataset = saved["dataset"]
+        if dataset is None:
+            dataset = synthetic.GenerateDataset(datadir, args.samples, args.loci, args.chroms,
+                                                args.diversity, args.disagreement, args.missing,
+                                                args.skip, args.seed)
+            with open(config_path, "w") as f:
+                json.dump({"config": config, "dataset": dataset}, f, indent=1)
+        results = {"format": "ensembletr-benchmark",
+                   "version": RESULTS_VERSION,
+                   "config": config,
+                   "repeat": args.repeat,
+                   "environment": GetEnvironment(),
+                   "results": RunBenchmarks(dataset, workdir, args.repeat, benchmarks)}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    regressions = []
+    if baseline is not None:
+        results["comparison"] = CompareResults(results, baseline, args.tolerance)
+        regressions = [name for name, comp in results["comparison"].items() if comp["regression"]]
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=1)
+    for name, result in results["results"].items():
+        line = "%-14s %8.3fs %10.1f clusters/s"%(name, result["seconds"], result["items_per_second"] or 0)
+        if name in results.get("comparison", {}):
+            comp = results["comparison"][name]
+            line += "  baseline %10.1f clusters/s  x%.2f%s"%(comp["baseline"], comp["ratio"],
+                                                               "  REGRESSION" if comp["regression"] else "")
+        print(line)
+    return 1 if len(regressions) > 0 else 0
+
+if __name__ == "__main__": # pragma: no cover
+    sys.exit(main(getargs()))
@@ -0,0 +1,353 @@
+"""
+Generate synthetic adVNTR, ExpansionHunter, HipSTR and GangSTR
+VCFs of the same TR loci, with a matching reference genome
+
+Each sample has a true genotype at each locus. Each caller reports it
+with some disagreement (alleles replaced by another allele of the locus)
+and missing calls, and skips some loci altogether.
+
+# Usage
+python benchmarks/synthetic.py --out synthetic --samples 100 --loci 2000
+"""
+
+import argparse
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from ensembletr import vcfio
+
+BASES = "ACGT"
+CALLERS = ["advntr", "eh", "hipstr", "gangstr"]
+# Length of the reference line of the FASTA file
+FASTA_LINE_LENGTH = 60
+# Distance (bp) between the first locus and the start of a chromosome
+CHROM_START = 1000
+# Largest distance (bp) between consecutive loci
+MAX_LOCUS_GAP = 2000
+
+def RandomSequence(rng, length):
+    r"""
+    Get a random DNA sequence
+
+    Parameters
+    ----------
+    rng : random.Random
+       Random number generator
+    length : int
+       Length of the sequence
+
+    Returns
+    -------
+    seq : str
+       Random sequence
+    """
+    return "".join(rng.choice(BASES) for i in range(length))
+
+def GenerateLoci(rng, num_loci, num_chroms):
+    r"""
+    Place TR loci along the chromosomes and build the reference genome
+
+    About 20% of loci are placed right next to the previous one, so
+    that records of different loci overlap and end up in the same
+    record clusters.
+
+    Parameters
+    ----------
+    rng : random.Random
+       Random number generator
+    num_loci : int
+       Number of TR loci
+    num_chroms : int
+       Number of chromosomes
+
+    Returns
+    -------
+    chroms : list of str
+       Chromosome names
+    seqs : dict of str: str
+       Reference sequence of each chromosome
+    loci : list of (str, int, str, int)
+       Chromosome, 1-based start, motif and reference
+       number of copies of each locus
+    """
+    chroms = ["chr%d"%(i + 1) for i in range(num_chroms)]
+    per_chrom = [num_loci // num_chroms + (1 if i < num_loci % num_chroms else 0) \
+                 for i in range(num_chroms)]
+    seqs = {}
+    loci = []
+    for chrom, chrom_loci in zip(chroms, per_chrom):
+        chrom_len = CHROM_START + chrom_loci * (MAX_LOCUS_GAP + 100) + CHROM_START
+        seq = list(RandomSequence(rng, chrom_len))
+        pos = CHROM_START
+        for i in range(chrom_loci):
+            period = rng.randint(1, 6)
+            motif = RandomSequence(rng, period)
+            while len(set(motif)) == 1 and period > 1:
+                motif = RandomSequence(rng, period)
+            copies = rng.randint(4, 12)
+            seq[pos-1:pos-1+copies*period] = list(motif*copies)
+            loci.append((chrom, pos, motif, copies))
+            if rng.random() < 0.2:
+                pos = pos + copies*period + rng.randint(-3, 5)
+            else:
+                pos = pos + copies*period + rng.randint(50, MAX_LOCUS_GAP)
+        seqs[chrom] = "".join(seq)
+    return chroms, seqs, loci
+
+def GetHeader(caller, chroms, seqs, samples):
+    r"""
+    Get the VCF header of a caller
+
+    Parameters
+    ----------
+    caller : str
+       One of CALLERS
+    chroms : list of str
+       Chromosome names
+    seqs : dict of str: str
+       Reference sequence of each chromosome
+    samples : list of str
+       Sample names
+
+    Returns
+    -------
+    header : str
+       Header lines, ending with the #CHROM line
+    """
+    lines = ["##fileformat=VCFv4.2"]
+    for chrom in chroms:
+        lines.append("##contig=<ID=%s,length=%d>"%(chrom, len(seqs[chrom])))
+    if caller == "hipstr":
+        lines.append("##command=HipSTR --synthetic")
+        info = [("START", "Integer"), ("END", "Integer"), ("PERIOD", "Integer")]
+        fmt = [("GT", "String"), ("Q", "Float")]
+    elif caller == "gangstr":
+        lines.append("##command=GangSTR --synthetic")
+        info = [("END", "Integer"), ("RU", "String"), ("PERIOD", "Integer"), ("REF", "Float")]
+        fmt = [("GT", "String"), ("Q", "Float")]
+    elif caller == "advntr":
+        lines.append("##source=adVNTR ver. 1.5.0")
+        info = [("END", "Integer"), ("VID", "Integer"), ("RU", "String"), ("RC", "Integer")]
+        fmt = [("GT", "String"), ("DP", "Integer"), ("ML", "Float")]
+    else:
+        for i in range(40):
+            lines.append('##ALT=<ID=STR%d,Description="Allele comprised of %d repeat units">'%(i, i))
+        info = [("END", "Integer"), ("REF", "Integer"), ("RL", "Integer"), ("RU", "String"),
+                ("VARID", "String"), ("REPID", "String")]
+        fmt = [("GT", "String"), ("REPCI", "String"), ("REPCN", "String")]
+    for field, field_type in info:
+        lines.append('##INFO=<ID=%s,Number=1,Type=%s,Description="%s">'%(field, field_type, field))
+    for field, field_type in fmt:
+        lines.append('##FORMAT=<ID=%s,Number=1,Type=%s,Description="%s">'%(field, field_type, field))
+    lines.append("\t".join(["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER",
+                            "INFO", "FORMAT"] + samples))
+    return "\n".join(lines) + "\n"
+
+def GetRecord(caller, rng, seqs, locus, diffs, calls):
+    r"""
+    Format the record of a locus as reported by a caller
+
+    Parameters
+    ----------
+    caller : str
+       One of CALLERS
+    rng : random.Random
+       Random number generator
+    seqs : dict of str: str
+       Reference sequence of each chromosome
+    locus : (str, int, str, int)
+       Chromosome, start, motif and reference number of copies
+    diffs : list of int
+       Differences in number of copies of the alleles called
+       by the caller, the reference (0) excluded
+    calls : list of (int, int)
+       Difference in number of copies of each allele of each sample,
+       None for missing calls
+
+    Returns
+    -------
+    line : str
+       VCF record, without newline
+    """
+    chrom, start, motif, copies = locus
+    period = len(motif)
+    end = start + copies*period - 1
+    refseq = seqs[chrom][start-1:end]
+    allele_index = {0: 0}
+    for i, diff in enumerate(diffs):
+        allele_index[diff] = i + 1
+    if caller == "hipstr":
+        flank = 2 if rng.random() < 0.2 else 0
+        pos = start - flank
+        lflank = seqs[chrom][pos-1:start-1]
+        ref = lflank + refseq
+        alts = [lflank + motif*(copies + diff) for diff in diffs]
+        info = "START=%d;END=%d;PERIOD=%d"%(start, end, period)
+        fmt = "GT:Q"
+        sample_data = [".|.:." if call is None else "%d|%d:%s"%(
+            allele_index[call[0]], allele_index[call[1]], rng.choice(["1.0", "0.99", "0.8", "0.5", "0.93"])) \
+            for call in calls]
+    elif caller == "gangstr":
+        pos = start
+        ref = refseq
+        alts = [motif*(copies + diff) for diff in diffs]
+        info = "END=%d;RU=%s;PERIOD=%d;REF=%d"%(
+            end, motif.lower() if rng.random() < 0.3 else motif, period, copies)
+        fmt = "GT:Q"
+        sample_data = [".:." if call is None else "%d/%d:%s"%(
+            allele_index[call[0]], allele_index[call[1]], rng.choice(["1", "1.0001", "0.97", "0.4"])) \
+            for call in calls]
+    elif caller == "advntr":
+        pos = start - 1
+        ref = refseq
+        alts = [motif*(copies + diff) for diff in diffs]
+        info = "END=%d;VID=%d;RU=%s;RC=%d"%(end, start, motif, copies)
+        fmt = "GT:DP:ML"
+        sample_data = ["./.:.:." if call is None else "%d/%d:30:%s"%(
+            allele_index[call[0]], allele_index[call[1]], rng.choice(["1", "0.9999", "0.75", "0.5"])) \
+            for call in calls]
+    else:
+        pos = start - 1
+        ref = seqs[chrom][start-2]
+        alts = ["<STR%d>"%(copies + diff) for diff in diffs]
+        info = "END=%d;REF=%d;RL=%d;RU=%s;VARID=%s_%d;REPID=%s_%d"%(
+            end, copies, copies*period, motif, chrom, start, chrom, start)
+        fmt = "GT:REPCI:REPCN"
+        sample_data = []
+        for call in calls:
+            if call is None:
+                sample_data.append("./.:.:.")
+                continue
+            copies1, copies2 = copies + call[0], copies + call[1]
+            if rng.random() < 0.1:
+                interval = "%d-%d/%d-%d"%(copies1 - 1, copies1 + 1, copies2, copies2 + 2)
+            else:
+                interval = "%d-%d/%d-%d"%(copies1, copies1, copies2, copies2)
+            sample_data.append("%d/%d:%s:%d/%d"%(allele_index[call[0]], allele_index[call[1]],
+                                                  interval, copies1, copies2))
+    recid = "%s_%d"%(chrom, start) if caller == "hipstr" else "."
+    return "\t".join([chrom, str(pos), recid, ref, ",".join(alts) or ".", ".", ".",
+                      info, fmt] + sample_data)
+
+def WriteIndexedVCF(path, header, lines):
+    r"""
+    Write a bgzipped VCF file and its tabix index
+
+    Parameters
+    ----------
+    path : str
+       Output path, ending with .vcf.gz
+    header : str
+       VCF header
+    lines : list of str
+       Sorted VCF records, without newline
+    """
+    writer = vcfio.BGZFWriter(path)
+    index = vcfio.TabixIndex()
+    writer.write(header)
+    for line in lines:
+        start_offset = writer.uncompressed_size
+        writer.write(line + "\n")
+        fields = line.split("\t", 4)
+        beg = int(fields[1]) - 1
+        index.AddRecord(fields[0], beg, beg + len(fields[3]), start_offset, writer.uncompressed_size)
+    writer.close()
+    index.Write(path + ".tbi", writer.GetVirtualOffset)
+
+def GenerateDataset(outdir, num_samples=100, num_loci=2000, num_chroms=2, diversity=4,
+                    disagreement=0.1, missing=0.05, skip=0.15, seed=1):
+    r"""
+    Generate synthetic VCFs of the four callers and the reference genome
+
+    Parameters
+    ----------
+    outdir : str
+       Output directory
+    num_samples : int, optional
+       Number of samples
+    num_loci : int, optional
+       Number of TR loci
+    num_chroms : int, optional
+       Number of chromosomes
+    diversity : int, optional
+       Number of alternate allele lengths drawn at each locus
+    disagreement : float, optional
+       Probability that a caller reports a different allele than the true one
+    missing : float, optional
+       Probability that a caller has no call for a sample
+    skip : float, optional
+       Probability that a caller has no record for a locus
+    seed : int, optional
+       Seed of the random number generator
+
+    Returns
+    -------
+    dataset : dict
+       Paths to the reference ("ref") and to the VCF
+       of each caller ("vcfs", in the order of CALLERS)
+    """
+    rng = random.Random(seed)
+    os.makedirs(outdir, exist_ok=True)
+    chroms, seqs, loci = GenerateLoci(rng, num_loci, num_chroms)
+    ref_path = os.path.join(outdir, "ref.fa")
+    with open(ref_path, "w") as f:
+        for chrom in chroms:
+            f.write(">%s\n"%chrom)
+            for i in range(0, len(seqs[chrom]), FASTA_LINE_LENGTH):
+                f.write(seqs[chrom][i:i+FASTA_LINE_LENGTH] + "\n")
+    samples = ["S%05d"%i for i in range(num_samples)]
+    records = {caller: [] for caller in CALLERS}
+    for locus in loci:
+        copies = locus[3]
+        diffs = sorted(set([0] + [rng.randint(-3, 4) for i in range(diversity)]))
+        diffs = [diff for diff in diffs if copies + diff > 0]
+        truth = [(rng.choice(diffs), rng.choice(diffs)) for sample in samples]
+        for caller in CALLERS:
+            if rng.random() < skip:
+                continue
+            calls = []
+            for allele1, allele2 in truth:
+                if rng.random() < missing:
+                    calls.append(None)
+                    continue
+                if rng.random() < disagreement:
+                    allele1 = rng.choice(diffs)
+                if rng.random() < disagreement:
+                    allele2 = rng.choice(diffs)
+                calls.append((allele1, allele2))
+            called = sorted(set(diff for call in calls if call is not None \
+                                for diff in call if diff != 0))
+            records[caller].append(GetRecord(caller, rng, seqs, locus, called, calls))
+    vcf_paths = []
+    chrom_ranks = {chrom: i for i, chrom in enumerate(chroms)}
+    for caller in CALLERS:
+        lines = sorted(records[caller], key=lambda line: (chrom_ranks[line.split("\t", 1)[0]],
+                                                          int(line.split("\t", 2)[1])))
+        path = os.path.join(outdir, "%s.vcf.gz"%caller)
+        WriteIndexedVCF(path, GetHeader(caller, chroms, seqs, samples), lines)
+        vcf_paths.append(path)
+    return {"ref": ref_path, "vcfs": vcf_paths}
+
+def getargs(): # pragma: no cover
+    parser = argparse.ArgumentParser(__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--out", help="Output directory", type=str, required=True)
+    parser.add_argument("--samples", help="Number of samples", type=int, default=100)
+    parser.add_argument("--loci", help="Number of TR loci", type=int, default=2000)
+    parser.add_argument("--chroms", help="Number of chromosomes", type=int, default=2)
+    parser.add_argument("--diversity", help="Number of alternate allele lengths "
+                        "drawn at each locus", type=int, default=4)
+    parser.add_argument("--disagreement", help="Probability that a caller reports "
+                        "a different allele", type=float, default=0.1)
+    parser.add_argument("--missing", help="Probability of a missing call", type=float, default=0.05)
+    parser.add_argument("--skip", help="Probability that a caller has no record "
+                        "for a locus", type=float, default=0.15)
+    parser.add_argument("--seed", help="Random seed", type=int, default=1)
+    return parser.parse_args()
+
+if __name__ == "__main__": # pragma: no cover
+    args = getargs()
+    dataset = GenerateDataset(args.out, args.samples, args.loci, args.chroms, args.diversity,
+                              args.disagreement, args.missing, args.skip, args.seed)
+    print("--vcfs %s --ref %s"%(",".join(dataset["vcfs"]), dataset["ref"]))
@@ -1 +1,6 @@
+import logging
+
 from .version import __version__
+
+# Silent unless the application configures logging (see main --log-level)
+logging.getLogger(__name__).addHandler(logging.NullHandler())
@@ -0,0 +1,136 @@
+"""
+Checkpoint journal used to resume interrupted merges
+"""
+
+import json
+import logging
+import os
+import time
+
+import trtools.utils.common as common
+
+log = logging.getLogger(__name__)
+
+# Default number of seconds between checkpoints
+CHECKPOINT_INTERVAL = 600
+# Version of the journal format
+JOURNAL_VERSION = 2
+
+class Journal:
+    """
+    Periodically record how far a merge got
+
+    Each checkpoint syncs the output to disk and atomically
+    replaces the journal with:
+
+    - settings: options the merge depends on
+    - output: output offset, last position written on each
+      chromosome, BGZF blocks and partial index of a .vcf.gz
+      output and sidecar state (see vcfio.Writer.Sync)
+    - progress: where to resume reading, e.g. the resume
+      position of each reader (see vcfio.Readers.GetResumePositions)
+
+    Checkpoints are only taken when all records of the merged
+    loci were written, so the output is always cut between records.
+
+    Parameters
+    ----------
+    path : str
+       Path to the journal
+    settings : dict
+       Options the merge depends on. Resuming requires the same settings.
+    interval : float, optional
+       Minimum number of seconds between checkpoints (0 disables them)
+
+    Attributes
+    ----------
+    num_checkpoints : int
+       Number of checkpoints written
+    """
+    def __init__(self, path, settings, interval=CHECKPOINT_INTERVAL):
+        self.path = path
+        self.settings = settings
+        self.interval = interval
+        self.last_time = time.monotonic()
+        self.num_checkpoints = 0
+
+    def Due(self, writer):
+        r"""
+        Check if a checkpoint should be written now
+
+        Parameters
+        ----------
+        writer : vcfio.Writer
+           Writer of the merged VCF file
+
+        Returns
+        -------
+        due : bool
+           True if the interval elapsed and all records were written
+        """
+        if self.interval <= 0 or time.monotonic() - self.last_time < self.interval:
+            return False
+        return writer.IsFlushed()
+
+    def Write(self, writer, progress):
+        r"""
+        Sync the output and record a checkpoint
+
+        Parameters
+        ----------
+        writer : vcfio.Writer
+           Writer of the merged VCF file
+        progress : dict
+           Where to resume reading from
+        """
+        journal = {"format": "ensembletr-checkpoint",
+                   "version": JOURNAL_VERSION,
+                   "settings": self.settings,
+                   "output": writer.Sync(),
+                   "progress": progress}
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(journal, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.last_time = time.monotonic()
+        self.num_checkpoints += 1
+        log.info("Checkpoint %d: output offset %d, last positions %s", self.num_checkpoints,
+                 journal["output"]["offset"], journal["output"]["last_positions"])
+
+    def Remove(self):
+        r"""
+        Remove the journal, e.g. once the merge is complete
+        """
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def LoadJournal(path, settings):
+    r"""
+    Load the last checkpoint of a merge
+
+    Parameters
+    ----------
+    path : str
+       Path to the journal
+    settings : dict
+       Options of the merge being resumed
+
+    Returns
+    -------
+    journal : dict
+       Content of the journal (see Journal)
+    """
+    with open(path, "r") as f:
+        journal = json.load(f)
+    if journal.get("format") != "ensembletr-checkpoint" or \
+       journal.get("version") != JOURNAL_VERSION:
+        common.WARNING("Error: %s is not a checkpoint journal of this version"%path)
+        raise ValueError('Invalid checkpoint journal.')
+    for key, value in settings.items():
+        if journal["settings"].get(key) != value:
+            common.WARNING("Error: the checkpoint in %s was written with a different "
+                           "value of %s (%s)"%(path, key, journal["settings"].get(key)))
+            raise ValueError('Checkpoint does not match the merge options.')
+    return journal
@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+
+"""
+Tool to correct a merged HipSTR VCF
+
+HipSTR might expand the coordinates of a repeat if there is a nearby
+SNP. After merging the outputs of several HipSTR runs (e.g. with
+mergeSTR), the same repeat can then have several consecutive records
+with the same ID. These records are trimmed to their shared coordinates
+and joined into a single record.
+
+# Usage
+HipSTRCorrection --vcf hipstr_merged_by_mergeSTR.vcf.gz --out hipstr_merged_corrected.vcf.gz
+"""
+
+import argparse
+import itertools
+import logging
+import math
+import numpy as np
+import os
+import trtools.utils.utils as utils
+import sys
+
+from cyvcf2 import VCF
+
+from . import vcfio as vcfio
+from ensembletr import __version__
+
+log = logging.getLogger("ensembletr.hipstr_correction")
+
+def GroupRecords(records):
+    r"""
+    Group consecutive records with the same ID
+
+    Records are streamed: only the records of
+    the current group are kept in memory.
+
+    Parameters
+    ----------
+    records : iterator of cyvcf2.Variant
+       Records of the merged HipSTR VCF
+
+    Returns
+    -------
+    groups : iterator of list of cyvcf2.Variant
+       Records of each group, in input order
+    """
+    for _, group in itertools.groupby(records, key=lambda record: record.ID):
+        yield list(group)
+
+def GetSharedCoordinates(records):
+    r"""
+    Get the coordinates covered by all records of a group
+
+    Parameters
+    ----------
+    records : list of cyvcf2.Variant
+       Records with the same ID
+
+    Returns
+    -------
+    start : int
+       Largest start position of the records
+    end : int
+       Smallest end position of the records
+    """
+    start = max(record.POS for record in records)
+    end = min(record.POS + len(record.REF) - 1 for record in records)
+    assert(start > 0)
+    assert(end > 0)
+    return start, end
+
+def TrimAlleles(records, start, end):
+    r"""
+    Trim the alleles of a group of records to the given coordinates
+
+    Parameters
+    ----------
+    records : list of cyvcf2.Variant
+       Records with the same ID
+    start : int
+       First position kept
+    end : int
+       Last position kept
+
+    Returns
+    -------
+    alleles : list of str
+       Trimmed alleles, REF first then the sorted ALTs
+    allele_map : dict of (str, int): str
+       Trimmed allele of each (ALT, index of the record)
+    ref_allele : str
+       Trimmed REF allele, the same for all records
+    """
+    alleles = set()
+    refs = set()
+    allele_map = {}
+    for i, record in enumerate(records):
+        start_diff = start - record.POS
+        end_diff = record.POS + len(record.REF) - 1 - end
+        assert(start_diff >= 0)
+        assert(end_diff >= 0)
+        refs.add(record.REF[start_diff:len(record.REF) - end_diff])
+        for allele in record.ALT:
+            trimmed_allele = allele[start_diff:len(allele) - end_diff]
+            alleles.add(trimmed_allele)
+            allele_map[(allele, i)] = trimmed_allele
+    assert(len(refs) == 1) # All the ref alleles should be same after trimming
+    ref_allele = list(refs)[0]
+    assert(len(ref_allele) > 0)
+    alleles.discard(ref_allele)
+    alleles = [ref_allele] + sorted(alleles)
+    return alleles, allele_map, ref_allele
+
+def getFormatValue(value):
+    r"""
+    Convert a FORMAT value of a sample to its output value
+
+    Parameters
+    ----------
+    value : object
+       Value returned by cyvcf2.Variant.format for one sample
+
+    Returns
+    -------
+    value : object
+       "." for a missing value, else the value
+       (the first one if it is an array)
+    """
+    if type(value) == np.ndarray:
+        value = value[0]
+        if value == -2147483648 or math.isnan(value):
+            return "."
+        return value
+    if value == -2147483648:
+        return "."
+    return value
+
+def UpdateFormat(alleles, allele_map, records, ref_allele, samples):
+    r"""
+    Get the FORMAT fields of each sample at a joined record
+
+    GT and GB are converted to the trimmed alleles, other fields
+    are copied. Samples called by several records take the call
+    of the last one. Samples with no call are missing.
+
+    Parameters
+    ----------
+    alleles : list of str
+       Trimmed alleles (see TrimAlleles)
+    allele_map : dict of (str, int): str
+       Trimmed allele of each (ALT, index of the record)
+    records : list of cyvcf2.Variant
+       Records with the same ID
+    ref_allele : str
+       Trimmed REF allele
+    samples : list of str
+       Samples of the VCF
+
+    Returns
+    -------
+    updated_format : dict of str: dict of str: object
+       Value of each FORMAT field of each sample
+    """
+    allele_index = {allele: i for i, allele in enumerate(alleles)}
+    updated_format = {sample: {} for sample in samples}
+    for j, record in enumerate(records):
+        format_data = {}
+        for format_field in record.FORMAT[1:]:
+            format_data[format_field] = record.format(format_field)
+        genotypes = record.genotypes
+        for i, sample in enumerate(samples):
+            gt = genotypes[i]
+            if gt[0] == -1:
+                continue
+            new_gt = [0, 0]
+            new_gb = [0, 0]
+            trimmed = False
+            for k in range(2):
+                if gt[k] == 0:
+                    continue
+                new_allele = allele_map[(record.ALT[gt[k]-1], j)]
+                if new_allele == '': # the allele got fully trimmed
+                    trimmed = True
+                    break
+                new_gt[k] = allele_index[new_allele]
+                new_gb[k] = len(new_allele) - len(ref_allele)
+            if trimmed:
+                continue
+            sample_format = updated_format[sample]
+            sample_format['GT'] = ("%d|%d" if gt[2] else "%d/%d")%tuple(new_gt)
+            sample_format['GB'] = "%d|%d"%tuple(new_gb)
+            for format_field in record.FORMAT[2:]:
+                value = format_data[format_field][i]
+                # Missing strings keep the value of an earlier record
+                if isinstance(value, str) and value == ".":
+                    continue
+                sample_format[format_field] = getFormatValue(value)
+    # Samples with no call at all
+    for sample in samples:
+        if not updated_format[sample]:
+            for format_field in records[0].FORMAT:
+                updated_format[sample][format_field] = "."
+    return updated_format
+
+def GetInfoString(record, pos, ref_allele):
+    r"""
+    Get the INFO field of a corrected record
+
+    Parameters
+    ----------
+    record : cyvcf2.Variant
+       Record the PERIOD comes from
+    pos : int
+       Position of the corrected record
+    ref_allele : str
+       REF allele of the corrected record
+
+    Returns
+    -------
+    info : str
+       START, END and PERIOD
+    """
+    return "START=%d;END=%d;PERIOD=%s"%(pos, pos + len(ref_allele) - 1, record.INFO['PERIOD'])
+
+def GetRecordString(record, samples):
+    r"""
+    Format a record that is not joined with any other
+
+    Parameters
+    ----------
+    record : cyvcf2.Variant
+       Record with a unique ID
+    samples : list of str
+       Samples of the VCF
+
+    Returns
+    -------
+    line : str
+       VCF record ending with a newline
+    """
+    format_data = {}
+    for format_field in record.FORMAT[1:]:
+        format_data[format_field] = record.format(format_field)
+    genotypes = record.genotypes
+    sample_strings = []
+    for i in range(len(samples)):
+        gt = genotypes[i]
+        if gt[0] == -1:
+            sample_data = ["."]
+        else:
+            sample_data = [("%d|%d" if gt[2] else "%d/%d")%(gt[0], gt[1])]
+        for format_field in record.FORMAT[1:]:
+            sample_data.append(str(getFormatValue(format_data[format_field][i])))
+        sample_strings.append(":".join(sample_data))
+    return '\t'.join([record.CHROM, str(record.POS), record.ID,
+                      record.REF, ",".join(record.ALT), ".", ".",
+                      GetInfoString(record, record.POS, record.REF),
+                      ':'.join(record.FORMAT),
+                      '\t'.join(sample_strings)]) + '\n'
+
+def JoinRecords(records, samples):
+    r"""
+    Join a group of records with the same ID into one record
+
+    Parameters
+    ----------
+    records : list of cyvcf2.Variant
+       Records with the same ID
+    samples : list of str
+       Samples of the VCF
+
+    Returns
+    -------
+    pos : int
+       Position of the joined record
+    line : str
+       VCF record ending with a newline
+    """
+    pos, end = GetSharedCoordinates(records)
+    alleles, allele_map, ref_allele = TrimAlleles(records, pos, end)
+    updated_format = UpdateFormat(alleles, allele_map, records, ref_allele, samples)
+    alt_string = ",".join(alleles[1:])
+    if len(alleles) == 1 or (len(alleles) == 2 and alleles[1] == ""):
+        alt_string = "."
+    sample_strings = [":".join([str(value) for value in updated_format[sample].values()]) \
+                      for sample in samples]
+    return pos, '\t'.join([records[0].CHROM, str(pos), records[0].ID,
+                           ref_allele, alt_string, ".", ".",
+                           GetInfoString(records[0], pos, ref_allele),
+                           ':'.join(records[0].FORMAT),
+                           '\t'.join(sample_strings)]) + '\n'
+
+def CorrectRecords(records, samples):
+    r"""
+    Correct the records of a merged HipSTR VCF
+
+    Groups of consecutive records with the same ID are joined,
+    whatever their size. Other records keep their alleles and calls.
+
+    Parameters
+    ----------
+    records : iterator of cyvcf2.Variant
+       Records of the merged HipSTR VCF, sorted
+    samples : list of str
+       Samples of the VCF
+
+    Returns
+    -------
+    corrected : iterator of (list of cyvcf2.Variant, int, str)
+       Input records, position and VCF line of each corrected record
+    """
+    for group in GroupRecords(records):
+        if len(group) == 1:
+            yield group, group[0].POS, GetRecordString(group[0], samples)
+            continue
+        log.debug("Joining %d records of %s", len(group), group[0].ID)
+        pos, line = JoinRecords(group, samples)
+        yield group, pos, line
+
+def CorrectVCF(vcf_path, out_path, compress_threads=1, index="tbi"):
+    r"""
+    Correct a merged HipSTR VCF file
+
+    Parameters
+    ----------
+    vcf_path : str
+       Merged HipSTR VCF
+    out_path : str
+       Output VCF. If it ends with .gz, it is bgzipped
+    compress_threads : int, optional
+       Number of threads compressing a .gz output
+    index : str, optional
+       Index of a .gz output to build: "tbi", "csi" or None
+
+    Returns
+    -------
+    num_records : int
+       Number of records read
+    num_corrected : int
+       Number of records written
+    """
+    reader = VCF(vcf_path, strict_gt=True)
+    # Joined records can move past the next records, sort them if
+    # the chromosome order is known
+    chroms = reader.seqnames if len(reader.seqnames) > 0 else None
+    writer = vcfio.Writer(out_path, reader.samples, None, chroms=chroms,
+                          compress_threads=compress_threads, index=index, header=reader.raw_header)
+    num_records = 0
+    num_corrected = 0
+    for group, pos, line in CorrectRecords(reader, reader.samples):
+        # Records still to come start after the first record of the group
+        writer.FlushUpTo(group[0].CHROM, group[0].POS)
+        writer.AddRecord(group[0].CHROM, pos, line)
+        num_records += len(group)
+        num_corrected += 1
+    writer.Close()
+    reader.close()
+    return num_records, num_corrected
+
+def main(args):
+    if not os.path.exists(args.vcf):
+        utils.common.WARNING("Error: %s does not exist"%args.vcf)
+        return 1
+    if not args.out.endswith(".vcf") and not args.out.endswith(".vcf.gz"):
+        utils.common.WARNING("Error: --out must end with '.vcf' or '.vcf.gz'")
+        return 1
+    if args.compress_threads < 1:
+        utils.common.WARNING("Error: --compress-threads must be at least 1")
+        return 1
+    if args.log_level is not None:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+        logging.getLogger("ensembletr").addHandler(handler)
+        logging.getLogger("ensembletr").setLevel(args.log_level.upper())
+    num_records, num_corrected = CorrectVCF(args.vcf, args.out, args.compress_threads,
+                                            None if args.index == "none" else args.index)
+    log.info("Read %d records, wrote %d corrected records to %s",
+             num_records, num_corrected, args.out)
+    return 0
+
+def getargs(): # pragma: no cover
+    parser = argparse.ArgumentParser(
+        __doc__,
+        formatter_class=utils.ArgumentDefaultsHelpFormatter
+    )
+    inout_group = parser.add_argument_group("Input/output")
+    inout_group.add_argument("--vcf", help="Merged HipSTR VCF (e.g. output of mergeSTR). Must be sorted",
+                             type=str, required=True)
+    inout_group.add_argument("--out", help="Output corrected VCF file. If it ends with .vcf.gz, "
+                             "it is bgzipped and indexed", type=str, required=True)
+    inout_group.add_argument("--index", help="Index to build for a .vcf.gz output",
+                             choices=["tbi", "csi", "none"], default="tbi")
+    perf_group = parser.add_argument_group("Performance")
+    perf_group.add_argument("--compress-threads", help="Number of threads compressing "
+                            "a .vcf.gz output", type=int, default=1)
+    debug_group = parser.add_argument_group("Debug")
+    debug_group.add_argument("--log-level", help="Print log messages of at least this level. "
+                             "Silent by default", choices=["debug", "info", "warning", "error"])
+    ver_group = parser.add_argument_group("Version")
+    ver_group.add_argument("--version", action="version", version = '{version}'.format(version=__version__))
+    args = parser.parse_args()
+    return args
+
+def run(): # pragma: no cover
+    args = getargs()
+    if args == None:
+        sys.exit(1)
+    else:
+        retcode = main(args)
+        sys.exit(retcode)
+
+if __name__ == "__main__": # pragma: no cover
+    run()
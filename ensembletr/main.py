@@ -9,48 +9,346 @@ EnsembleTR --out test.vcf --ref hg38.fa --vcfs ensembletr/ExampleData/advntr-chr
 """
 
 import argparse
-import networkx as nx
+import logging
+import multiprocessing
 import numpy as np
 import os
 from pyfaidx import Fasta
+import shutil
+import tempfile
 import trtools.utils.utils as utils
 import sys
 
 from . import vcfio as vcfio
+from . import checkpoint as checkpoint
+from . import memory as memory
 from . import recordcluster as recordcluster
+from . import pipeline as pipeline
+from . import profiling as profiling
+from . import samplepool as samplepool
 from ensembletr import __version__
 
-def main(args):
-    if not os.path.exists(args.ref):
-        utils.common.WARNING("Error: %s does not exist"%args.ref)
-        return 1
-    for vcffile in args.vcfs.split(","):
-        if not os.path.exists(vcffile):
-            utils.common.WARNING("Error: %s does not exist"%vcffile)
-            return 1
-    if not args.out.endswith("vcf"):
-        utils.common.WARNING("Error: --out must end with '.vcf'")
-        return 1
+log = logging.getLogger("ensembletr.main")
 
-    ref_genome = Fasta(args.ref)
-    readers = vcfio.Readers(args.vcfs.split(","), ref_genome)
-    writer = vcfio.Writer(args.out, readers.samples, " ".join(sys.argv))
+def MergeRecords(readers, writer, exclude_single=False, end_after=-1, sample_pool=None,
+                 journal=None):
+    r"""
+    Merge all records of the readers and write them out
+
+    Parameters
+    ----------
+    readers : vcfio.Readers
+       Readers of the input VCF files
+    writer : vcfio.Writer
+       Writer of the merged VCF file
+    exclude_single : bool
+       Skip TRs called by only one genotyper
+    end_after : int
+       Stop after processing this many record clusters (-1 for no limit)
+    sample_pool : samplepool.SamplePool, optional
+       Worker processes used to resolve blocks of samples
+    journal : checkpoint.Journal, optional
+       Journal recording checkpoints to resume from
 
+    Returns
+    -------
+    recnum : int
+       Number of record clusters processed
+    """
     recnum = 0
     while not readers.done:
         rc_list = readers.getMergableCalls().RecordClusters
         rc_list.sort(key=lambda x: x.first_pos)
         for rc in rc_list:
             num_vcfs = len([i for i in rc.vcf_types if i == True])
-            if not (num_vcfs == 1 and args.exclude_single):
-                recresolver = recordcluster.RecordResolver(rc)
+            if not (num_vcfs == 1 and exclude_single):
+                recresolver = recordcluster.RecordResolver(rc, sample_pool)
                 if recresolver.Resolve():
                     writer.WriteRecord(recresolver)
+                recresolver.Release()
+                memory.CheckBudget(writer)
             recnum += 1
             readers.goToNext(rc.vcf_types)
-        if args.end_after != -1 and recnum >= args.end_after:
+        # Records left start at or after the current range
+        if not readers.done:
+            writer.FlushUpTo(readers.cur_range_chrom, readers.cur_range_start_pos)
+            if journal is not None and journal.Due(writer):
+                journal.Write(writer, {"readers": readers.GetResumePositions()})
+        if end_after != -1 and recnum >= end_after:
             break
+    return recnum
+
+def MergeRegion(task):
+    r"""
+    Merge the records starting in a single region.
+    Run in worker processes when using --threads.
+
+    Parameters
+    ----------
+    task : tuple
+       (vcfpaths, ref path, samples, region, output path, exclude_single,
+       reference window size, sort buffer size, output buffer size,
+       keep consensus calls for the sidecar, profile, memory budget (bytes),
+       target regions, INPUTS encoding)
+
+    Returns
+    -------
+    out_path : str
+       Path to the records (without header) of the region.
+       With the sidecar, their consensus calls are in out_path + ".rows".
+    ref_cache_stats : (int, int)
+       Hits and misses of the reference cache
+    profile : dict
+       Profile of the region (see profiling.Profiler.GetData),
+       None if not profiling
+    """
+    vcfpaths, ref_path, samples, region, out_path, exclude_single, ref_window_size, \
+        sort_buffer_size, output_buffer_size, keep_rows, profile, max_memory, targets, inputs_mode = task
+    if profile:
+        profiling.Enable()
+    memory.SetBudget(max_memory)
+    ref_genome = Fasta(ref_path)
+    readers = vcfio.Readers(vcfpaths, ref_genome, region=region, samples=samples,
+                            ref_window_size=ref_window_size, targets=targets)
+    writer = vcfio.Writer(out_path, samples, None, write_header=False, chroms=readers.chroms,
+                          sort_buffer_size=sort_buffer_size, tmpdir=os.path.dirname(out_path),
+                          buffer_size=output_buffer_size,
+                          row_path=(out_path + ".rows") if keep_rows else None,
+                          inputs_mode=inputs_mode)
+    MergeRecords(readers, writer, exclude_single)
+    writer.Close()
+    profile_data = None
+    if profile:
+        profile_data = profiling.PROFILER.GetData()
+    return out_path, (readers.ref_cache.hits, readers.ref_cache.misses), profile_data
+
+def MergeParallel(args, readers, writer, journal=None, regions_done=0):
+    r"""
+    Split the input into regions, merge them in a pool
+    of worker processes and concatenate the results in order.
+    Each worker sorts the records of its region.
+
+    Parameters
+    ----------
+    args : argparse namespace
+       Command line arguments
+    readers : vcfio.Readers
+       Readers of the input VCF files
+    writer : vcfio.Writer
+       Writer of the merged VCF file (header already written)
+    journal : checkpoint.Journal, optional
+       Journal recording checkpoints to resume from
+    regions_done : int, optional
+       Number of regions already merged by a previous run
+
+    Returns
+    -------
+    ref_cache_stats : (int, int)
+       Hits and misses of the reference caches of all workers
+    """
+    vcfpaths = args.vcfs.split(",")
+    regions = vcfio.GetMergeRegions(vcfpaths, readers.file_vcftypes, readers.chroms,
+                                    readers.ref_genome, args.region_size)
+    if readers.targets is not None:
+        regions = [region for region in regions if vcfio.HasTargets(region, readers.targets)]
+    # Workers share the budget
+    worker_max_memory = None
+    if memory.BUDGET is not None:
+        worker_max_memory = memory.BUDGET.max_bytes // args.threads
+    tmpdir = tempfile.mkdtemp(prefix="ensembletr-",
+                              dir=os.path.dirname(os.path.abspath(args.out)))
+    tasks = [(vcfpaths, args.ref, readers.samples, region,
+              os.path.join(tmpdir, "region%d.vcf"%i), args.exclude_single,
+              args.ref_window_size, args.sort_buffer_size, args.output_buffer_size,
+              args.sidecar is not None, args.profile is not None, worker_max_memory,
+              readers.targets, args.inputs_mode)
+             for i, region in enumerate(regions)]
+    hits, misses = 0, 0
+    try:
+        with multiprocessing.Pool(args.threads) as pool:
+            for i, (out_path, ref_cache_stats, profile_data) in \
+                    enumerate(pool.imap(MergeRegion, tasks[regions_done:]), regions_done):
+                if profile_data is not None:
+                    profiling.PROFILER.Merge(profile_data)
+                rows = None
+                if args.sidecar is not None:
+                    rows = vcfio.ReadRows(out_path + ".rows")
+                with open(out_path, "r") as f:
+                    writer.WriteRecords(f, rows)
+                os.remove(out_path)
+                if rows is not None:
+                    rows.close()
+                    os.remove(out_path + ".rows")
+                # Records of later regions start after this one
+                if i + 1 < len(regions):
+                    writer.FlushUpTo(regions[i+1][0], regions[i+1][1])
+                    if journal is not None and journal.Due(writer):
+                        journal.Write(writer, {"regions_done": i + 1})
+                hits += ref_cache_stats[0]
+                misses += ref_cache_stats[1]
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return hits, misses
+
+def main(args):
+    if not os.path.exists(args.ref):
+        utils.common.WARNING("Error: %s does not exist"%args.ref)
+        return 1
+    for vcffile in args.vcfs.split(","):
+        if not os.path.exists(vcffile):
+            utils.common.WARNING("Error: %s does not exist"%vcffile)
+            return 1
+    if not args.out.endswith(".vcf") and not args.out.endswith(".vcf.gz"):
+        utils.common.WARNING("Error: --out must end with '.vcf' or '.vcf.gz'")
+        return 1
+    if args.threads < 1:
+        utils.common.WARNING("Error: --threads must be at least 1")
+        return 1
+    if args.region_size < 1:
+        utils.common.WARNING("Error: --region-size must be at least 1")
+        return 1
+    if args.threads > 1 and args.end_after != -1:
+        utils.common.WARNING("Error: --end-after cannot be used with --threads")
+        return 1
+    if args.sample_threads < 1:
+        utils.common.WARNING("Error: --sample-threads must be at least 1")
+        return 1
+    if args.sample_block_size < 1:
+        utils.common.WARNING("Error: --sample-block-size must be at least 1")
+        return 1
+    if args.queue_size < 1:
+        utils.common.WARNING("Error: --queue-size must be at least 1")
+        return 1
+    if args.threads > 1 and args.pipeline:
+        utils.common.WARNING("Error: --threads and --pipeline cannot be used together")
+        return 1
+    if args.threads > 1 and args.sample_threads > 1:
+        utils.common.WARNING("Error: --threads and --sample-threads cannot be used together")
+        return 1
+    if args.ref_window_size < 1:
+        utils.common.WARNING("Error: --ref-window-size must be at least 1")
+        return 1
+    if args.sort_buffer_size < 1:
+        utils.common.WARNING("Error: --sort-buffer-size must be at least 1")
+        return 1
+    if args.compress_threads < 1:
+        utils.common.WARNING("Error: --compress-threads must be at least 1")
+        return 1
+    if args.sidecar_chunk_size < 1:
+        utils.common.WARNING("Error: --sidecar-chunk-size must be at least 1")
+        return 1
+    if args.output_buffer_size < 1:
+        utils.common.WARNING("Error: --output-buffer-size must be at least 1")
+        return 1
+    if args.checkpoint_interval < 0:
+        utils.common.WARNING("Error: --checkpoint-interval must be at least 0")
+        return 1
+    if args.max_memory is not None and args.max_memory < 1:
+        utils.common.WARNING("Error: --max-memory must be at least 1")
+        return 1
+    if args.regions is not None and len([regstr for regstr in args.regions.split(",") if regstr]) == 0:
+        utils.common.WARNING("Error: --regions is empty")
+        return 1
+    if args.regions_file is not None and not os.path.exists(args.regions_file):
+        utils.common.WARNING("Error: %s does not exist"%args.regions_file)
+        return 1
+    if args.log_level is not None:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+        logging.getLogger("ensembletr").addHandler(handler)
+        logging.getLogger("ensembletr").setLevel(args.log_level.upper())
+    if args.profile is not None:
+        profiling.Enable()
+    if args.max_memory is not None:
+        memory.SetBudget(args.max_memory * 1024 * 1024)
+
+    targets = None
+    if args.regions is not None or args.regions_file is not None:
+        targets = []
+        try:
+            if args.regions is not None:
+                targets.extend([vcfio.ParseRegion(regstr) for regstr in args.regions.split(",") if regstr])
+            if args.regions_file is not None:
+                targets.extend(vcfio.LoadRegionsFile(args.regions_file))
+        except ValueError:
+            return 1
+
+    # Options the output depends on, a run can only
+    # be resumed with the same ones
+    settings = {"vcfs": args.vcfs.split(","), "ref": args.ref, "index": args.index,
+                "sidecar": args.sidecar, "exclude_single": args.exclude_single,
+                "region_size": args.region_size if args.threads > 1 else None,
+                "targets": None if targets is None else [list(target) for target in targets],
+                "inputs_mode": args.inputs_mode}
+    journal = checkpoint.Journal(args.out + ".ckpt", settings, args.checkpoint_interval)
+    resume = None
+    if args.resume:
+        if not os.path.exists(journal.path):
+            utils.common.WARNING("Error: --resume requires the checkpoint journal %s"%journal.path)
+            return 1
+        try:
+            resume = checkpoint.LoadJournal(journal.path, settings)
+        except ValueError:
+            return 1
+    else:
+        # Checkpoints of a previous run do not apply to the new output
+        journal.Remove()
+
+    if resume is not None:
+        log.info("Resuming from the checkpoint in %s", journal.path)
+    ref_genome = Fasta(args.ref)
+    readers = vcfio.Readers(args.vcfs.split(","), ref_genome,
+                            ref_window_size=args.ref_window_size,
+                            resume_positions=None if resume is None else resume["progress"].get("readers"),
+                            targets=targets)
+    index = None
+    if args.index != "none":
+        index = args.index
+    sidecar = None
+    if args.sidecar is not None:
+        sidecar = vcfio.SidecarWriter(args.sidecar, readers.samples, args.sidecar_chunk_size,
+                                      resume=None if resume is None else resume["output"]["sidecar"])
+    writer = vcfio.Writer(args.out, readers.samples, " ".join(sys.argv), chroms=readers.chroms,
+                          sort_buffer_size=args.sort_buffer_size,
+                          tmpdir=os.path.dirname(os.path.abspath(args.out)),
+                          compress_threads=args.compress_threads, index=index,
+                          buffer_size=args.output_buffer_size, sidecar=sidecar,
+                          resume=None if resume is None else resume["output"],
+                          inputs_mode=args.inputs_mode)
+    log.info("Merging %d samples from %d VCF files", len(readers.samples), len(readers.file_vcftypes))
+
+    sample_pool = None
+    if args.sample_threads > 1:
+        sample_pool = samplepool.SamplePool(args.sample_threads, args.sample_block_size)
+    try:
+        if args.pipeline:
+            merge_pipeline = pipeline.Pipeline(readers, writer, args.exclude_single, args.end_after,
+                                               sample_pool, args.queue_size, journal)
+            merge_pipeline.Run()
+            for counters in merge_pipeline.counters:
+                utils.common.MSG("Pipeline %s"%counters.GetSummary(), debug=args.pipeline_stats)
+            ref_cache_stats = (readers.ref_cache.hits, readers.ref_cache.misses)
+        elif args.threads == 1:
+            MergeRecords(readers, writer, args.exclude_single, args.end_after, sample_pool, journal)
+            ref_cache_stats = (readers.ref_cache.hits, readers.ref_cache.misses)
+        else:
+            regions_done = 0
+            if resume is not None:
+                regions_done = resume["progress"]["regions_done"]
+            ref_cache_stats = MergeParallel(args, readers, writer, journal, regions_done)
+    finally:
+        if sample_pool is not None:
+            sample_pool.Close()
     writer.Close()
+    journal.Remove()
+    if memory.BUDGET is not None:
+        log.info(memory.BUDGET.GetSummary())
+    if args.profile is not None:
+        profiling.PROFILER.Write(args.profile)
+        log.info("Wrote the profile to %s", args.profile)
+    utils.common.MSG("Reference cache: %d hits, %d misses"%ref_cache_stats,
+                     debug=args.ref_cache_stats)
+    return 0
 
 
 def getargs(): # pragma: no cover
@@ -61,11 +359,67 @@ def getargs(): # pragma: no cover
     inout_group = parser.add_argument_group("Input/output")
     inout_group.add_argument("--vcfs", help="Comma-separated list of VCFs to merge. Must be sorted/indexed", type=str,
                         required=True)
-    inout_group.add_argument("--out", help="Output merged VCF file", type=str, required= True)
+    inout_group.add_argument("--out", help="Output merged VCF file. Sorted. If it ends with .vcf.gz, "
+                             "it is bgzipped and indexed", type=str, required= True)
     inout_group.add_argument("--ref", help="Reference genome .fa file", type=str, required=True)
+    inout_group.add_argument("--sidecar", help="Directory where to also write the consensus calls "
+                             "(GT, GB, NCOPY, SCORE, GTS) as memory-mappable numpy arrays", type=str)
+    inout_group.add_argument("--sidecar-chunk-size", help="Number of loci per file of the --sidecar arrays",
+                             type=int, default=vcfio.SIDECAR_CHUNK_SIZE)
+    inout_group.add_argument("--index", help="Index to build for a .vcf.gz output",
+                             choices=["tbi", "csi", "none"], default="tbi")
+    inout_group.add_argument("--inputs-mode", help="Encoding of the INPUTS field: copy numbers "
+                             "called by each method (full), allele indices of the input records (compact) "
+                             "or no INPUTS field (none)", choices=vcfio.INPUTS_MODES, default="full")
+    inout_group.add_argument("--checkpoint-interval", help="Seconds between checkpoints recorded "
+                             "in the journal <out>.ckpt, used by --resume. 0 to disable",
+                             type=float, default=checkpoint.CHECKPOINT_INTERVAL)
+    inout_group.add_argument("--resume", help="Resume an interrupted run from the last checkpoint "
+                             "of its journal. The output is truncated to the checkpoint and the "
+                             "input VCFs (must be indexed) are read from there", default=False, action='store_true')
     filter_group = parser.add_argument_group("Filtering")
+    filter_group.add_argument("--regions", help="Only merge records overlapping these regions. "
+                              "Comma-separated list of chrom:start-end (1-based, inclusive) or chrom. "
+                              "Requires indexed VCFs", type=str)
+    filter_group.add_argument("--regions-file", help="Only merge records overlapping the regions "
+                              "of this BED file. Requires indexed VCFs", type=str)
+    perf_group = parser.add_argument_group("Performance")
+    perf_group.add_argument("--threads", "--workers", help="Number of worker processes. "
+                            "If more than 1, the input is split into regions that are merged in parallel. "
+                            "Requires indexed VCFs", type=int, default=1)
+    perf_group.add_argument("--region-size", help="Approximate size (bp) of regions merged by each "
+                            "worker when using --threads", type=int, default=5000000)
+    perf_group.add_argument("--pipeline", help="Read, resolve and write in separate threads "
+                            "connected by bounded queues", default=False, action='store_true')
+    perf_group.add_argument("--queue-size", help="Maximum number of record clusters waiting "
+                            "between stages when using --pipeline", type=int, default=pipeline.QUEUE_SIZE)
+    perf_group.add_argument("--sample-threads", help="Number of worker processes resolving blocks "
+                            "of samples at each locus. Useful for cohorts with thousands of samples", type=int, default=1)
+    perf_group.add_argument("--sample-block-size", help="Number of samples resolved by each task "
+                            "when using --sample-threads", type=int, default=500)
+    perf_group.add_argument("--sort-buffer-size", help="Number of output records kept in memory "
+                            "for sorting before spilling to temporary files", type=int, default=vcfio.SORT_BUFFER_SIZE)
+    perf_group.add_argument("--output-buffer-size", help="Size (bytes) of the buffer of "
+                            "the output file", type=int, default=vcfio.OUTPUT_BUFFER_SIZE)
+    perf_group.add_argument("--compress-threads", help="Number of threads compressing "
+                            "a .vcf.gz output", type=int, default=1)
+    perf_group.add_argument("--max-memory", help="Memory budget (MB). When exceeded, buffered "
+                            "records are spilled to disk and large loci are resolved in chunks of "
+                            "samples instead of failing. With --threads, split between the workers",
+                            type=int)
+    perf_group.add_argument("--ref-window-size", help="Size (bp) of the window of reference "
+                            "sequence kept in memory to pad records", type=int, default=vcfio.REF_WINDOW_SIZE)
     debug_group = parser.add_argument_group("Debug")
     debug_group.add_argument("--end-after", help="Only process the first N records", type=int, default=-1)
+    debug_group.add_argument("--ref-cache-stats", help="Print hits and misses of the reference "
+                            "sequence cache", default=False, action='store_true')
+    debug_group.add_argument("--pipeline-stats", help="Print the time each --pipeline stage "
+                            "spent busy and idle", default=False, action='store_true')
+    debug_group.add_argument("--profile", help="Write the time and memory used by each stage, "
+                             "counters of each locus and the loci with the largest memory "
+                             "footprint to this JSON file", type=str)
+    debug_group.add_argument("--log-level", help="Print log messages of at least this level. "
+                             "Silent by default", choices=["debug", "info", "warning", "error"])
     debug_group.add_argument("--exclude-single", help="Exclude TRs called by only one genotyper", default=False, action='store_true')
     ver_group = parser.add_argument_group("Version")
     ver_group.add_argument("--version", action="version", version = '{version}'.format(version=__version__))
@@ -0,0 +1,217 @@
+"""
+Memory accounting of the merge and the optional --max-memory budget
+"""
+
+import logging
+import os
+import resource
+import sys
+
+log = logging.getLogger(__name__)
+
+# Samples resolved at once at loci that do not fit in the budget
+SAMPLE_CHUNK_SIZE = 256
+# Estimated bytes of the results of one sample while resolving a locus
+SAMPLE_RESULT_BYTES = 512
+# Estimated bytes of the calls of one sample for each record of a locus
+SAMPLE_CALL_BYTES = 64
+
+# Budget of the current process, None when memory is not limited
+BUDGET = None
+
+# File descriptor of /proc/self/statm and the process it was opened in
+_statm = None
+_statm_pid = None
+
+def GetCurrentRSS():
+    r"""
+    Get the resident set size of the current process
+
+    Falls back to the peak resident set size on
+    platforms without /proc/self/statm.
+
+    Returns
+    -------
+    rss : int
+       Resident set size (bytes)
+    """
+    global _statm, _statm_pid
+    try:
+        # /proc/self is resolved when opening, reopen it in forked workers
+        if _statm_pid != os.getpid():
+            _statm = os.open("/proc/self/statm", os.O_RDONLY)
+            _statm_pid = os.getpid()
+        return int(os.pread(_statm, 128, 0).split()[1]) * resource.getpagesize()
+    except OSError:
+        return getMaxRSS()
+
+def getMaxRSS():
+    r"""
+    Get the peak resident set size reported by getrusage
+
+    Returns
+    -------
+    rss : int
+       Peak resident set size (bytes)
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    if sys.platform == "darwin":
+        return peak
+    return peak * 1024
+
+def GetPeakRSS():
+    r"""
+    Get the peak resident set size of the current process
+
+    Returns
+    -------
+    rss : int
+       Peak resident set size (bytes), at least the current one
+    """
+    return max(getMaxRSS(), GetCurrentRSS())
+
+def EstimateResolveBytes(num_samples, num_records):
+    r"""
+    Estimate the memory needed to resolve all samples of a locus at once
+
+    Parameters
+    ----------
+    num_samples : int
+       Number of samples
+    num_records : int
+       Number of records of the record cluster
+
+    Returns
+    -------
+    nbytes : int
+       Estimated bytes
+    """
+    return num_samples * (SAMPLE_RESULT_BYTES + num_records * SAMPLE_CALL_BYTES)
+
+class Budget:
+    """
+    Maximum resident set size of the process
+
+    The merge checks the budget between loci. When it is exceeded,
+    buffered output records are spilled to disk, the --pipeline
+    reader waits for the queued loci to be written, and loci are
+    resolved in chunks of samples. Only the index of its distinct
+    result is kept for each sample of a chunk. The merge goes on
+    (more slowly) if the budget is still exceeded.
+
+    Parameters
+    ----------
+    max_bytes : int
+       Budget (bytes)
+
+    Attributes
+    ----------
+    num_exceeded : int
+       Number of checks that found the budget exceeded
+    num_chunked : int
+       Number of loci resolved in chunks of samples
+    peak_rss : int
+       Largest resident set size seen by the checks (bytes)
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.num_exceeded = 0
+        self.num_chunked = 0
+        self.peak_rss = 0
+
+    def Exceeded(self):
+        r"""
+        Check if the process uses more memory than the budget
+
+        Returns
+        -------
+        exceeded : bool
+           True if the resident set size is above the budget
+        """
+        rss = GetCurrentRSS()
+        self.peak_rss = max(self.peak_rss, rss)
+        if rss <= self.max_bytes:
+            return False
+        if self.num_exceeded == 0:
+            log.warning("Memory use (%d MB) exceeds the budget (%d MB), spilling buffered "
+                        "records and resolving loci in chunks of samples",
+                        rss >> 20, self.max_bytes >> 20)
+        self.num_exceeded += 1
+        return True
+
+    def GetSampleChunkSize(self, num_samples, num_records):
+        r"""
+        Get the number of samples to resolve at once at a locus
+
+        Parameters
+        ----------
+        num_samples : int
+           Number of samples
+        num_records : int
+           Number of records of the record cluster
+
+        Returns
+        -------
+        chunk_size : int
+           Number of samples resolved at once. num_samples if
+           the whole locus fits in the memory left.
+        """
+        if num_samples <= SAMPLE_CHUNK_SIZE:
+            return num_samples
+        headroom = self.max_bytes - GetCurrentRSS()
+        if EstimateResolveBytes(num_samples, num_records) <= headroom:
+            return num_samples
+        self.num_chunked += 1
+        return SAMPLE_CHUNK_SIZE
+
+    def GetSummary(self):
+        r"""
+        Get a one-line summary of the budget
+
+        Returns
+        -------
+        summary : str
+           Budget, peak memory use and actions taken
+        """
+        return "Memory budget %d MB: peak %d MB, exceeded %d times, %d loci resolved in chunks"%(
+            self.max_bytes >> 20, max(self.peak_rss, GetPeakRSS()) >> 20,
+            self.num_exceeded, self.num_chunked)
+
+def SetBudget(max_bytes):
+    r"""
+    Limit the memory of the current process
+
+    Parameters
+    ----------
+    max_bytes : int
+       Budget (bytes), None for no limit
+
+    Returns
+    -------
+    budget : Budget
+       The new budget, None for no limit
+    """
+    global BUDGET
+    BUDGET = None if max_bytes is None else Budget(max_bytes)
+    return BUDGET
+
+def CheckBudget(writer):
+    r"""
+    Free buffered output records if the process
+    is over its budget
+
+    Parameters
+    ----------
+    writer : vcfio.Writer
+       Writer of the merged VCF file
+
+    Returns
+    -------
+    exceeded : bool
+       True if the budget was exceeded
+    """
+    if BUDGET is None or not BUDGET.Exceeded():
+        return False
+    writer.SpillBuffer()
+    return True
@@ -0,0 +1,314 @@
+"""
+Pipelined merging: reading, resolving and writing
+run concurrently, connected by bounded queues
+"""
+
+import queue
+import threading
+import time
+
+from . import memory as memory
+from . import recordcluster as recordcluster
+
+# Default number of items held by each queue
+QUEUE_SIZE = 64
+# Seconds between checks for a failed stage while blocked on a queue
+QUEUE_TIMEOUT = 0.1
+
+class StageCounters:
+    """
+    Time spent by a pipeline stage working and waiting on its queues
+
+    Attributes
+    ----------
+    name : str
+       Name of the stage
+    busy : float
+       Seconds spent processing items
+    idle : float
+       Seconds spent waiting for input or for room in the output queue
+    items : int
+       Number of items processed
+    """
+    def __init__(self, name):
+        self.name = name
+        self.busy = 0.0
+        self.idle = 0.0
+        self.items = 0
+
+    def GetSummary(self):
+        r"""
+        Get a one-line summary of the counters
+
+        Returns
+        -------
+        summary : str
+           Name, items, busy and idle seconds of the stage
+        """
+        total = self.busy + self.idle
+        busy_pct = 100.0 * self.busy / total if total > 0 else 0.0
+        return "%s: %d items, busy %.2fs, idle %.2fs (%.1f%% busy)"%(
+            self.name, self.items, self.busy, self.idle, busy_pct)
+
+class Pipeline:
+    """
+    Merge records in three stages running concurrently:
+
+    - reader (thread): advances the readers and builds record clusters
+    - resolver (calling thread): resolves the record clusters
+    - writer (thread): formats, compresses and writes the records
+
+    Stages exchange items through queues of at most queue_size items.
+    Over the memory budget (see memory.Budget), the reader waits for
+    the queued items to be written before adding more.
+    The output is the same as merging sequentially (main.MergeRecords).
+
+    Parameters
+    ----------
+    readers : vcfio.Readers
+       Readers of the input VCF files
+    writer : vcfio.Writer
+       Writer of the merged VCF file
+    exclude_single : bool
+       Skip TRs called by only one genotyper
+    end_after : int
+       Stop after processing this many record clusters (-1 for no limit)
+    sample_pool : samplepool.SamplePool, optional
+       Worker processes used to resolve blocks of samples
+    queue_size : int, optional
+       Maximum number of items in each queue
+    journal : checkpoint.Journal, optional
+       Journal recording checkpoints to resume from
+
+    Attributes
+    ----------
+    counters : list of StageCounters
+       Counters of the reader, resolver and writer stages
+    recnum : int
+       Number of record clusters processed by the reader
+    """
+    def __init__(self, readers, writer, exclude_single=False, end_after=-1,
+                 sample_pool=None, queue_size=QUEUE_SIZE, journal=None):
+        self.readers = readers
+        self.writer = writer
+        self.exclude_single = exclude_single
+        self.end_after = end_after
+        self.sample_pool = sample_pool
+        self.journal = journal
+        self.cluster_queue = queue.Queue(queue_size)
+        self.record_queue = queue.Queue(queue_size)
+        self.reader_counters = StageCounters("reader")
+        self.resolver_counters = StageCounters("resolver")
+        self.writer_counters = StageCounters("writer")
+        self.counters = [self.reader_counters, self.resolver_counters, self.writer_counters]
+        self.recnum = 0
+        self.failed = threading.Event()
+        self.errors = []
+
+    def put(self, out_queue, item, counters):
+        r"""
+        Add an item to a queue, waiting for room
+
+        Parameters
+        ----------
+        out_queue : queue.Queue
+           Queue to add to
+        item : tuple
+           Item to add
+        counters : StageCounters
+           Counters of the stage, its wait is counted as idle
+
+        Returns
+        -------
+        added : bool
+           False if another stage failed while waiting
+        """
+        start = time.perf_counter()
+        try:
+            while not self.failed.is_set():
+                try:
+                    out_queue.put(item, timeout=QUEUE_TIMEOUT)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+        finally:
+            counters.idle += time.perf_counter() - start
+
+    def get(self, in_queue, counters):
+        r"""
+        Take the next item from a queue, waiting for one
+
+        Parameters
+        ----------
+        in_queue : queue.Queue
+           Queue to take from
+        counters : StageCounters
+           Counters of the stage, its wait is counted as idle
+
+        Returns
+        -------
+        item : tuple
+           The next item, or None if another stage failed while waiting
+        """
+        start = time.perf_counter()
+        try:
+            while not self.failed.is_set():
+                try:
+                    return in_queue.get(timeout=QUEUE_TIMEOUT)
+                except queue.Empty:
+                    continue
+            return None
+        finally:
+            counters.idle += time.perf_counter() - start
+
+    def waitForMemory(self, counters):
+        r"""
+        Wait until the queues are empty if the process
+        is over its memory budget
+
+        Parameters
+        ----------
+        counters : StageCounters
+           Counters of the stage, its wait is counted as idle
+
+        Returns
+        -------
+        ok : bool
+           False if another stage failed while waiting
+        """
+        if memory.BUDGET is None or not memory.BUDGET.Exceeded():
+            return True
+        start = time.perf_counter()
+        try:
+            while not self.failed.is_set():
+                if self.cluster_queue.empty() and self.record_queue.empty():
+                    return True
+                time.sleep(QUEUE_TIMEOUT)
+            return False
+        finally:
+            counters.idle += time.perf_counter() - start
+
+    def runStage(self, stage):
+        r"""
+        Run a stage in a thread, recording its error if it fails
+
+        Parameters
+        ----------
+        stage : function
+           Body of the stage
+        """
+        try:
+            stage()
+        except BaseException as e:
+            self.errors.append(e)
+            self.failed.set()
+
+    def readStage(self):
+        r"""
+        Build the record clusters in merge order
+
+        Queues ("cluster", cluster) for clusters to resolve,
+        ("flush", chrom, pos, positions) when the writer may write the
+        records before (chrom, pos) and ("done",) at the end. With a
+        journal, positions are the resume positions of the readers
+        at that point (None otherwise).
+        """
+        counters = self.reader_counters
+        readers = self.readers
+        start = time.perf_counter()
+        while not readers.done:
+            rc_list = readers.getMergableCalls().RecordClusters
+            rc_list.sort(key=lambda x: x.first_pos)
+            for rc in rc_list:
+                num_vcfs = len([i for i in rc.vcf_types if i == True])
+                if not (num_vcfs == 1 and self.exclude_single):
+                    counters.busy += time.perf_counter() - start
+                    if not self.waitForMemory(counters) or \
+                       not self.put(self.cluster_queue, ("cluster", rc), counters):
+                        return
+                    start = time.perf_counter()
+                    counters.items += 1
+                self.recnum += 1
+                readers.goToNext(rc.vcf_types)
+            if not readers.done:
+                positions = None
+                if self.journal is not None:
+                    positions = readers.GetResumePositions()
+                counters.busy += time.perf_counter() - start
+                if not self.put(self.cluster_queue, ("flush", readers.cur_range_chrom,
+                                                     readers.cur_range_start_pos, positions), counters):
+                    return
+                start = time.perf_counter()
+            if self.end_after != -1 and self.recnum >= self.end_after:
+                break
+        counters.busy += time.perf_counter() - start
+        self.put(self.cluster_queue, ("done",), counters)
+
+    def writeStage(self):
+        r"""
+        Write the resolved record clusters in order
+        """
+        counters = self.writer_counters
+        while True:
+            item = self.get(self.record_queue, counters)
+            if item is None or item[0] == "done":
+                return
+            start = time.perf_counter()
+            if item[0] == "flush":
+                self.writer.FlushUpTo(item[1], item[2])
+                if self.journal is not None and self.journal.Due(self.writer):
+                    self.journal.Write(self.writer, {"readers": item[3]})
+            else:
+                self.writer.WriteRecord(item[1])
+                item[1].Release()
+                memory.CheckBudget(self.writer)
+                counters.items += 1
+            counters.busy += time.perf_counter() - start
+
+    def resolveStage(self):
+        r"""
+        Resolve the record clusters queued by the reader
+        """
+        counters = self.resolver_counters
+        while True:
+            item = self.get(self.cluster_queue, counters)
+            if item is None:
+                return
+            if item[0] == "cluster":
+                start = time.perf_counter()
+                recresolver = recordcluster.RecordResolver(item[1], self.sample_pool)
+                resolved = recresolver.Resolve()
+                counters.busy += time.perf_counter() - start
+                counters.items += 1
+                if not resolved:
+                    # Written clusters are released by the writer
+                    recresolver.Release()
+                    continue
+                item = ("record", recresolver)
+            if not self.put(self.record_queue, item, counters):
+                return
+            if item[0] == "done":
+                return
+
+    def Run(self):
+        r"""
+        Run all stages until the readers are done
+
+        Returns
+        -------
+        recnum : int
+           Number of record clusters processed
+        """
+        threads = [threading.Thread(target=self.runStage, args=(self.readStage,),
+                                    name="ensembletr-reader", daemon=True),
+                   threading.Thread(target=self.runStage, args=(self.writeStage,),
+                                    name="ensembletr-writer", daemon=True)]
+        for thread in threads:
+            thread.start()
+        self.runStage(self.resolveStage)
+        for thread in threads:
+            thread.join()
+        if len(self.errors) > 0:
+            raise self.errors[0]
+        return self.recnum
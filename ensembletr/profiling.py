@@ -0,0 +1,248 @@
+"""
+Optional profiling of the merge: wall time, calls and memory
+of each stage and counters of each locus
+"""
+
+import contextlib
+import functools
+import json
+import time
+
+from . import memory as memory
+
+# Stages timed by the profiler. Times are inclusive: reader_advance
+# includes harmonize and cluster_build includes reference_fetch.
+STAGES = ["reader_advance", "harmonize", "cluster_build", "reference_fetch",
+          "graph_build", "resolve_samples", "write"]
+# Counters recorded for each resolved locus
+LOCUS_COUNTERS = ["records", "alleles", "components", "samples_resolved", "footprint"]
+# Number of loci with the largest footprint listed in the profile
+NUM_LARGEST_LOCI = 20
+# Version of the profile format
+PROFILE_VERSION = 2
+
+# Profiler of the current process, None when profiling is disabled
+PROFILER = None
+# Returned by Stage when profiling is disabled
+NULL_STAGE = contextlib.nullcontext()
+
+class stageTimer:
+    """
+    Context manager adding its elapsed time and the
+    memory use at its end to a stage of a profiler
+
+    Parameters
+    ----------
+    profiler : Profiler
+       Profiler to add the time to
+    name : str
+       Name of the stage
+    """
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.AddTime(self.name, time.perf_counter() - self.start, rss=memory.GetCurrentRSS())
+        return False
+
+class Profiler:
+    """
+    Cumulative wall time, number of calls and largest memory
+    use of each stage, and counters of each resolved locus
+
+    Attributes
+    ----------
+    stages : dict of str: [float, int, int]
+       Seconds, calls and largest resident set size (bytes)
+       at the end of a call of each stage
+    loci : dict of str: list
+       Columns of the locus table: chrom, pos, seconds
+       spent resolving and LOCUS_COUNTERS
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {name: [0.0, 0, 0] for name in STAGES}
+        self.loci = {name: [] for name in ["chrom", "pos", "seconds"] + LOCUS_COUNTERS}
+        self.peak_rss = 0
+
+    def Stage(self, name):
+        r"""
+        Time a stage
+
+        Parameters
+        ----------
+        name : str
+           Name of the stage
+
+        Returns
+        -------
+        timer : stageTimer
+           Context manager timing its block
+        """
+        return stageTimer(self, name)
+
+    def AddTime(self, name, seconds, calls=1, rss=0):
+        r"""
+        Add time spent in a stage
+
+        Parameters
+        ----------
+        name : str
+           Name of the stage
+        seconds : float
+           Time spent
+        calls : int, optional
+           Number of calls
+        rss : int, optional
+           Resident set size (bytes) at the end of the calls
+        """
+        stage = self.stages.setdefault(name, [0.0, 0, 0])
+        stage[0] += seconds
+        stage[1] += calls
+        stage[2] = max(stage[2], rss)
+        self.peak_rss = max(self.peak_rss, rss)
+
+    def AddLocus(self, chrom, pos, seconds, counters):
+        r"""
+        Record the counters of a resolved locus
+
+        Parameters
+        ----------
+        chrom : str
+           Chromosome of the locus
+        pos : int
+           Position of the locus
+        seconds : float
+           Time spent resolving the locus
+        counters : dict of str: int
+           Value of each of LOCUS_COUNTERS
+        """
+        self.loci["chrom"].append(chrom)
+        self.loci["pos"].append(pos)
+        self.loci["seconds"].append(seconds)
+        for name in LOCUS_COUNTERS:
+            self.loci[name].append(counters[name])
+
+    def Merge(self, data):
+        r"""
+        Add the stages and loci of another profiler,
+        e.g. of a worker process. Memory use is the
+        largest of the two processes.
+
+        Parameters
+        ----------
+        data : dict
+           Data returned by GetData of the other profiler
+        """
+        for name, stage in data["stages"].items():
+            self.AddTime(name, stage["seconds"], stage["calls"], stage["max_rss"])
+        for name, values in data["loci"].items():
+            self.loci[name].extend(values)
+        self.peak_rss = max(self.peak_rss, data["peak_rss"])
+
+    def GetData(self):
+        r"""
+        Get the profile
+
+        Returns
+        -------
+        data : dict
+           Wall time since the profiler was created, current and
+           peak resident set size (bytes), stages, summary (total,
+           mean, max) of each locus counter, the NUM_LARGEST_LOCI
+           loci with the largest footprint and the locus table
+        """
+        num_loci = len(self.loci["chrom"])
+        counters = {}
+        for name in ["seconds"] + LOCUS_COUNTERS:
+            values = self.loci[name]
+            counters[name] = {"total": sum(values),
+                              "mean": sum(values) / num_loci if num_loci > 0 else 0,
+                              "max": max(values) if num_loci > 0 else 0}
+        largest = sorted(range(num_loci), key=lambda i: self.loci["footprint"][i],
+                         reverse=True)[0:NUM_LARGEST_LOCI]
+        return {"format": "ensembletr-profile",
+                "version": PROFILE_VERSION,
+                "wall_seconds": time.perf_counter() - self.start,
+                "rss": memory.GetCurrentRSS(),
+                "peak_rss": max(self.peak_rss, memory.GetPeakRSS()),
+                "stages": {name: {"seconds": stage[0], "calls": stage[1], "max_rss": stage[2]} \
+                           for name, stage in self.stages.items()},
+                "num_loci": num_loci,
+                "counters": counters,
+                "largest_loci": [{name: self.loci[name][i] for name in self.loci} for i in largest],
+                "loci": self.loci}
+
+    def Write(self, path):
+        r"""
+        Write the profile as JSON
+
+        Parameters
+        ----------
+        path : str
+           Output path
+        """
+        with open(path, "w") as f:
+            json.dump(self.GetData(), f)
+
+def Enable():
+    r"""
+    Start profiling the current process
+
+    Returns
+    -------
+    profiler : Profiler
+       The new profiler
+    """
+    global PROFILER
+    PROFILER = Profiler()
+    return PROFILER
+
+def Stage(name):
+    r"""
+    Time a stage if profiling is enabled
+
+    Parameters
+    ----------
+    name : str
+       Name of the stage
+
+    Returns
+    -------
+    timer : context manager
+       Times its block, does nothing if profiling is disabled
+    """
+    if PROFILER is None:
+        return NULL_STAGE
+    return PROFILER.Stage(name)
+
+def Timed(name):
+    r"""
+    Decorator timing each call of a function as a stage
+    if profiling is enabled
+
+    Parameters
+    ----------
+    name : str
+       Name of the stage
+
+    Returns
+    -------
+    decorator : function
+       Decorator adding the timing to a function
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            if PROFILER is None:
+                return func(*args, **kwargs)
+            with PROFILER.Stage(name):
+                return func(*args, **kwargs)
+        return timed
+    return decorator
@@ -5,15 +5,23 @@ Classes to keep track of mergeable records
 import trtools.utils.tr_harmonizer as trh
 from trtools.utils.utils import GetCanonicalMotif
 from collections import defaultdict
+import copy
 from enum import Enum
-import networkx as nx
 import numpy as np
+import logging
 import math
 import sys
+import time
 
+from . import memory as memory
+from . import profiling as profiling
 from . import utils as utils
 
+log = logging.getLogger(__name__)
+
 CC_PREFIX = 'cc'
+MAX_SIGNATURE_CACHE = 10000 # Max distinct genotype signatures cached per locus
+GB_MISSING = np.iinfo(np.int32).min # Missing bp difference in GetNumericColumns
 
 convert_type_to_idx = {trh.VcfTypes.advntr: 0,
                        trh.VcfTypes.eh: 1,
@@ -31,18 +39,66 @@ class RecordObj:
        VCF record for the object
     vcf_type: trh.TRRecordHarmonizer.vcftype
        Type of the VCF file
+    vcf_samples : list of str
+       Samples of the VCF file, in column order
+    sample_index : dict of str: int, optional
+       Column of each sample in the VCF file. Computed from
+       vcf_samples if not given. Readers share one per file.
+    hm_record : trh.TRRecord, optional
+       Harmonized record, if already computed
+    canonical_motif : str, optional
+       Canonical motif of the record, if already computed
+    sample_columns : np.ndarray, optional
+       Column of each output sample in the VCF file (see vcfio.Readers)
+    batches : list of (cyvcf2.VCF.vcfrecord, np.ndarray, int), optional
+       When the caller is split into VCF files with disjoint samples:
+       record (None if missing), map from its allele indices to those of
+       hm_record (see MergeBatchRecords) and number of samples of each
+       file. Genotypes and scores of the files are concatenated.
+
+    Attributes
+    ----------
+    genotypes : np.ndarray
+       Allele indices of each sample (num samples x 2, -1 for no call)
+    phased : np.ndarray
+       Whether the genotype of each sample is phased
     """
-    def __init__(self, rec, vcf_type, vcf_samples):
+    def __init__(self, rec, vcf_type, vcf_samples, sample_index=None,
+                 hm_record=None, canonical_motif=None, sample_columns=None,
+                 batches=None):
         self.cyvcf2_record = rec
         self.vcf_type = vcf_type
-        self.hm_record = trh.HarmonizeRecord(vcf_type, rec)
-        self.pos = self.hm_record.pos
-        if vcf_type.name == 'advntr' or vcf_type.name == 'eh':
-            self.pos += 1 # AdVNTR call is 0-based, should change it to 1-based
-        self.canonical_motif = GetCanonicalMotif(self.hm_record.motif)
+        if hm_record is None:
+            hm_record = trh.HarmonizeRecord(vcf_type, rec)
+        self.hm_record = hm_record
+        self.pos = GetHarmonizedPosition(hm_record, vcf_type)
+        if canonical_motif is None:
+            canonical_motif = GetCanonicalMotif(hm_record.motif)
+        self.canonical_motif = canonical_motif
         self.prepend_seq = ''
         self.append_seq = ''
         self.vcf_samples = vcf_samples
+        if sample_index is None:
+            sample_index = GetSampleIndex(vcf_samples)
+        self.sample_index = sample_index
+        self.sample_columns = sample_columns
+        self.batches = batches
+        if batches is None:
+            self.genotypes, self.phased = GetDiploidGenotypes(rec.genotype.array())
+        else:
+            genotypes = []
+            phased = []
+            for batch_rec, allele_map, num_samples in batches:
+                if batch_rec is None:
+                    genotypes.append(np.full((num_samples, 2), -1, dtype=np.int32))
+                    phased.append(np.zeros(num_samples, dtype=bool))
+                    continue
+                batch_genotypes, batch_phased = GetDiploidGenotypes(batch_rec.genotype.array())
+                genotypes.append(allele_map[batch_genotypes])
+                phased.append(batch_phased)
+            self.genotypes = np.concatenate(genotypes)
+            self.phased = np.concatenate(phased)
+        self.scores = None
 
     def GetCalledAlleles(self):
         r"""
@@ -54,12 +110,24 @@ class RecordObj:
         al_idx : set of int
             Set of called alleles (based on REF/ALT fields)
         """
-        al_idx = set()
-        for call in self.hm_record.vcfrecord.genotypes:
-            if call[0] != -1 and len(call) == 3:
-                al_idx.add(call[0])
-                al_idx.add(call[1])
-        return al_idx
+        called = self.genotypes[self.genotypes[:, 0] != -1]
+        return set(np.unique(called).tolist())
+
+    def GetSampleColumns(self, samples):
+        r"""
+        Get the columns of samples in the VCF file
+
+        Parameters
+        ----------
+        samples : list of str
+           Sample IDs
+
+        Returns
+        -------
+        columns : np.ndarray
+           Column of each sample
+        """
+        return np.array([self.sample_index[sample] for sample in samples], dtype=np.intp)
 
     def GetROSampleCall(self, sample):
         r"""
@@ -67,8 +135,8 @@ class RecordObj:
 
         Parameters
         ----------
-        samp_idx : int
-           Index of the sample
+        sample : str
+           Sample ID
 
         Returns
         -------
@@ -76,8 +144,8 @@ class RecordObj:
            Corresponds to the genotype alleles and phasing
            (based on cyvcf2 representation)
         """
-        samp_idx = self.vcf_samples.index(sample)
-        return self.cyvcf2_record.genotypes[samp_idx]
+        samp_idx = self.sample_index[sample]
+        return self.genotypes[samp_idx].tolist() + [bool(self.phased[samp_idx])]
 
     def GetSampleString(self, sample):
         r"""
@@ -95,7 +163,22 @@ class RecordObj:
             Caller is one of gangstr/hipstr/eh/advntr
             Alleles are given in copy number        
         """
-        samp_call = self.GetROSampleCall(sample)
+        return self.GetCallString(self.GetROSampleCall(sample))
+
+    def GetCallString(self, samp_call):
+        r"""
+        Get a user-readable string of a genotype (see GetSampleString)
+
+        Parameters
+        ----------
+        samp_call : list of int
+           Allele indices of the genotype
+
+        Returns
+        -------
+        callstr : str
+            Format is "caller=allele1,allele2"
+        """
         if samp_call is None or samp_call[0] == -1:
             sampdata = "."
         else:
@@ -109,38 +192,205 @@ class RecordObj:
         callstr = "%s=%s"%(self.vcf_type.name, sampdata)
         return callstr
 
-    def GetScore(self, sample):
+    def GetScores(self):
         r"""
-        Get the score of a sample's genotype
+        Get the scores of the genotypes of all samples
         For HipSTR/GangSTR, use "FORMAT/Q"
         For adVNTR: use "FORMAT/ML"
         For ExpansionHunter, use a custom score based on
             FORMAT/REPCN and FORMAT/REPCI
 
+        FORMAT fields are decoded once per record.
+
+        Returns
+        -------
+        scores : np.ndarray
+           Score of each sample in column order, nan if missing.
+           Indicates confidence in the call (0=low, 1=high)
+        """
+        if self.scores is not None:
+            return self.scores
+        if self.batches is None:
+            self.scores = GetRecordScores(self.cyvcf2_record, self.vcf_type)
+        else:
+            # Keep the precision of the FORMAT fields
+            dtype = np.float64 if self.vcf_type == trh.VcfTypes.eh else np.float32
+            scores = []
+            for batch_rec, allele_map, num_samples in self.batches:
+                if batch_rec is None:
+                    scores.append(np.full(num_samples, np.nan, dtype=dtype))
+                else:
+                    scores.append(GetRecordScores(batch_rec, self.vcf_type).astype(dtype))
+            self.scores = np.concatenate(scores)
+        return self.scores
+
+    def GetScore(self, sample):
+        r"""
+        Get the score of a sample's genotype
+        (see GetScores)
+
         Parameters
         ----------
-        samp_idx : int
-           Index of the sample
+        sample : str
+           Sample ID
 
         Returns
         -------
         score : float
            Indicates confidence in the call (0=low, 1=high)      
         """
-        samp_idx = self.vcf_samples.index(sample)
-        if self.vcf_type == trh.VcfTypes.advntr:
-            return min(self.cyvcf2_record.format('ML')[samp_idx][0], 1)
-        elif self.vcf_type in [trh.VcfTypes.hipstr, trh.VcfTypes.gangstr]:
-            return min(self.cyvcf2_record.format('Q')[samp_idx][0], 1)  # Sometimes GangSTR Q is slightly more than 1
-        elif self.vcf_type == trh.VcfTypes.eh:
-            REPCI = self.cyvcf2_record.format('REPCI')[samp_idx]
-            REPCN = self.cyvcf2_record.format('REPCN')[samp_idx]
-            if REPCI == "." or REPCN == ".":
-                return 0
-            length = len(self.cyvcf2_record.INFO['RU'])
-            return utils.GetEHScore(REPCI, REPCN, length)
-        else:
-            return 0 # shouldn't happen
+        return self.GetScores()[self.sample_index[sample]]
+
+def GetDiploidGenotypes(gt_array):
+    r"""
+    Get the diploid calls of a record
+
+    Calls of other ploidies (e.g. haploid calls on chrX, padded
+    with -2 by cyvcf2) are treated as no calls.
+
+    Parameters
+    ----------
+    gt_array : np.ndarray
+       Genotypes returned by cyvcf2 genotype.array(): allele
+       indices of each sample, the last column holds the phasing
+
+    Returns
+    -------
+    genotypes : np.ndarray
+       Allele indices of each sample (num samples x 2, -1 for no call)
+    phased : np.ndarray
+       Whether the genotype of each sample is phased
+    """
+    num_alleles = gt_array.shape[1] - 1
+    genotypes = np.full((gt_array.shape[0], 2), -1, dtype=np.int32)
+    if num_alleles >= 2:
+        diploid = gt_array[:, 1] != -2
+        if num_alleles > 2:
+            diploid &= np.all(gt_array[:, 2:num_alleles] == -2, axis=1)
+        genotypes[diploid] = gt_array[diploid, 0:2]
+    return genotypes, gt_array[:, -1].astype(bool)
+
+def GetRecordScores(rec, vcf_type):
+    r"""
+    Get the scores of the genotypes of all samples of a record
+    (see RecordObj.GetScores)
+
+    Parameters
+    ----------
+    rec : cyvcf2.VCF.vcfrecord
+       VCF record
+    vcf_type : trh.VcfTypes
+       Type of the VCF file
+
+    Returns
+    -------
+    scores : np.ndarray
+       Score of each sample in column order, nan if missing
+    """
+    if vcf_type == trh.VcfTypes.advntr:
+        return np.minimum(rec.format('ML')[:, 0], 1)
+    elif vcf_type in [trh.VcfTypes.hipstr, trh.VcfTypes.gangstr]:
+        return np.minimum(rec.format('Q')[:, 0], 1)  # Sometimes GangSTR Q is slightly more than 1
+    elif vcf_type == trh.VcfTypes.eh:
+        REPCI = rec.format('REPCI')
+        REPCN = rec.format('REPCN')
+        length = len(rec.INFO['RU'])
+        scores = np.zeros(len(REPCN), dtype=np.float64)
+        called = (REPCI != ".") & (REPCN != ".")
+        scores[called] = utils.GetEHScores(REPCI[called], REPCN[called], length)
+        return scores
+    else:
+        return np.zeros(len(rec.genotypes)) # shouldn't happen
+
+def MergeBatchRecords(hm_records):
+    r"""
+    Merge harmonized records of the same locus from
+    VCF files of one caller with disjoint samples
+
+    Parameters
+    ----------
+    hm_records : list of trh.TRRecord
+       Harmonized record of each file (None if missing)
+
+    Returns
+    -------
+    hm_record : trh.TRRecord
+       Copy of the first record, with the alternate alleles
+       of the other records added after its own
+    allele_maps : list of np.ndarray
+       For each file, union allele index of each of its allele
+       indices (None if missing). The last entry maps index -1.
+    """
+    merged = None
+    allele_keys = {}
+    alt_alleles = []
+    alt_allele_lengths = []
+    full_alt_alleles = []
+    allele_maps = []
+    for hm_record in hm_records:
+        if hm_record is None:
+            allele_maps.append(None)
+            continue
+        if merged is None:
+            merged = copy.copy(hm_record)
+        allele_map = [0]
+        for i in range(len(hm_record.alt_alleles)):
+            # Full alleles include flanks, use them when available
+            if hm_record.full_alleles is not None:
+                key = hm_record.full_alleles[1][i]
+            else:
+                key = hm_record.alt_alleles[i]
+            if key not in allele_keys:
+                allele_keys[key] = len(alt_alleles) + 1
+                alt_alleles.append(hm_record.alt_alleles[i])
+                alt_allele_lengths.append(hm_record.alt_allele_lengths[i])
+                if hm_record.full_alleles is not None:
+                    full_alt_alleles.append(hm_record.full_alleles[1][i])
+            allele_map.append(allele_keys[key])
+        allele_map.append(-1)
+        allele_maps.append(np.array(allele_map, dtype=np.int32))
+    merged.alt_alleles = alt_alleles
+    merged.alt_allele_lengths = alt_allele_lengths
+    if merged.full_alleles is not None:
+        merged.full_alleles = (merged.full_alleles[0], full_alt_alleles)
+    return merged, allele_maps
+
+def GetHarmonizedPosition(hm_record, vcf_type):
+    r"""
+    Get the 1-based position of a harmonized record
+
+    Parameters
+    ----------
+    hm_record : trh.TRRecord
+       Harmonized record
+    vcf_type : trh.VcfTypes
+       Type of the VCF file
+
+    Returns
+    -------
+    pos : int
+       1-based start position
+    """
+    pos = hm_record.pos
+    if vcf_type.name == 'advntr' or vcf_type.name == 'eh':
+        pos += 1 # AdVNTR call is 0-based, should change it to 1-based
+    return pos
+
+def GetSampleIndex(vcf_samples):
+    r"""
+    Map samples of a VCF file to their column
+
+    Parameters
+    ----------
+    vcf_samples : list of str
+       Samples of the VCF file, in column order
+
+    Returns
+    -------
+    sample_index : dict of str: int
+       Column of each sample
+    """
+    return {sample: i for i, sample in enumerate(vcf_samples)}
 
 class RecordCluster:
     r"""
@@ -150,13 +400,15 @@ class RecordCluster:
     ----------
     recobjs : list of RecordObj
        list of record objects to be merged
-    ref_genome : pyfaidx.Fasta
+    ref_genome : vcfio.ReferenceCache
        reference genome
     canon_motif : str
        canonical repeat motif
     samples : list of str
        List of samples to analyze
 
+    Bounds and padding are computed once for all records
+    given at construction. AppendRecordObject recomputes them.
     """
     def __init__(self, recobjs, ref_genome, canon_motif, samples):
         self.canonical_motif = canon_motif
@@ -168,19 +420,25 @@ class RecordCluster:
         self.last_pos = -1
         self.chrom = recobjs[0].cyvcf2_record.CHROM
         self.update()
+        # HipSTR allele frequencies are only taken from the first record
+        # object, the one a cluster used to be created with
         self.hipstr_allele_frequency = {}
-        for ro in self.record_objs:
-            if ro.vcf_type.name == "hipstr":
-                self.hipstr_allele_frequency = self.GetHipSTR_freqs(ro)
+        if self.record_objs[0].vcf_type.name == "hipstr":
+            self.hipstr_allele_frequency = self.GetHipSTR_freqs(self.record_objs[0])
 
     def GetHipSTR_freqs(self, ro):
         freqs = defaultdict(int)
-        for call in ro.hm_record.vcfrecord.gt_bases:
-            call = call.split("|")
-            if len(call) < 2:
-                continue
-            freqs[call[0]] += 1
-            freqs[call[1]] += 1
+        if ro.batches is None:
+            records = [ro.cyvcf2_record]
+        else:
+            records = [batch[0] for batch in ro.batches if batch[0] is not None]
+        for rec in records:
+            for call in rec.gt_bases:
+                call = call.split("|")
+                if len(call) < 2:
+                    continue
+                freqs[call[0]] += 1
+                freqs[call[1]] += 1
         return freqs
 
     def AppendRecordObject(self, ro):
@@ -207,8 +465,6 @@ class RecordCluster:
         self.first_pos = min([rec.pos for rec in self.record_objs])
         self.last_end = max([rec.cyvcf2_record.end for rec in self.record_objs])
 
-        print(
-            f"Analysing record cluster ranged in {self.record_objs[0].cyvcf2_record.CHROM}:{self.first_pos}-{self.last_end}.")
         ref_record = ""
         for rec in self.record_objs:
             if rec.pos == self.first_pos:
@@ -219,11 +475,11 @@ class RecordCluster:
             if rec.pos > self.first_pos:
                 # Found a record that starts after
                 # Should prepend the record
-                rec.prepend_seq = self.fasta[chrom][self.first_pos - 1: rec.pos - 1].seq.upper()
+                rec.prepend_seq = self.fasta.GetSequence(chrom, self.first_pos - 1, rec.pos - 1)
             if rec.cyvcf2_record.end < self.last_end:
                 # Found a record that ends before last end
                 # Should append the record
-                rec.append_seq = self.fasta[chrom][rec.cyvcf2_record.end-1 : self.last_end-1].seq.upper()
+                rec.append_seq = self.fasta.GetSequence(chrom, rec.cyvcf2_record.end-1, self.last_end-1)
 
 
     def GetRawCalls(self):
@@ -235,11 +491,97 @@ class RecordCluster:
         out_dict : (dict of str: str)
            Key=sample, Value=comma-separated list of genotypes
         """
-        out_dict = {}
-        for sample in self.samples:
-            samp_call_list = [ro.GetSampleString(sample) for ro in self.record_objs]
-            out_dict[sample] = '|'.join(samp_call_list)
-        return out_dict        
+        return dict(zip(self.samples, self.GetRawCallColumn()))
+
+    def GetRawCallColumn(self):
+        r"""
+        Get the INPUTS strings of all samples
+
+        Each distinct combination of calls is formatted once.
+
+        Returns
+        -------
+        inputs : list of str
+           Comma-separated list of genotypes of each sample
+        """
+        calls, scores = self.GetCallArrays(with_scores=False)
+        signatures, inverse = np.unique(np.concatenate(calls, axis=1), axis=0, return_inverse=True)
+        # Genotypes of a caller repeat across signatures
+        call_strings = [{} for ro in self.record_objs]
+        strings = []
+        for signature in signatures.tolist():
+            samp_strings = []
+            for i, ro in enumerate(self.record_objs):
+                call = (signature[2*i], signature[2*i+1])
+                call_string = call_strings[i].get(call)
+                if call_string is None:
+                    call_string = ro.GetCallString(call)
+                    call_strings[i][call] = call_string
+                samp_strings.append(call_string)
+            strings.append('|'.join(samp_strings))
+        return [strings[i] for i in inverse.reshape(-1).tolist()]
+
+    def GetCompactCallColumn(self):
+        r"""
+        Get the compact INPUTS strings of all samples
+
+        Calls of each record are given as allele indices of the
+        input record, with records in the order of the methods
+        (advntr, eh, hipstr, gangstr), e.g. "1,2|0,0|.".
+        A missing call or allele is ".".
+
+        Returns
+        -------
+        inputs : list of str
+           Allele indices of the calls of each sample
+        """
+        calls, scores = self.GetCallArrays(with_scores=False)
+        order = sorted(range(len(self.record_objs)),
+                       key=lambda i: convert_type_to_idx[self.record_objs[i].vcf_type])
+        signatures, inverse = np.unique(np.concatenate([calls[i] for i in order], axis=1),
+                                        axis=0, return_inverse=True)
+        strings = []
+        for signature in signatures.tolist():
+            samp_strings = []
+            for i in range(len(order)):
+                call = signature[2*i:2*i+2]
+                if call[0] == -1:
+                    samp_strings.append(".")
+                else:
+                    samp_strings.append(",".join(["." if idx == -1 else str(idx) for idx in call]))
+            strings.append('|'.join(samp_strings))
+        return [strings[i] for i in inverse.reshape(-1).tolist()]
+
+    def GetCallArrays(self, with_scores=True):
+        r"""
+        Get calls and quality scores of all samples
+        for each record object
+
+        Parameters
+        ----------
+        with_scores : bool, optional
+           If False, scores are not decoded and an empty list is returned
+
+        Returns
+        -------
+        calls : list of np.ndarray
+           One array (num samples x 2) per record object with
+           the allele indices of each sample (-1 for no call)
+        scores : list of np.ndarray
+           One array per record object with the
+           quality score of each sample (nan if missing)
+        """
+        calls = []
+        scores = []
+        for rec in self.record_objs:
+            if rec.sample_columns is not None:
+                columns = rec.sample_columns
+            else:
+                columns = rec.GetSampleColumns(self.samples)
+            calls.append(rec.genotypes[columns])
+            if with_scores:
+                scores.append(rec.GetScores()[columns])
+        return calls, scores
 
     def GetSampleCall(self, sample):
         r"""
@@ -354,24 +696,31 @@ class PreAllele:
 
 class ConnectedComponent:
     """
-    Subgraph corresponding to nodes mapped to a single allele
+    Group of nodes mapped to a single allele
+
+    Parameters
+    ----------
+    ccid : str
+       Identifier of the component
+    nodes : list of Allele
+       Nodes of the component, in the order they were added to the graph
     """
-    def __init__(self, ccid, subgraph):
+    def __init__(self, ccid, nodes):
         self.cc_id = ccid
-        self.subgraph = subgraph
+        self.nodes = nodes
         self.uniq_callers = self.GetUniqueCallers()
         self.caller_to_nodes = self.GetCallerToNodes()
         self.resolved_prealleles = self.GetResolvedPreAlleles()
 
     def GetUniqueCallers(self):
         uniq_callers = set()
-        for node in self.subgraph.nodes():
+        for node in self.nodes:
             uniq_callers.add(node.GetVCFType())
         return uniq_callers
 
     def GetCallerToNodes(self):
         caller_to_nodes = {}
-        for node in self.subgraph.nodes():
+        for node in self.nodes:
             if node.GetVCFType() not in caller_to_nodes:
                 caller_to_nodes[node.GetVCFType()] = [node]
             else:
@@ -381,11 +730,11 @@ class ConnectedComponent:
     def GetResolvedPreAlleles(self):
         resolved_prealleles = {}
         # If number of nodes == number of callers: 1-1-1
-        if len(self.uniq_callers) == len(self.subgraph.nodes()):
+        if len(self.uniq_callers) == len(self.nodes):
             if trh.VcfTypes.hipstr in self.uniq_callers:
                 tmp_node = self.caller_to_nodes[trh.VcfTypes.hipstr][0]
             else:
-                tmp_node = list(self.subgraph.nodes())[0]
+                tmp_node = self.nodes[0]
             pa = PreAllele(tmp_node, self.uniq_callers)
             resolved_prealleles['any'] = pa
 
@@ -399,12 +748,12 @@ class ConnectedComponent:
             # only one hipstr node
             if len(self.caller_to_nodes[trh.VcfTypes.hipstr]) == 1:
                 for caller in self.uniq_callers:
-                    print(caller, len(self.caller_to_nodes[caller]))
+                    log.error("%s: %d nodes", caller, len(self.caller_to_nodes[caller]))
                 sys.exit("This should not happen")
                 sys.exit(0)
                 tmp_node = self.caller_to_nodes[trh.VcfTypes.hipstr][0]
                 pa = PreAllele(tmp_node, [trh.VcfTypes.hipstr])
-                for node in self.subgraph:
+                for node in self.nodes:
                     if node != tmp_node and node.allele_sequence == tmp_node.allele_sequence:
                         pa.add_support([node.GetVCFType()])
                 resolved_preallele['any'] = pa
@@ -413,12 +762,12 @@ class ConnectedComponent:
             # different hipstr nodes for different allele idx
             else:
                 tmp_node = None
-                for node1 in self.subgraph:
+                for node1 in self.nodes:
                     if node1.GetVCFType() == trh.VcfTypes.hipstr:
                         if node1.al_idx not in resolved_prealleles:
                             tmp_node = node1
                             pa = PreAllele(tmp_node, [trh.VcfTypes.hipstr])
-                            for node2 in self.subgraph:
+                            for node2 in self.nodes:
                                 if node2 != tmp_node and node2.allele_sequence == tmp_node.allele_sequence:
                                     pa.add_support([node2.GetVCFType()])
                             resolved_prealleles[node1.al_idx] = pa
@@ -429,46 +778,93 @@ class ClusterGraph:
     """
     Keeps track of graph of alleles called by each method
 
+    Alleles (nodes) of equal size called by different methods are
+    connected. Connected components are therefore built directly by
+    grouping alleles on their size, in linear time.
+
     Parameters
     ----------
     record_cluster : RecordCluster
        record cluster to build a graph out of 
+
+    Attributes
+    ----------
+    alleles : list of Allele
+       All nodes of the graph
+    connected_comps : list of ConnectedComponent
+       Connected components, sorted by decreasing number of nodes.
+       Ties keep the order of the first node of each component.
+    allele_cc : dict (trh.VcfTypes: np.ndarray)
+       Per caller, index of the connected component of each allele
+       index (-1 if not called). The last entry is used for index -1.
+    allele_sizes : dict (trh.VcfTypes: np.ndarray)
+       Per caller, allele_size of each allele index
     """
 
     def __init__(self, record_cluster):
         self.rclust = record_cluster
-        self.graph = self.BuildGraph()
+        self.alleles = self.GetAlleleList()
 
         # Get list of connected components
         # Sorted by the number of nodes in each
-        sorted_ccs = sorted(nx.algorithms.components.connected_components(self.graph), \
-                    key=len, reverse=True)
-        self.connected_comps = [ConnectedComponent(CC_PREFIX+str(i), \
-                                        self.graph.subgraph(sorted_ccs[i]).copy()) \
+        sorted_ccs = sorted(self.GetComponents(), key=len, reverse=True)
+        self.connected_comps = [ConnectedComponent(CC_PREFIX+str(i), sorted_ccs[i]) \
                                     for i in range(len(sorted_ccs))]
+        self.allele_cc, self.allele_sizes = self.GetLookupTables()
 
-    def BuildGraph(self):
+    def GetComponents(self):
         r"""
-        Build the allele graph
-        """
-        allele_list = self.GetAlleleList()
-        graph = nx.Graph()
+        Group nodes into connected components
 
-        # Add nodes - one for each allele
-        for al in allele_list:
-            graph.add_node(al)
+        Nodes of the same size are all connected if they come
+        from at least two methods. Otherwise (sizes seen by
+        a single method) each node is its own component.
 
-        # Add edges between nodes of equivalent size
-        # from different methods
-        for nd1 in graph.nodes():
-            for nd2 in graph.nodes():
-                if nd1 == nd2:
-                    continue
-                if nd1.allele_size == nd2.allele_size \
-                        and not graph.has_edge(nd1, nd2) \
-                        and nd1.GetVCFType() != nd2.GetVCFType():
-                    graph.add_edge(nd1, nd2)
-        return graph
+        Returns
+        -------
+        components : list of list of Allele
+           Components in the order of their first node.
+           Nodes keep the order of alleles.
+        """
+        buckets = {}
+        bucket_callers = {}
+        for al in self.alleles:
+            buckets.setdefault(al.allele_size, []).append(al)
+            bucket_callers.setdefault(al.allele_size, set()).add(al.GetVCFType())
+        components = []
+        seen_sizes = set()
+        for al in self.alleles:
+            if len(bucket_callers[al.allele_size]) == 1:
+                components.append([al])
+            elif al.allele_size not in seen_sizes:
+                seen_sizes.add(al.allele_size)
+                components.append(buckets[al.allele_size])
+        return components
+
+    def GetLookupTables(self):
+        r"""
+        Map allele indices of each caller to their
+        connected component and allele size
+
+        Returns
+        -------
+        allele_cc : dict (trh.VcfTypes: np.ndarray)
+           Per caller, index of the connected component of each allele index
+        allele_sizes : dict (trh.VcfTypes: np.ndarray)
+           Per caller, allele_size of each allele index
+        """
+        allele_cc = {}
+        allele_sizes = {}
+        for ro in self.rclust.record_objs:
+            # ref + alts + one entry for index -1 (half calls)
+            num_alleles = len(ro.hm_record.alt_alleles) + 2
+            allele_cc[ro.vcf_type] = np.full(num_alleles, -1, dtype=np.int32)
+            allele_sizes[ro.vcf_type] = np.zeros(num_alleles, dtype=np.int64)
+        for ccid, connected_comp in enumerate(self.connected_comps):
+            for node in connected_comp.nodes:
+                allele_cc[node.GetVCFType()][node.al_idx] = ccid
+                allele_sizes[node.GetVCFType()][node.al_idx] = node.allele_size
+        return allele_cc, allele_sizes
 
     def GetAlleleList(self):
         """
@@ -484,7 +880,7 @@ class ClusterGraph:
         return alist
 
     def GetNodeObject(self, vcf_type, al_idx):
-        for allele in self.graph.nodes:
+        for allele in self.alleles:
             if allele.GetVCFType() == vcf_type and allele.al_idx == al_idx:
                 return allele
         return None
@@ -493,148 +889,238 @@ class ClusterGraph:
         if node is None:
             return None
         for i in range(len(self.connected_comps)):
-            if node in self.connected_comps[i].subgraph:
+            if node in self.connected_comps[i].nodes:
                 return i
         return None
 
     def GetSubgraphSize(self, ccid):
         if ccid < 0 or ccid >= len(self.connected_comps):
             return None
-        return len(self.connected_comps[ccid].subgraph.nodes())
+        return len(self.connected_comps[ccid].nodes)
         
 
 
-class RecordResolver:
+class ResolutionTable:
     """
-    Main class to resolve info for a record cluster
+    Per-locus lookup tables used to resolve the calls of individual samples
+
+    Only holds plain python objects so it can be sent to worker
+    processes resolving blocks of samples.
 
     Parameters
     ----------
-    rc : RecordCluster
+    rc_graph : ClusterGraph
+       allele graph of the record cluster
+    record_cluster : RecordCluster
        the record cluster being resolved
 
     Attributes
     ----------
-    rc_graph : ClusterGraph
-       keeps track of alleles across records being merged
-    resolved : bool
-       Set to True once the record cluster has been resolved
-    resolution_score : dict (str: float)
-       Key=sample, Value=resolution score
-       (i.e. all callers agreed)
+    callers : list of trh.VcfTypes
+       VCF type of each record object in the cluster
+    allele_cc : list of np.ndarray
+       Per caller, connected component index of each allele index
+       (see ClusterGraph.allele_cc)
+    allele_sizes : list of np.ndarray
+       Per caller, allele size of each allele index
+    cc_callers : list of set of trh.VcfTypes
+       Callers of each connected component
+    cc_prealleles : list of dict
+       Resolved prealleles of each connected component.
+       Values are indices in prealleles.
+    prealleles : list of PreAllele
+       All prealleles of the locus
+    hipstr_allele_frequency : dict (str: int)
+       Key=HipSTR allele sequence, Value=number of times it was called
+    signature_cache : dict
+       Key=calls of all callers, Value=score independent part of the
+       resolution shared by all samples with these calls.
+       Holds at most MAX_SIGNATURE_CACHE signatures.
     """
-    def __init__(self, rc):
-        self.record_cluster = rc
-        self.rc_graph = ClusterGraph(rc)
-        self.resolved = False
+    def __init__(self, rc_graph, record_cluster):
+        self.callers = []
+        for ro in record_cluster.record_objs:
+            if ro.vcf_type in self.callers:
+                raise ValueError("Multiple records with same VCF type: " + str(ro.vcf_type))
+            self.callers.append(ro.vcf_type)
+        self.allele_cc = [rc_graph.allele_cc[caller] for caller in self.callers]
+        self.allele_sizes = [rc_graph.allele_sizes[caller] for caller in self.callers]
+        self.cc_callers = []
+        self.cc_prealleles = []
+        self.prealleles = []
+        for connected_comp in rc_graph.connected_comps:
+            self.cc_callers.append(connected_comp.uniq_callers)
+            pa_indices = {}
+            for key, pa in connected_comp.resolved_prealleles.items():
+                pa_indices[key] = len(self.prealleles)
+                self.prealleles.append(pa)
+            self.cc_prealleles.append(pa_indices)
+        self.hipstr_allele_frequency = record_cluster.hipstr_allele_frequency
+        self.signature_cache = {}
+
+    def ResolveSamples(self, samples, calls, scores, start=0):
+        r"""
+        Resolve a block of samples
 
-        # Get set after resolving
-        self.resolved_prealleles = {}
-        self.resolution_score = {}
-        self.allele_support = {}
-        self.resolution_method = {}
-        self.empty_call = {}
-        self.ref = None
-        self.alts = []
-        self.sample_to_info = {} # sample -> GT, NCOPY
-        self.nocall = False
+        Samples are grouped by the calls of all callers,
+        so the lookups are done once per distinct genotype.
 
-    def Resolve(self):
-        resolved_prealleles = {}
-        resolution_score = {}
-        resolution_methods = {}
-        allele_supports = {}
-        for sample in self.record_cluster.samples:
-            samp_call = self.record_cluster.GetSampleCall(sample)
-            samp_qual_scores = self.record_cluster.GetQualScore(sample)
-            resolved_connected_comp_ids, resolved_methods, score, allele_support = \
-                self.GetConnectedCompForSingleCall(samp_call, samp_qual_scores)
-            resolution_score[sample] = score
-            resolution_methods[sample] = resolved_methods
-            resolved_prealleles[sample] = self.ResolveSequenceForSingleCall(resolved_connected_comp_ids, samp_call,
-                                                                            sample, self.record_cluster.hipstr_allele_frequency)
-            allele_supports[sample] = allele_support
-        self.resolved_prealleles = resolved_prealleles
-        self.resolution_score = resolution_score
-        self.allele_support = allele_supports
-        self.resolution_method = resolution_methods
-        self.update()
-        self.resolved = True
-        return self.resolved
-   
-    def update(self):
-        # First update alleles list
-        for sample in self.resolved_prealleles:
-            for pa in self.resolved_prealleles[sample]:
-                if self.ref is None:
-                    self.ref = pa.reference_sequence
-                if pa.allele_sequence != self.ref and pa.allele_sequence != pa.reference_sequence:
-                    if pa.allele_sequence not in self.alts:
-                        if pa.allele_sequence != "":
-                            self.alts.append(pa.allele_sequence)
+        Parameters
+        ----------
+        samples : list of str
+           Samples of the block
+        calls : list of np.ndarray
+           Per caller, allele indices of each sample (num samples x 2)
+        scores : list of np.ndarray
+           Per caller, quality score of each sample
+        start : int
+           Index of the first sample of the block in calls and scores
 
-        if self.ref is None:
-            self.nocall = True 
-        # Now update other info. need all alts for this
-        for sample in self.resolved_prealleles:
-            self.empty_call[sample] = False
-            self.sample_to_info[sample] = {}
-            GT_list = []
-            GB_list = []
-            NCOPY_list = []
-            Expanded = []
-            for pa in self.resolved_prealleles[sample]:
-                if pa.exp_flag:
-                    Expanded.append("1")
-                else:
-                    Expanded.append("0")
-                if pa.al_idx != 0 and pa.allele_sequence != self.ref:
-                    if pa.allele_sequence == "":
-                        self.empty_call[sample] = True
-                        break
-                    GT_list.append(str(self.alts.index(pa.allele_sequence) + 1))
-                    GB_list.append(str(len(pa.allele_sequence) - len(self.ref)))
-                    NCOPY_list.append(str(pa.allele_ncopy))
-                else:
-                    GT_list.append('0')
-                    GB_list.append('0')
-                    NCOPY_list.append(str(pa.reference_ncopy))
-            if len(GT_list) == 0 or self.empty_call[sample]:
-                GT_list = ['.']
-                NCOPY_list = ['.']
-                GB_list = ['.']
-                Expanded = ['.']
-            self.sample_to_info[sample]["GT"] = '/'.join(GT_list)
-            self.sample_to_info[sample]["GB"] = '/'.join(GB_list)
-            self.sample_to_info[sample]["NCOPY"] = ','.join(NCOPY_list)
-            self.sample_to_info[sample]["EXP"] = '/'.join(Expanded)
+        Returns
+        -------
+        results : list of tuple
+           One (ccids, methods, score, allele_support, prealleles) per sample,
+           see ResolveSample
+        """
+        end = start + len(samples)
+        block_calls = np.concatenate([caller_calls[start:end] for caller_calls in calls], axis=1)
+        signatures, inverse = np.unique(block_calls, axis=0, return_inverse=True)
+        resolutions = self.GetSignatureResolutions(signatures)
+        inverse = inverse.reshape(-1).tolist()
+        # float64 scores (EH) are python floats in the single sample API.
+        # Convert them back so that mixing them with float32 scores
+        # gives exactly the same results.
+        block_scores = []
+        for caller_scores in scores:
+            if caller_scores.dtype == np.float64:
+                block_scores.append(caller_scores[start:end].tolist())
+            else:
+                block_scores.append(caller_scores[start:end])
+        results = []
+        for i in range(len(samples)):
+            samp_scores = [caller_scores[i] for caller_scores in block_scores]
+            results.append(self.ResolveSampleScores(samples[i], resolutions[inverse[i]], samp_scores))
+        return results
+
+    def ResolveSample(self, sample, samp_calls, samp_scores):
+        r"""
+        Resolve the call of a single sample
 
-    def GetSampleScore(self, sample):
-        if self.resolution_score[sample] == -1 or self.empty_call[sample]:
-            return "."
-        return str(self.resolution_score[sample])
+        Parameters
+        ----------
+        sample : str
+           Sample ID
+        samp_calls : list of [int, int]
+           Allele indices called by each caller (-1 for no call)
+        samp_scores : list of float
+           Quality score of each caller (nan if missing)
 
-    def GetSampleGTS(self, sample):
-        if len(self.resolution_method[sample]) == 0 or self.empty_call[sample]:
-            return "."
-        return '|'.join([str(method) for method in self.resolution_method[sample]])
+        Returns
+        -------
+        ccids : list of int
+           indices of CCs of resolved call
+        methods : list of int
+           Supporting methods for the resolved call
+        score : float
+           Score of caller agreement
+        allele_support : dict
+           Key=bp diff of allele and the ref genome, Value=number of times we saw this allele.
+        prealleles : list of int
+           Indices of the resolved prealleles
 
-    def GetSampleALS(self, sample):
-        if not self.allele_support[sample] or self.empty_call[sample]:
-            return "."
-        return ",".join([str(key) + "|" + str(val) for key,val in self.allele_support[sample].items()])
+        Samples with the same calls share the returned lists and dicts,
+        which must not be modified.
+        """
+        signatures = np.array(samp_calls, dtype=np.int32).reshape(1, -1)
+        resolution = self.GetSignatureResolutions(signatures)[0]
+        return self.ResolveSampleScores(sample, resolution, samp_scores)
 
-    def GetSampleGT(self, sample):
-        return self.sample_to_info[sample]["GT"]
+    def ResolveSampleScores(self, sample, resolution, samp_scores):
+        r"""
+        Finish resolving a sample using the scores of its calls
 
-    def GetSampleGB(self, sample):
-        return self.sample_to_info[sample]["GB"]
+        Parameters
+        ----------
+        sample : str
+           Sample ID
+        resolution : tuple
+           Score independent part of the resolution,
+           see GetSignatureResolutions
+        samp_scores : list of float
+           Quality score of each caller (nan if missing)
 
-    def GetSampleNCOPY(self, sample):
-        return self.sample_to_info[sample]["NCOPY"]
+        Returns
+        -------
+        result : tuple
+           (ccids, methods, score, allele_support, prealleles),
+           see ResolveSample
+        """
+        samp_call, method_cc, allele_size_support, pair_resolutions = resolution
+        if len(method_cc) == 0:  # no call across all methods
+            return [], [], -1, {}, []
 
-    def GetExpandedFlag(self, sample):
-        return self.sample_to_info[sample]['EXP']
+        # Only the choice of CCs depends on scores
+        samp_qual_scores = {}
+        for caller, score in zip(self.callers, samp_scores):
+            if ~np.isnan(score):
+                samp_qual_scores[caller] = score
+        ret_cc_ids, score = self.ResolveScore(samp_qual_scores, method_cc)
+        assert(self.TestScore(score))
+        if ret_cc_ids not in pair_resolutions:
+            sup_method = self.GetSupportingMethods(method_cc[ret_cc_ids])
+            prealleles = self.ResolveSequenceForSingleCall(list(ret_cc_ids), samp_call, sample)
+            pair_resolutions[ret_cc_ids] = (sup_method, prealleles)
+        sup_method, prealleles = pair_resolutions[ret_cc_ids]
+        return list(ret_cc_ids), sup_method, round(score, 2), allele_size_support, prealleles
+
+    def GetSignatureResolutions(self, signatures):
+        r"""
+        Get the part of the resolution that only depends
+        on the calls of a sample, for several genotype signatures
+
+        Connected components and allele sizes of all
+        signatures are looked up at once in allele_cc and allele_sizes.
+
+        Parameters
+        ----------
+        signatures : np.ndarray
+           One row per signature with the two allele indices
+           of each caller (-1 for no call)
+
+        Returns
+        -------
+        resolutions : list of tuple
+           For each signature:
+           samp_call : dict(vcftype:allele) calls by VCF type,
+           method_cc : dict (tuple: list) Key=pair of ccids, Value=list of supporting methods,
+           allele_size_support : dict Key=bp diff of allele and the ref genome,
+           Value=number of times we saw this allele,
+           pair_resolutions : dict Key=chosen pair of ccids, Value=(supporting methods, prealleles),
+           filled as pairs get chosen.
+        """
+        keys = [tuple(row) for row in signatures.tolist()]
+        resolutions = [self.signature_cache.get(key) for key in keys]
+        missing = [i for i in range(len(keys)) if resolutions[i] is None]
+        if len(missing) == 0:
+            return resolutions
+        rows = signatures[missing]
+        ccs = []
+        sizes = []
+        for i in range(len(self.callers)):
+            caller_calls = rows[:, 2*i:2*i+2]
+            ccs.append(self.allele_cc[i][caller_calls].tolist())
+            sizes.append(self.allele_sizes[i][caller_calls].tolist())
+        for j, i in enumerate(missing):
+            samp_call = {}
+            for k, caller in enumerate(self.callers):
+                samp_call[caller] = list(keys[i][2*k:2*k+2])
+            method_cc, allele_size_support = self.GetMethodCC(samp_call,
+                                                              [caller_ccs[j] for caller_ccs in ccs],
+                                                              [caller_sizes[j] for caller_sizes in sizes])
+            resolutions[i] = (samp_call, method_cc, allele_size_support, {})
+            if len(self.signature_cache) < MAX_SIGNATURE_CACHE:
+                self.signature_cache[keys[i]] = resolutions[i]
+        return resolutions
 
     def TestScore(self, score):
         if np.isnan(score):
@@ -662,35 +1148,75 @@ class RecordResolver:
         allele_size_support: dict
             Key=bp diff of allele and the ref genome, Value=number of times we saw this allele.
         """
+        samp_ccs = []
+        samp_sizes = []
+        for i, caller in enumerate(self.callers):
+            call = samp_call[caller][0:2]
+            samp_ccs.append(self.allele_cc[i][call].tolist())
+            samp_sizes.append(self.allele_sizes[i][call].tolist())
+        method_cc, allele_size_support = self.GetMethodCC(samp_call, samp_ccs, samp_sizes)
+        if len(method_cc) == 0:  # no call across all methods
+            return [], [], -1, {}
+        ret_cc_ids, score = self.ResolveScore(samp_qual_scores, method_cc)
+        assert(self.TestScore(score))
+        sup_method = self.GetSupportingMethods(method_cc[ret_cc_ids])
+        return list(ret_cc_ids), sup_method, round(score, 2), allele_size_support
+
+    def GetMethodCC(self, samp_call, samp_ccs, samp_sizes):
+        r"""
+        Get the pairs of CCs supported by each caller
+
+        Parameters
+        ----------
+        samp_call: dict(vcftype:allele)
+                allele: [al1, al2, BOOL] or [-1, BOOL] for no calls
+        samp_ccs : list of [int, int]
+           Per caller, CC index of each called allele
+        samp_sizes : list of [int, int]
+           Per caller, allele size of each called allele
+
+        Returns
+        -------
+        method_cc : dict (tuple: list)
+           Key=pair of ccids, Value=list of supporting methods
+        allele_size_support: dict
+            Key=bp diff of allele and the ref genome, Value=number of times we saw this allele.
+        """
         method_cc = defaultdict(list)  # methods supporting each pair of CCID
-        method_dict = {"advntr": [1, 0, 0, 0], "eh": [0, 1, 0, 0], "hipstr": [0, 0, 1, 0], "gangstr": [0, 0, 0, 1]}
         allele_size_support = {}
-        for method in samp_call:
+        for method, ccids, allele_sizes in zip(self.callers, samp_ccs, samp_sizes):
                 # check for no calls
                 if samp_call[method][0] == -1:
                         continue  # no call
                 # Get the IDs of supported connected components
-                ccids = []
                 for i in [0, 1]:
-                        node = self.rc_graph.GetNodeObject(method, samp_call[method][i])
-                        ccid = self.rc_graph.GetSubgraphIndexForNode(node)
-                        ccids.append(ccid)
-                        allele_size_support[node.allele_size] = allele_size_support.get(node.allele_size, 0) + 1
+                        if ccids[i] == -1:
+                                raise ValueError("Allele %d of %s is not in the allele graph" \
+                                                 %(samp_call[method][i], method.value))
+                        allele_size = allele_sizes[i]
+                        allele_size_support[allele_size] = allele_size_support.get(allele_size, 0) + 1
 
-                ccids.sort()
-                ccids = (ccids[0],ccids[1])
+                ccids = (min(ccids), max(ccids))
                 method_cc[ccids].append(method)
+        return method_cc, allele_size_support
 
-        if len(method_cc) == 0:  # no call across all methods
-            return [], [], -1, {}
-        ret_cc_ids, score = self.ResolveScore(samp_qual_scores, method_cc)
-        assert(self.TestScore(score))
+    def GetSupportingMethods(self, methods):
+        r"""
+        Parameters
+        ----------
+        methods : list of trh.VcfTypes
+           Methods supporting the resolved call
 
-        ret_sup_methods = [method.value for method in method_cc[ret_cc_ids]]
+        Returns
+        -------
+        sup_method : list of int
+           One flag per method (advntr, eh, hipstr, gangstr)
+        """
+        method_dict = {"advntr": [1, 0, 0, 0], "eh": [0, 1, 0, 0], "hipstr": [0, 0, 1, 0], "gangstr": [0, 0, 0, 1]}
         sup_method = [0, 0, 0, 0]
-        for method in ret_sup_methods:
+        for method in [method.value for method in methods]:
                 sup_method = [sum(x) for x in zip(sup_method, method_dict[method])] 
-        return list(ret_cc_ids), sup_method, round(score, 2), allele_size_support
+        return sup_method
 
 
 
@@ -746,25 +1272,30 @@ class RecordResolver:
                         if method_.value == method:
                             return pair, max_score * max_seen_score
 
-    def ResolveSequenceForSingleCall(self, ccid_list, samp_call, sample, hipstr_allele_frequency):
+    def ResolveSequenceForSingleCall(self, ccid_list, samp_call, sample):
+        r"""
+        Returns
+        -------
+        pre_allele_list : list of int
+           Indices of the resolved prealleles
+        """
         if len(ccid_list) == 0: return []
         pre_allele_list = []
         for cc_id in ccid_list:
-            connected_comp = self.rc_graph.connected_comps[cc_id]
-            resolved_prealleles = connected_comp.resolved_prealleles
+            resolved_prealleles = self.cc_prealleles[cc_id]
             if "any" in resolved_prealleles:
                 pre_allele_list.append(resolved_prealleles["any"])
                 continue
 
-            elif trh.VcfTypes.hipstr in connected_comp.uniq_callers and \
+            elif trh.VcfTypes.hipstr in self.cc_callers[cc_id] and \
                 trh.VcfTypes.hipstr in samp_call and samp_call[trh.VcfTypes.hipstr][0] != -1:
-                self.ResolveHipSTRcall(connected_comp, resolved_prealleles, pre_allele_list,
-                                       samp_call, sample, hipstr_allele_frequency)
+                self.ResolveHipSTRcall(resolved_prealleles, pre_allele_list, samp_call)
 
             else:
                 # TODO. For now just return a random allele if we don't have hipstr
                 pre_allele_list.append(list(resolved_prealleles.values())[0])
-        pre_allele_list = list(set(pre_allele_list))
+        # Remove duplicates, keeping the order deterministic
+        pre_allele_list = list(dict.fromkeys(pre_allele_list))
 
         if len(pre_allele_list) == 1:
             return [pre_allele_list[0], pre_allele_list[0]]
@@ -774,11 +1305,11 @@ class RecordResolver:
             # but we have a hipstr call of 10bp-10bp with different sequences as well
             n_copies = []
             for i in range(len(pre_allele_list)):
-                n_copies.append(pre_allele_list[i].allele_ncopy)
+                n_copies.append(self.prealleles[pre_allele_list[i]].allele_ncopy)
             n_copies.sort()
             if n_copies[0] == n_copies[1] or n_copies[1] == n_copies[2]:
                 for pa in pre_allele_list:
-                    if pa.allele_ncopy == n_copies[1]:
+                    if self.prealleles[pa].allele_ncopy == n_copies[1]:
                         pre_allele_list.remove(pa)
                         return pre_allele_list
 
@@ -787,12 +1318,8 @@ class RecordResolver:
 
         return pre_allele_list
 
-    def ResolveHipSTRcall(self, connected_comp, resolved_prealleles, pre_allele_list, samp_call,
-                          sample, hipstr_allele_frequency):
-        other_callers = list(connected_comp.uniq_callers)
-        other_callers.remove(trh.VcfTypes.hipstr)
-        other_callers.insert(0, trh.VcfTypes.hipstr)
-
+    def ResolveHipSTRcall(self, resolved_prealleles, pre_allele_list, samp_call):
+        hipstr_allele_frequency = self.hipstr_allele_frequency
         call = samp_call[trh.VcfTypes.hipstr]
         added_alleles = 0
         for al_idx in call[0:2]:
@@ -803,11 +1330,460 @@ class RecordResolver:
             max_freq_hipstr = 0
             max_freq_pa = ""
             for key in resolved_prealleles:
-                if resolved_prealleles[key].allele_sequence in hipstr_allele_frequency:
-                    if hipstr_allele_frequency[resolved_prealleles[key].allele_sequence] > max_freq_hipstr:
-                        max_freq_hipstr = hipstr_allele_frequency[resolved_prealleles[key].allele_sequence]
+                allele_sequence = self.prealleles[resolved_prealleles[key]].allele_sequence
+                if allele_sequence in hipstr_allele_frequency:
+                    if hipstr_allele_frequency[allele_sequence] > max_freq_hipstr:
+                        max_freq_hipstr = hipstr_allele_frequency[allele_sequence]
                         max_freq_pa = resolved_prealleles[key]
             if max_freq_pa == "": # HipSTR alleles were expanded, add a random allele
                 max_freq_pa = list(resolved_prealleles.values())[0]
             pre_allele_list.append(max_freq_pa)
 
+class RecordResolver:
+    """
+    Main class to resolve info for a record cluster
+
+    Parameters
+    ----------
+    rc : RecordCluster
+       the record cluster being resolved
+    sample_pool : samplepool.SamplePool, optional
+       Pool of worker processes used to resolve
+       blocks of samples in parallel
+
+    Attributes
+    ----------
+    rc_graph : ClusterGraph
+       keeps track of alleles across records being merged
+    resolved : bool
+       Set to True once the record cluster has been resolved
+    results : list of (list of PreAllele, float, list of int, dict)
+       Distinct results of the samples: resolved prealleles,
+       resolution score (i.e. all callers agreed, -1 for no call),
+       supporting methods and allele support
+    sample_results : np.ndarray
+       Index in results of each sample, in the order of record_cluster.samples
+    result_infos : list of (dict of str: str, bool)
+       GT, GB, NCOPY and EXP fields of each result and whether
+       it has an empty allele (see GetPreallelesInfo)
+    resolved_prealleles : dict (str: list of PreAllele)
+       Key=sample, Value=resolved prealleles
+    resolution_score : dict (str: float)
+       Key=sample, Value=resolution score
+       (i.e. all callers agreed)
+    resolution_method : dict (str: list of int)
+       Key=sample, Value=supporting methods
+    allele_support : dict (str: dict)
+       Key=sample, Value=allele support
+    sample_to_info : dict (str: dict of str: str)
+       Key=sample, Value=GT, GB, NCOPY and EXP fields
+    empty_call : dict (str: bool)
+       Key=sample, Value=True if the call has an empty allele
+
+    The per-sample dicts are read-only and rebuilt from results,
+    sample_results and result_infos on each access.
+    """
+    def __init__(self, rc, sample_pool=None):
+        self.record_cluster = rc
+        with profiling.Stage("graph_build"):
+            self.rc_graph = ClusterGraph(rc)
+        self.sample_pool = sample_pool
+        self.resolved = False
+
+        # Get set after resolving
+        self.results = []
+        self.sample_results = np.zeros(0, dtype=np.int32)
+        self.result_infos = []
+        self.sample_index = None
+        self.ref = None
+        self.alts = []
+        self.nocall = False
+
+    def Resolve(self):
+        start = time.perf_counter()
+        with profiling.Stage("resolve_samples"):
+            table = ResolutionTable(self.rc_graph, self.record_cluster)
+            samples = self.record_cluster.samples
+            calls, scores = self.record_cluster.GetCallArrays()
+            if self.sample_pool is not None and self.sample_pool.ShouldShard(len(samples)):
+                blocks = [(0, self.sample_pool.ResolveSamples(table, samples, calls, scores))]
+            else:
+                chunk_size = len(samples)
+                if memory.BUDGET is not None:
+                    chunk_size = memory.BUDGET.GetSampleChunkSize(len(samples), len(calls))
+                # Over the memory budget, only hold the results of a chunk of samples at once
+                blocks = ((first, table.ResolveSamples(samples[first:first+chunk_size], calls, scores, first)) \
+                          for first in range(0, len(samples), max(chunk_size, 1)))
+            self.sample_results = np.zeros(len(samples), dtype=np.int32)
+            result_index = {}
+            for first, block_results in blocks:
+                self.addResults(table, result_index, first, block_results)
+                del block_results
+        self.update()
+        self.resolved = True
+        if profiling.PROFILER is not None:
+            counters = {"records": len(self.record_cluster.record_objs),
+                        "alleles": len(self.rc_graph.alleles),
+                        "components": len(self.rc_graph.connected_comps),
+                        "samples_resolved": sum(1 for i in self.sample_results.tolist() \
+                                                if not self.result_infos[i][1]),
+                        "footprint": self.GetFootprint()}
+            profiling.PROFILER.AddLocus(self.record_cluster.chrom, self.record_cluster.first_pos,
+                                        time.perf_counter() - start, counters)
+        return self.resolved
+
+    def addResults(self, table, result_index, first, block_results):
+        r"""
+        Record the results of a block of samples
+
+        Only the index of its result is kept for each sample, so the
+        results of a block can be freed before the next one is resolved.
+
+        Parameters
+        ----------
+        table : ResolutionTable
+           Lookup tables the results come from
+        result_index : dict
+           Index in results of each distinct result, updated
+        first : int
+           Index of the first sample of the block
+        block_results : list of tuple
+           Result of each sample of the block (see ResolutionTable.ResolveSamples)
+        """
+        # Samples with the same calls share the objects of their
+        # results, only compare the contents of new objects
+        block_index = {}
+        indices = []
+        for resolved_ccids, resolved_methods, score, allele_support, pa_indices in block_results:
+            key = (id(pa_indices), id(resolved_methods), id(allele_support), score.__class__, score)
+            index = block_index.get(key)
+            if index is None:
+                content = (tuple(pa_indices), tuple(resolved_methods), tuple(allele_support.items()),
+                           score.__class__, score)
+                index = result_index.get(content)
+                if index is None:
+                    index = len(self.results)
+                    result_index[content] = index
+                    self.results.append(([table.prealleles[i] for i in pa_indices], score,
+                                         resolved_methods, allele_support))
+                block_index[key] = index
+            indices.append(index)
+        self.sample_results[first:first+len(indices)] = indices
+
+    def update(self):
+        # Samples often share the same resolved prealleles,
+        # handle each distinct combination once
+        distinct_prealleles = {}
+        for prealleles, score, methods, support in self.results:
+            distinct_prealleles.setdefault(tuple(map(id, prealleles)), prealleles)
+        # First update alleles list
+        for prealleles in distinct_prealleles.values():
+            for pa in prealleles:
+                if self.ref is None:
+                    self.ref = pa.reference_sequence
+                if pa.allele_sequence != self.ref and pa.allele_sequence != pa.reference_sequence:
+                    if pa.allele_sequence not in self.alts:
+                        if pa.allele_sequence != "":
+                            self.alts.append(pa.allele_sequence)
+
+        if self.ref is None:
+            self.nocall = True 
+        # Now update other info. need all alts for this
+        infos = {}
+        for key, prealleles in distinct_prealleles.items():
+            infos[key] = self.GetPreallelesInfo(prealleles)
+        self.result_infos = [infos[tuple(map(id, result[0]))] for result in self.results]
+
+    def GetPreallelesValues(self, prealleles):
+        r"""
+        Get the allele indices, bp differences, copy numbers
+        and expansion flags of a resolved call
+
+        Parameters
+        ----------
+        prealleles : list of PreAllele
+           Resolved prealleles of a sample
+
+        Returns
+        -------
+        values : (list of int, list of int, list of float, list of int)
+           GT, GB, NCOPY and EXP values of each allele.
+           Empty lists if there is no call.
+        empty_call : bool
+           True if the call has an empty allele
+        """
+        empty_call = False
+        GT_list = []
+        GB_list = []
+        NCOPY_list = []
+        Expanded = []
+        for pa in prealleles:
+            if pa.exp_flag:
+                Expanded.append(1)
+            else:
+                Expanded.append(0)
+            if pa.al_idx != 0 and pa.allele_sequence != self.ref:
+                if pa.allele_sequence == "":
+                    empty_call = True
+                    break
+                GT_list.append(self.alts.index(pa.allele_sequence) + 1)
+                GB_list.append(len(pa.allele_sequence) - len(self.ref))
+                NCOPY_list.append(pa.allele_ncopy)
+            else:
+                GT_list.append(0)
+                GB_list.append(0)
+                NCOPY_list.append(pa.reference_ncopy)
+        if len(GT_list) == 0 or empty_call:
+            return ([], [], [], []), empty_call
+        return (GT_list, GB_list, NCOPY_list, Expanded), empty_call
+
+    def GetPreallelesInfo(self, prealleles):
+        r"""
+        Get the GT, GB, NCOPY and EXP fields of a resolved call
+
+        Parameters
+        ----------
+        prealleles : list of PreAllele
+           Resolved prealleles of a sample
+
+        Returns
+        -------
+        info : dict of str: str
+           Value of each field
+        empty_call : bool
+           True if the call has an empty allele
+        """
+        (GT_list, GB_list, NCOPY_list, Expanded), empty_call = self.GetPreallelesValues(prealleles)
+        if len(GT_list) == 0:
+            info = {"GT": ".", "GB": ".", "NCOPY": ".", "EXP": "."}
+        else:
+            info = {"GT": '/'.join([str(item) for item in GT_list]),
+                    "GB": '/'.join([str(item) for item in GB_list]),
+                    "NCOPY": ','.join([str(item) for item in NCOPY_list]),
+                    "EXP": '/'.join([str(item) for item in Expanded])}
+        return info, empty_call
+
+    def getSampleValues(self, values):
+        r"""
+        Map a value of each distinct result to the samples
+
+        Parameters
+        ----------
+        values : list
+           Value of each result
+
+        Returns
+        -------
+        sample_values : dict
+           Key=sample, Value=value of its result
+        """
+        return dict(zip(self.record_cluster.samples,
+                        [values[i] for i in self.sample_results.tolist()]))
+
+    @property
+    def resolved_prealleles(self):
+        return self.getSampleValues([result[0] for result in self.results])
+
+    @property
+    def resolution_score(self):
+        return self.getSampleValues([result[1] for result in self.results])
+
+    @property
+    def resolution_method(self):
+        return self.getSampleValues([result[2] for result in self.results])
+
+    @property
+    def allele_support(self):
+        return self.getSampleValues([result[3] for result in self.results])
+
+    @property
+    def sample_to_info(self):
+        return self.getSampleValues([info for info, empty_call in self.result_infos])
+
+    @property
+    def empty_call(self):
+        return self.getSampleValues([empty_call for info, empty_call in self.result_infos])
+
+    def getSampleResult(self, sample):
+        r"""
+        Get the result of a sample
+
+        Parameters
+        ----------
+        sample : str
+           Sample ID
+
+        Returns
+        -------
+        result : (list of PreAllele, float, list of int, dict)
+           Resolved prealleles, score, supporting methods and allele support
+        info : dict of str: str
+           GT, GB, NCOPY and EXP fields
+        empty_call : bool
+           True if the call has an empty allele
+        """
+        if self.sample_index is None:
+            self.sample_index = GetSampleIndex(self.record_cluster.samples)
+        index = self.sample_results[self.sample_index[sample]]
+        info, empty_call = self.result_infos[index]
+        return self.results[index], info, empty_call
+
+    def GetSampleScore(self, sample):
+        (prealleles, score, methods, support), info, empty_call = self.getSampleResult(sample)
+        if score == -1 or empty_call:
+            return "."
+        return str(score)
+
+    def GetSampleGTS(self, sample):
+        (prealleles, score, methods, support), info, empty_call = self.getSampleResult(sample)
+        if len(methods) == 0 or empty_call:
+            return "."
+        return '|'.join([str(method) for method in methods])
+
+    def GetSampleALS(self, sample):
+        (prealleles, score, methods, support), info, empty_call = self.getSampleResult(sample)
+        if not support or empty_call:
+            return "."
+        return ",".join([str(key) + "|" + str(val) for key,val in support.items()])
+
+    def GetSampleGT(self, sample):
+        return self.getSampleResult(sample)[1]["GT"]
+
+    def GetSampleGB(self, sample):
+        return self.getSampleResult(sample)[1]["GB"]
+
+    def GetSampleNCOPY(self, sample):
+        return self.getSampleResult(sample)[1]["NCOPY"]
+
+    def GetExpandedFlag(self, sample):
+        return self.getSampleResult(sample)[1]['EXP']
+
+    def GetNumericColumns(self):
+        r"""
+        Get the consensus calls of all samples as arrays
+
+        Returns
+        -------
+        columns : dict of str: np.ndarray
+           Per sample, in the order of record_cluster.samples:
+           "gt" allele indices (int16, samples x 2, -1 if missing),
+           "gb" bp differences from the reference (int32, samples x 2,
+           GB_MISSING if missing), "ncopy" copy numbers (float32,
+           samples x 2, nan if missing), "score" (float32, nan if
+           missing) and "gts" supporting methods (uint8, bit i set
+           if method i of advntr, eh, hipstr, gangstr supports the call)
+        """
+        # One row per distinct set of resolved prealleles, first row is no call
+        distinct = {}
+        gt_table = [[-1, -1]]
+        gb_table = [[GB_MISSING, GB_MISSING]]
+        ncopy_table = [[np.nan, np.nan]]
+        rows = []
+        scores = []
+        masks = []
+        for (prealleles, score, methods, support), (info, empty_call) in zip(self.results, self.result_infos):
+            key = tuple(map(id, prealleles))
+            row = distinct.get(key)
+            if row is None:
+                (gts, gbs, ncopies, expanded), empty = self.GetPreallelesValues(prealleles)
+                row = 0
+                if len(gts) > 0:
+                    # Keep the first two alleles, pad haploid calls
+                    gts = (gts + [-1])[0:2]
+                    gbs = (gbs + [GB_MISSING])[0:2]
+                    ncopies = (ncopies + [np.nan])[0:2]
+                    row = len(gt_table)
+                    gt_table.append(gts)
+                    gb_table.append(gbs)
+                    ncopy_table.append(ncopies)
+                distinct[key] = row
+            if empty_call:
+                row = 0
+            rows.append(row)
+            if row == 0 or score == -1:
+                scores.append(np.nan)
+                masks.append(0)
+                continue
+            scores.append(score)
+            masks.append(sum([1 << i for i, count in enumerate(methods) if count > 0]))
+        rows = np.array(rows, dtype=np.intp)[self.sample_results]
+        return {"gt": np.array(gt_table, dtype=np.int16)[rows],
+                "gb": np.array(gb_table, dtype=np.int32)[rows],
+                "ncopy": np.array(ncopy_table, dtype=np.float32)[rows],
+                "score": np.array(scores, dtype=np.float32)[self.sample_results],
+                "gts": np.array(masks, dtype=np.uint8)[self.sample_results]}
+
+    def GetFormatColumns(self, inputs_mode="full"):
+        r"""
+        Get the FORMAT fields of all samples, one column per field
+
+        Each distinct value is formatted once and the same
+        string object is shared by all samples with that value.
+
+        Parameters
+        ----------
+        inputs_mode : str, optional
+           Encoding of INPUTS: "full" (copy numbers of each caller, see
+           RecordCluster.GetRawCallColumn), "compact" (allele indices, see
+           RecordCluster.GetCompactCallColumn) or "none" (no INPUTS column)
+
+        Returns
+        -------
+        columns : list of list of str
+           Values of GT, GB, NCOPY, EXP, SCORE, GTS, ALS and INPUTS
+           for each sample, in the order of record_cluster.samples
+        """
+        # Strings of each distinct result
+        result_strings = []
+        for (prealleles, score, methods, support), (info, empty_call) in zip(self.results, self.result_infos):
+            if empty_call:
+                strings = (".", ".", ".")
+            else:
+                strings = ("." if score == -1 else str(score),
+                           '|'.join([str(m) for m in methods]) if len(methods) > 0 else ".",
+                           ",".join([str(k) + "|" + str(v) for k, v in support.items()]) if support else ".")
+            result_strings.append((info["GT"], info["GB"], info["NCOPY"], info["EXP"]) + strings)
+        sample_strings = [result_strings[i] for i in self.sample_results.tolist()]
+        columns = [[strings[field] for strings in sample_strings] for field in range(7)]
+        if inputs_mode == "full":
+            columns.append(self.record_cluster.GetRawCallColumn())
+        elif inputs_mode == "compact":
+            columns.append(self.record_cluster.GetCompactCallColumn())
+        return columns
+
+    def GetFootprint(self):
+        r"""
+        Estimate the memory held by the locus until it is written
+
+        Counts the call, phasing and score arrays and the allele
+        sequences of the records, and the per-sample results.
+        Values shared by many samples are not counted.
+
+        Returns
+        -------
+        nbytes : int
+           Estimated bytes
+        """
+        nbytes = 0
+        for ro in self.record_cluster.record_objs:
+            nbytes += ro.genotypes.nbytes + ro.phased.nbytes
+            if ro.scores is not None:
+                nbytes += ro.scores.nbytes
+            nbytes += len(ro.hm_record.ref_allele) + sum(len(alt) for alt in ro.hm_record.alt_alleles)
+        nbytes += self.sample_results.nbytes
+        nbytes += sys.getsizeof(self.results) + sys.getsizeof(self.result_infos)
+        nbytes += sum(sys.getsizeof(result[0]) for result in self.results)
+        return nbytes
+
+    def Release(self):
+        r"""
+        Drop the results, allele graph and records of a written locus
+        so that their memory is freed right away, rather than
+        when the resolver of a later locus replaces this one
+        """
+        self.results = []
+        self.sample_results = np.zeros(0, dtype=np.int32)
+        self.result_infos = []
+        self.sample_index = None
+        self.rc_graph = None
+        self.record_cluster.record_objs = []
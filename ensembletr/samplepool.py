@@ -0,0 +1,169 @@
+"""
+Pool of worker processes to resolve blocks of
+samples of a record cluster in parallel
+"""
+
+import multiprocessing
+from multiprocessing import resource_tracker, shared_memory
+import numpy as np
+import pickle
+
+# Lookup tables and samples of the locus being resolved by this
+# worker: (locus number, table, samples), unpickled once per locus
+_locus = None
+
+class SamplePool:
+    """
+    Resolves disjoint blocks of samples in worker processes.
+
+    The allele graph is built once per locus in the main process.
+    Workers only get its lookup tables (recordcluster.ResolutionTable).
+    The pickled tables and samples, and the call and score arrays,
+    are written once per locus to a shared memory block. Tasks only
+    hold the bounds of their block of samples.
+
+    Parameters
+    ----------
+    threads : int
+       Number of worker processes
+    block_size : int
+       Number of samples resolved by each task.
+       Loci with at most this many samples are resolved
+       in the main process.
+
+    Attributes
+    ----------
+    pool : multiprocessing.Pool
+       Worker processes
+    num_loci : int
+       Number of loci resolved in blocks
+    """
+    def __init__(self, threads, block_size):
+        self.threads = threads
+        self.block_size = block_size
+        self.num_loci = 0
+        # Workers must share our resource tracker, otherwise each of them
+        # reports the shared memory blocks it attached to as leaked
+        resource_tracker.ensure_running()
+        self.pool = multiprocessing.Pool(threads)
+
+    def ShouldShard(self, num_samples):
+        r"""
+        Check if a locus is worth splitting across workers
+
+        Parameters
+        ----------
+        num_samples : int
+           Number of samples at the locus
+
+        Returns
+        -------
+        shard : bool
+           True if the samples should be resolved in blocks
+        """
+        return num_samples > self.block_size
+
+    def ResolveSamples(self, table, samples, calls, scores):
+        r"""
+        Resolve all samples of a locus in blocks
+
+        Parameters
+        ----------
+        table : recordcluster.ResolutionTable
+           Lookup tables of the locus
+        samples : list of str
+           Samples of the record cluster
+        calls : list of np.ndarray
+           Per caller, allele indices of each sample (num samples x 2)
+        scores : list of np.ndarray
+           Per caller, quality score of each sample
+
+        Returns
+        -------
+        results : list of tuple
+           Results for each sample, in the same order as samples
+           (see recordcluster.ResolutionTable.ResolveSample)
+        """
+        arrays = calls + scores
+        locus = pickle.dumps((table, samples), pickle.HIGHEST_PROTOCOL)
+        layout, nbytes = GetSharedLayout(arrays)
+        shm = shared_memory.SharedMemory(create=True, size=nbytes + len(locus))
+        self.num_loci += 1
+        try:
+            for array, (offset, shape, dtype) in zip(arrays, layout):
+                np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)[...] = array
+            shm.buf[nbytes:nbytes+len(locus)] = locus
+            tasks = []
+            for start in range(0, len(samples), self.block_size):
+                tasks.append((self.num_loci, shm.name, layout, len(calls), (nbytes, len(locus)),
+                              start, min(start + self.block_size, len(samples))))
+            results = []
+            for block_results in self.pool.imap(ResolveSampleBlock, tasks):
+                results.extend(block_results)
+        finally:
+            shm.close()
+            shm.unlink()
+        return results
+
+    def Close(self):
+        r"""
+        Stop the worker processes
+        """
+        self.pool.close()
+        self.pool.join()
+
+def GetSharedLayout(arrays):
+    r"""
+    Compute where each array is stored in a shared memory block
+
+    Parameters
+    ----------
+    arrays : list of np.ndarray
+       Arrays to store
+
+    Returns
+    -------
+    layout : list of (int, tuple, str)
+       Offset, shape and dtype of each array
+    nbytes : int
+       Total size of the block
+    """
+    layout = []
+    offset = 0
+    for array in arrays:
+        offset = (offset + 7) // 8 * 8 # align to 8 bytes
+        layout.append((offset, array.shape, array.dtype.str))
+        offset += array.nbytes
+    return layout, offset
+
+def ResolveSampleBlock(task):
+    r"""
+    Resolve a block of samples in a worker process
+
+    Parameters
+    ----------
+    task : tuple
+       (locus number, shared memory name, layout, number of
+       call arrays, offset and size of the pickled tables and
+       samples, index of the first and past the last sample)
+
+    Returns
+    -------
+    results : list of tuple
+       Results for each sample of the block
+    """
+    global _locus
+    locus_num, shm_name, layout, num_calls, (locus_offset, locus_size), start, end = task
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        if _locus is None or _locus[0] != locus_num:
+            _locus = None
+            _locus = (locus_num,) + pickle.loads(bytes(shm.buf[locus_offset:locus_offset+locus_size]))
+        table, samples = _locus[1], _locus[2]
+        arrays = [np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset) \
+                  for offset, shape, dtype in layout]
+        results = table.ResolveSamples(samples[start:end], arrays[:num_calls], arrays[num_calls:], start)
+        del arrays
+    finally:
+        shm.close()
+    return results
@@ -0,0 +1,93 @@
+import os
+import random
+
+import pytest
+
+from .. import vcfio
+
+# Chromosomes in header order, which is not lexicographic
+MERGE_CHROMS = ["chr2", "chr10"]
+# Loci (chrom, position, motif, reference copies). The first one is
+# long enough to span the first boundary of small merge regions.
+MERGE_LOCI = [("chr2", 40, "AC", 40), ("chr2", 200, "AGG", 6), ("chr2", 330, "AC", 7),
+              ("chr2", 480, "ATTT", 5), ("chr2", 620, "AC", 6),
+              ("chr10", 60, "AC", 5), ("chr10", 200, "AAT", 6), ("chr10", 350, "AC", 8)]
+# Loci without a HipSTR record
+MERGE_GANGSTR_ONLY = [("chr2", 480), ("chr10", 200)]
+MERGE_CHROM_LENGTH = 800
+MERGE_NUM_SAMPLES = 12
+
+def writeIndexedVCF(path, header, lines):
+	writer = vcfio.BGZFWriter(path)
+	index = vcfio.TabixIndex()
+	writer.write(header)
+	for line in lines:
+		start_offset = writer.uncompressed_size
+		writer.write(line + "\n")
+		fields = line.split("\t", 4)
+		beg = int(fields[1]) - 1
+		index.AddRecord(fields[0], beg, beg + len(fields[3]), start_offset, writer.uncompressed_size)
+	writer.close()
+	index.Write(path + ".tbi", writer.GetVirtualOffset)
+
+def getGenotypes(rng, num_alleles, sep):
+	# Samples share a few genotypes
+	pool = [".%s."%sep] + ["%d%s%d"%(rng.randrange(num_alleles), sep, rng.randrange(num_alleles)) \
+		for i in range(4)]
+	return [pool[0] if rng.random() < 0.1 else rng.choice(pool[1:]) for i in range(MERGE_NUM_SAMPLES)]
+
+@pytest.fixture
+def mergevcfs(tmp_path):
+	r"""
+	Bgzipped and indexed GangSTR and HipSTR VCFs of MERGE_LOCI
+	and their reference. Genotypes repeat across samples.
+	"""
+	rng = random.Random(3)
+	seqs = {}
+	for chrom in MERGE_CHROMS:
+		seq = [rng.choice("GT") for i in range(MERGE_CHROM_LENGTH)]
+		for locus_chrom, pos, motif, copies in MERGE_LOCI:
+			if locus_chrom == chrom:
+				seq[pos-1:pos-1+len(motif)*copies] = list(motif*copies)
+		seqs[chrom] = "".join(seq)
+	ref = os.path.join(str(tmp_path), "ref.fa")
+	with open(ref, "w") as f:
+		for chrom in MERGE_CHROMS:
+			f.write(">%s\n%s\n"%(chrom, seqs[chrom]))
+	samples = ["S%d"%(i+1) for i in range(MERGE_NUM_SAMPLES)]
+	header = "##fileformat=VCFv4.2\n" + \
+		"".join("##contig=<ID=%s,length=%d>\n"%(chrom, MERGE_CHROM_LENGTH) for chrom in MERGE_CHROMS) + "%s" + \
+		'##FORMAT=<ID=GT,Number=1,Type=String,Description="">\n' + \
+		'##FORMAT=<ID=Q,Number=1,Type=Float,Description="">\n' + \
+		"#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t" + "\t".join(samples) + "\n"
+	gangstr_lines = []
+	hipstr_lines = []
+	for chrom, pos, motif, copies in MERGE_LOCI:
+		end = pos + len(motif)*copies - 1
+		alt_copies = [copies + 1, copies - 1, copies + 2]
+		genotypes = getGenotypes(rng, len(alt_copies) + 1, "/")
+		gangstr_lines.append("\t".join([chrom, str(pos), ".", motif*copies,
+			",".join(motif*alt for alt in alt_copies), ".", ".",
+			"END=%d;RU=%s;PERIOD=%d;REF=%d"%(end, motif, len(motif), copies), "GT:Q"] + \
+			["%s:%s"%(gt, "." if gt == "./." else round(rng.uniform(0.5, 1), 2)) for gt in genotypes]))
+		if (chrom, pos) in MERGE_GANGSTR_ONLY:
+			continue
+		# HipSTR includes 2bp of flank
+		flank = seqs[chrom][pos-3:pos-1]
+		genotypes = getGenotypes(rng, 3, "|")
+		hipstr_lines.append("\t".join([chrom, str(pos-2), "%s_%d"%(chrom, pos), flank + motif*copies,
+			",".join(flank + motif*alt for alt in alt_copies[:2]), ".", ".",
+			"START=%d;END=%d;PERIOD=%d"%(pos, end, len(motif)), "GT:Q"] + \
+			["%s:%s"%(gt, "." if gt == ".|." else round(rng.uniform(0.5, 1), 2)) for gt in genotypes]))
+	gangstr = os.path.join(str(tmp_path), "gangstr.vcf.gz")
+	writeIndexedVCF(gangstr, header%("##command=GangSTR\n" + \
+		'##INFO=<ID=END,Number=1,Type=Integer,Description="">\n' + \
+		'##INFO=<ID=RU,Number=1,Type=String,Description="">\n' + \
+		'##INFO=<ID=PERIOD,Number=1,Type=Integer,Description="">\n' + \
+		'##INFO=<ID=REF,Number=1,Type=Float,Description="">\n'), gangstr_lines)
+	hipstr = os.path.join(str(tmp_path), "hipstr.vcf.gz")
+	writeIndexedVCF(hipstr, header%("##command=HipSTR\n" + \
+		'##INFO=<ID=START,Number=1,Type=Integer,Description="">\n' + \
+		'##INFO=<ID=END,Number=1,Type=Integer,Description="">\n' + \
+		'##INFO=<ID=PERIOD,Number=1,Type=Integer,Description="">\n'), hipstr_lines)
+	return {"vcfs": [gangstr, hipstr], "ref": ref}
@@ -0,0 +1,43 @@
+from .. import hipstr_correction
+
+import cyvcf2
+import gzip
+import os
+
+def writeVCF(vcffile, records):
+	with open(vcffile, "w") as f:
+		f.write("##fileformat=VCFv4.1\n")
+		f.write("##contig=<ID=chr1,length=100000>\n")
+		f.write('##INFO=<ID=START,Number=1,Type=Integer,Description="">\n')
+		f.write('##INFO=<ID=END,Number=1,Type=Integer,Description="">\n')
+		f.write('##INFO=<ID=PERIOD,Number=1,Type=Integer,Description="">\n')
+		f.write('##FORMAT=<ID=GT,Number=1,Type=String,Description="">\n')
+		f.write('##FORMAT=<ID=GB,Number=1,Type=String,Description="">\n')
+		f.write('##FORMAT=<ID=Q,Number=1,Type=Float,Description="">\n')
+		f.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1\tS2\n")
+		for pos, recid, ref, alt, s1, s2 in records:
+			f.write("chr1\t%d\t%s\t%s\t%s\t.\t.\tPERIOD=2\tGT:GB:Q\t%s\t%s\n"%(pos, recid, ref, alt, s1, s2))
+
+def test_CorrectVCF(tmp_path):
+	vcffile = os.path.join(str(tmp_path), "hipstr.vcf")
+	# The second record of STR_1 was expanded over a SNP one base before
+	# the repeat. Its SNP allele is the same as REF once trimmed
+	records = [(100, "STR_1", "ACACAC", "ACACACAC", "0|1:0|2:0.9", "."),
+	           (99, "STR_1", "GACACAC", "GACAC,TACACAC", ".", "1/2:-2|0:0.8"),
+	           (500, "STR_2", "TTTT", "TTTTT", "1|1:1|1:.", "0|0:0|0:1")]
+	# A group longer than the window of the original script
+	records += [(1000 - i, "STR_3", "G"*i + "AGAG", ".", ".", ".") for i in range(100)]
+	writeVCF(vcffile, sorted(records))
+	out = os.path.join(str(tmp_path), "corrected.vcf.gz")
+	assert(hipstr_correction.CorrectVCF(vcffile, out) == (103, 3))
+	assert(os.path.exists(out + ".tbi"))
+	with gzip.open(out, "rt") as f:
+		lines = [line.rstrip("\n").split("\t") for line in f if not line.startswith("#")]
+	assert(lines[0][0:5] == ["chr1", "100", "STR_1", "ACACAC", "ACAC,ACACACAC"])
+	assert(lines[0][7] == "START=100;END=105;PERIOD=2")
+	assert(lines[0][9:] == ["0|2:0|2:0.9", "1/0:-2|0:0.8"])
+	assert(lines[1][0:5] == ["chr1", "500", "STR_2", "TTTT", "TTTTT"])
+	assert(lines[1][9:] == ["1|1:1|1:.", "0|0:0|0:1.0"])
+	assert(lines[2][1:5] == ["1000", "STR_3", "AGAG", "."])
+	assert(lines[2][9:] == [".:.:.", ".:.:."])
+	assert(sum(1 for record in cyvcf2.VCF(out)("chr1:1000-1000")) == 1)
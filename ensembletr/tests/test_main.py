@@ -0,0 +1,31 @@
+from .. import main
+from .. import vcfio
+
+import argparse
+import os
+from pyfaidx import Fasta
+
+def test_MergeParallel(mergevcfs, tmp_path):
+	serial_path = os.path.join(str(tmp_path), "serial.vcf")
+	readers = vcfio.Readers(mergevcfs["vcfs"], Fasta(mergevcfs["ref"]))
+	writer = vcfio.Writer(serial_path, readers.samples, "test", chroms=readers.chroms)
+	main.MergeRecords(readers, writer)
+	writer.Close()
+
+	parallel_path = os.path.join(str(tmp_path), "parallel.vcf")
+	# Small regions, the first boundary is inside the first locus
+	args = argparse.Namespace(vcfs=",".join(mergevcfs["vcfs"]), ref=mergevcfs["ref"], out=parallel_path,
+		threads=2, region_size=38, exclude_single=False, ref_window_size=vcfio.REF_WINDOW_SIZE,
+		sort_buffer_size=vcfio.SORT_BUFFER_SIZE, output_buffer_size=vcfio.OUTPUT_BUFFER_SIZE,
+		sidecar=None, profile=None, inputs_mode="full")
+	readers = vcfio.Readers(mergevcfs["vcfs"], Fasta(mergevcfs["ref"]))
+	writer = vcfio.Writer(parallel_path, readers.samples, "test", chroms=readers.chroms)
+	main.MergeParallel(args, readers, writer)
+	writer.Close()
+
+	with open(serial_path, "rb") as f:
+		serial = f.read()
+	with open(parallel_path, "rb") as f:
+		parallel = f.read()
+	assert(serial.count(b"\nchr") == 8)
+	assert(parallel == serial)
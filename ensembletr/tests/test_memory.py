@@ -0,0 +1,81 @@
+from .. import memory
+from .. import recordcluster
+from .. import vcfio
+
+import numpy as np
+import os
+from pyfaidx import Fasta
+
+def test_Budget():
+	rss = memory.GetCurrentRSS()
+	assert(rss > 0)
+	assert(memory.GetPeakRSS() >= rss)
+	budget = memory.Budget(1 << 50)
+	assert(not budget.Exceeded())
+	assert(budget.GetSampleChunkSize(10000, 4) == 10000)
+	budget = memory.Budget(1)
+	assert(budget.Exceeded())
+	assert(budget.num_exceeded == 1)
+	# Small loci are always resolved at once
+	assert(budget.GetSampleChunkSize(100, 4) == 100)
+	assert(budget.GetSampleChunkSize(10000, 4) == memory.SAMPLE_CHUNK_SIZE)
+	assert(budget.num_chunked == 1)
+
+def writeLocusVCFs(tmpdir):
+	ref = os.path.join(tmpdir, "ref.fa")
+	refseq = "GATTGCTCAG"*5 + "AC"*5 + "TGGTCAATGC"*5
+	with open(ref, "w") as f:
+		f.write(">chr1\n%s\n"%refseq)
+	gangstr_gts = ["0/1", "0/0", "./.", "2/2", "1/1", "0/2", "0/1", "1/2", "./.", "0/0", "1/1", "0/1"]
+	hipstr_gts = ["0|1", "0|0", "1|1", ".|.", "1|1", "0|2", "1|0", "0|1", ".|.", "2|2", "0|1", "0|1"]
+	samples = ["S%d"%(i+1) for i in range(len(gangstr_gts))]
+	header = "##fileformat=VCFv4.2\n##contig=<ID=chr1,length=%d>\n%s" + \
+		'##FORMAT=<ID=GT,Number=1,Type=String,Description="">\n' + \
+		'##FORMAT=<ID=Q,Number=1,Type=Float,Description="">\n' + \
+		"#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t" + "\t".join(samples) + "\n"
+	gangstr = os.path.join(tmpdir, "gangstr.vcf")
+	with open(gangstr, "w") as f:
+		f.write(header%(len(refseq), "##command=GangSTR\n" + \
+			'##INFO=<ID=END,Number=1,Type=Integer,Description="">\n' + \
+			'##INFO=<ID=RU,Number=1,Type=String,Description="">\n' + \
+			'##INFO=<ID=PERIOD,Number=1,Type=Integer,Description="">\n' + \
+			'##INFO=<ID=REF,Number=1,Type=Float,Description="">\n'))
+		f.write("chr1\t51\t.\t%s\t%s,%s\t.\t.\tEND=60;RU=AC;PERIOD=2;REF=5\tGT:Q\t%s\n"%(
+			"AC"*5, "AC"*6, "AC"*3,
+			"\t".join("%s:%s"%(gt, "." if gt == "./." else 0.5 + 0.05*i) for i, gt in enumerate(gangstr_gts))))
+	# HipSTR includes 2bp of flank
+	hipstr = os.path.join(tmpdir, "hipstr.vcf")
+	with open(hipstr, "w") as f:
+		f.write(header%(len(refseq), "##command=HipSTR\n" + \
+			'##INFO=<ID=START,Number=1,Type=Integer,Description="">\n' + \
+			'##INFO=<ID=END,Number=1,Type=Integer,Description="">\n' + \
+			'##INFO=<ID=PERIOD,Number=1,Type=Integer,Description="">\n'))
+		f.write("chr1\t49\tchr1_51\t%s\t%s,%s\t.\t.\tSTART=51;END=60;PERIOD=2\tGT:Q\t%s\n"%(
+			"AG" + "AC"*5, "AG" + "AC"*6, "AG" + "AC"*4,
+			"\t".join("%s:%s"%(gt, "." if gt == ".|." else 0.9 - 0.05*i) for i, gt in enumerate(hipstr_gts))))
+	return [gangstr, hipstr], ref
+
+def resolveLocus(vcfs, ref):
+	readers = vcfio.Readers(vcfs, Fasta(ref))
+	record_clusters = readers.getMergableCalls().RecordClusters
+	assert(len(record_clusters) == 1)
+	resolver = recordcluster.RecordResolver(record_clusters[0])
+	assert(resolver.Resolve())
+	return resolver.GetFormatColumns(), resolver.GetNumericColumns()
+
+def test_ResolveBudget(tmp_path, monkeypatch):
+	vcfs, ref = writeLocusVCFs(str(tmp_path))
+	format_columns, numeric_columns = resolveLocus(vcfs, ref)
+	# Resolve in chunks of 5 samples, the last one partial
+	budget = memory.Budget(1)
+	monkeypatch.setattr(memory, "SAMPLE_CHUNK_SIZE", 5)
+	monkeypatch.setattr(memory, "BUDGET", budget)
+	chunked_format_columns, chunked_numeric_columns = resolveLocus(vcfs, ref)
+	assert(budget.num_chunked == 1)
+	assert(chunked_format_columns == format_columns)
+	assert(sorted(chunked_numeric_columns.keys()) == sorted(numeric_columns.keys()))
+	for key in numeric_columns:
+		assert(np.array_equal(chunked_numeric_columns[key], numeric_columns[key], equal_nan=True))
+	# Distinct calls of one or both methods, and a sample without calls
+	assert(len(set(format_columns[0])) > 4)
+	assert(format_columns[0][8] == ".")
@@ -0,0 +1,108 @@
+from .. import main
+from .. import pipeline
+from .. import recordcluster
+from .. import vcfio
+
+import os
+from pyfaidx import Fasta
+import pytest
+import threading
+import time
+
+class FailingReaders:
+	done = False
+	def getMergableCalls(self):
+		raise ValueError("bad record")
+
+class FakeWriter:
+	def WriteRecord(self, rcres):
+		pass
+	def FlushUpTo(self, chrom=None, pos=None):
+		pass
+
+def test_PipelineError():
+	merge_pipeline = pipeline.Pipeline(FailingReaders(), FakeWriter(), queue_size=1)
+	with pytest.raises(ValueError):
+		merge_pipeline.Run()
+
+def test_StageCounters():
+	counters = pipeline.StageCounters("writer")
+	counters.busy, counters.idle, counters.items = 1.0, 3.0, 5
+	assert(counters.GetSummary() == "writer: 5 items, busy 1.00s, idle 3.00s (25.0% busy)")
+
+def mergeFixture(mergevcfs, out_path, use_pipeline):
+	readers = vcfio.Readers(mergevcfs["vcfs"], Fasta(mergevcfs["ref"]))
+	writer = vcfio.Writer(out_path, readers.samples, "test", chroms=readers.chroms)
+	if use_pipeline:
+		merge_pipeline = pipeline.Pipeline(readers, writer, queue_size=1)
+		recnum = merge_pipeline.Run()
+	else:
+		recnum = main.MergeRecords(readers, writer)
+	writer.Close()
+	with open(out_path, "rb") as f:
+		return recnum, f.read()
+
+def test_PipelineOutput(mergevcfs, tmp_path):
+	recnum, output = mergeFixture(mergevcfs, os.path.join(str(tmp_path), "serial.vcf"), False)
+	assert(recnum == 8)
+	assert(mergeFixture(mergevcfs, os.path.join(str(tmp_path), "pipeline.vcf"), True) == (recnum, output))
+
+def getPrefetched(mergevcfs, tmp_path, monkeypatch, queue_size):
+	resolving = threading.Event()
+	release = threading.Event()
+	class BlockingResolver(recordcluster.RecordResolver):
+		def Resolve(self):
+			resolving.set()
+			assert(release.wait(10))
+			return super().Resolve()
+	monkeypatch.setattr(recordcluster, "RecordResolver", BlockingResolver)
+	readers = vcfio.Readers(mergevcfs["vcfs"], Fasta(mergevcfs["ref"]))
+	writer = vcfio.Writer(os.path.join(str(tmp_path), "out%d.vcf"%queue_size), readers.samples, "test",
+		chroms=readers.chroms)
+	merge_pipeline = pipeline.Pipeline(readers, writer, queue_size=queue_size)
+	thread = threading.Thread(target=merge_pipeline.Run)
+	thread.start()
+	try:
+		# Let the reader run ahead while the first cluster is being resolved
+		assert(resolving.wait(10))
+		deadline = time.monotonic() + 10
+		while not merge_pipeline.cluster_queue.full() and not readers.done and \
+		      time.monotonic() < deadline:
+			time.sleep(0.01)
+		time.sleep(0.2)
+		prefetched = merge_pipeline.reader_counters.items
+		assert(merge_pipeline.cluster_queue.qsize() <= queue_size)
+	finally:
+		release.set()
+		thread.join()
+	writer.Close()
+	assert(merge_pipeline.reader_counters.items == 8)
+	return prefetched
+
+def test_PipelineQueueBound(mergevcfs, tmp_path, monkeypatch):
+	# The cluster being resolved and at most one queued, the
+	# next one waits for room in the queue
+	assert(getPrefetched(mergevcfs, tmp_path, monkeypatch, 1) <= 2)
+	assert(getPrefetched(mergevcfs, tmp_path, monkeypatch, 64) == 8)
+
+def test_PipelineRelease(mergevcfs, tmp_path, monkeypatch):
+	resolvers = []
+	class TrackedResolver(recordcluster.RecordResolver):
+		def Resolve(self):
+			resolvers.append(self)
+			self.released = False
+			# Clusters of chr10 are not written
+			return super().Resolve() and self.record_cluster.chrom != "chr10"
+		def Release(self):
+			self.released = True
+			super().Release()
+	monkeypatch.setattr(recordcluster, "RecordResolver", TrackedResolver)
+	out_path = os.path.join(str(tmp_path), "out.vcf")
+	readers = vcfio.Readers(mergevcfs["vcfs"], Fasta(mergevcfs["ref"]))
+	writer = vcfio.Writer(out_path, readers.samples, "test", chroms=readers.chroms)
+	pipeline.Pipeline(readers, writer, queue_size=1).Run()
+	writer.Close()
+	assert(len(resolvers) == 8)
+	assert(all(resolver.released for resolver in resolvers))
+	with open(out_path) as f:
+		assert([line.split("\t", 1)[0] for line in f if not line.startswith("#")] == ["chr2"]*5)
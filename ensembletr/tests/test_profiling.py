@@ -0,0 +1,30 @@
+from .. import profiling
+
+@profiling.Timed("write")
+def Double(x):
+	return 2 * x
+
+def test_Profiler():
+	assert(profiling.PROFILER is None)
+	assert(Double(2) == 4)
+	profiler = profiling.Enable()
+	try:
+		assert(Double(3) == 6)
+		with profiling.Stage("graph_build"):
+			pass
+		profiler.AddLocus("chr1", 100, 0.5, {"records": 3, "alleles": 5, "components": 2, "samples_resolved": 10,
+		                            "footprint": 2048})
+		data = profiler.GetData()
+		assert(data["stages"]["write"]["calls"] == 1)
+		assert(data["stages"]["graph_build"]["calls"] == 1)
+		assert(data["stages"]["harmonize"]["calls"] == 0)
+		assert(data["stages"]["write"]["max_rss"] > 0)
+		assert(data["peak_rss"] >= data["stages"]["write"]["max_rss"])
+		assert(data["counters"]["alleles"] == {"total": 5, "mean": 5.0, "max": 5})
+		assert(data["largest_loci"][0]["footprint"] == 2048)
+		# e.g. profile of a worker process
+		profiler.Merge(data)
+		assert(profiler.stages["write"][1] == 2)
+		assert(profiler.loci["pos"] == [100, 100])
+	finally:
+		profiling.PROFILER = None
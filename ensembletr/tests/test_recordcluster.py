@@ -1,9 +1,12 @@
 from .. import recordcluster
+from .. import vcfio
 import trtools.utils.tr_harmonizer as trh
 
 import os
 import pytest
 import cyvcf2
+import numpy as np
+from pyfaidx import Fasta
 
 def test_RecordObj(vcfdir):
 	# Test GangSTR VCF
@@ -36,3 +39,155 @@ def test_RecordObj(vcfdir):
 	assert(ro_eh.GetROSampleCall(0)[1] == 0)
 	assert(ro_eh.GetSampleString(0) == "eh=14.0,14.0")
 	assert(ro_eh.GetScore(0) == 1.0)
+
+def test_RecordObjGenotypes(tmp_path):
+	vcffile = os.path.join(str(tmp_path), "gangstr.vcf")
+	with open(vcffile, "w") as f:
+		f.write("##fileformat=VCFv4.2\n")
+		f.write("##command=GangSTR\n")
+		f.write("##contig=<ID=chr1,length=1000>\n")
+		f.write('##INFO=<ID=END,Number=1,Type=Integer,Description="">\n')
+		f.write('##INFO=<ID=RU,Number=1,Type=String,Description="">\n')
+		f.write('##INFO=<ID=PERIOD,Number=1,Type=Integer,Description="">\n')
+		f.write('##INFO=<ID=REF,Number=1,Type=Float,Description="">\n')
+		f.write('##FORMAT=<ID=GT,Number=1,Type=String,Description="">\n')
+		f.write('##FORMAT=<ID=Q,Number=1,Type=Float,Description="">\n')
+		f.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1\tS2\tS3\n")
+		f.write("chr1\t100\t.\tACACAC\tACACACAC,ACAC\t.\t.\tEND=105;RU=AC;PERIOD=2;REF=3\tGT:Q\t0/0:1\t./.:.\t2/1:0.9\n")
+	reader = cyvcf2.VCF(vcffile)
+	record = next(reader)
+	ro = recordcluster.RecordObj(record, trh.VcfTypes.gangstr, reader.samples)
+	assert(ro.GetCalledAlleles() == set([0, 1, 2]))
+	assert(ro.GetROSampleCall("S1") == [0, 0, False])
+	assert(ro.GetROSampleCall("S2")[0] == -1)
+	assert(ro.GetROSampleCall("S3") == [2, 1, False])
+	assert(ro.GetSampleString("S3") == "gangstr=2.0,4.0")
+	assert(ro.GetCallString((2, 1)) == "gangstr=2.0,4.0")
+	assert(ro.GetCallString((-1, -1)) == "gangstr=.")
+	assert(list(ro.GetSampleColumns(["S3", "S1"])) == [2, 0])
+	scores = ro.GetScores()
+	assert(scores[0] == 1.0)
+	assert(np.isnan(scores[1]))
+	assert(scores[2] == ro.GetScore("S3"))
+
+def test_RecordObjMixedPloidy(tmp_path):
+	vcffile = os.path.join(str(tmp_path), "gangstr.vcf")
+	with open(vcffile, "w") as f:
+		f.write("##fileformat=VCFv4.2\n")
+		f.write("##command=GangSTR\n")
+		f.write("##contig=<ID=chrX,length=1000>\n")
+		f.write('##INFO=<ID=END,Number=1,Type=Integer,Description="">\n')
+		f.write('##INFO=<ID=RU,Number=1,Type=String,Description="">\n')
+		f.write('##INFO=<ID=PERIOD,Number=1,Type=Integer,Description="">\n')
+		f.write('##INFO=<ID=REF,Number=1,Type=Float,Description="">\n')
+		f.write('##FORMAT=<ID=GT,Number=1,Type=String,Description="">\n')
+		f.write('##FORMAT=<ID=Q,Number=1,Type=Float,Description="">\n')
+		f.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1\tS2\tS3\n")
+		# S2 is haploid (e.g. a male chrX call)
+		f.write("chrX\t100\t.\tACACAC\tACACACAC,ACAC\t.\t.\tEND=105;RU=AC;PERIOD=2;REF=3\tGT:Q\t0/1:1\t2:0.9\t1|1:0.8\n")
+	reader = cyvcf2.VCF(vcffile)
+	record = next(reader)
+	ro = recordcluster.RecordObj(record, trh.VcfTypes.gangstr, reader.samples)
+	# Haploid calls are skipped, as no calls
+	assert(ro.GetCalledAlleles() == set([0, 1]))
+	assert(ro.GetROSampleCall("S2")[0:2] == [-1, -1])
+	assert(ro.GetSampleString("S2") == "gangstr=.")
+	assert(ro.GetROSampleCall("S3") == [1, 1, True])
+	# Also when the caller is split into files with disjoint samples
+	allele_map = np.array([0, 1, 2, -1], dtype=np.int32)
+	ro = recordcluster.RecordObj(record, trh.VcfTypes.gangstr, reader.samples,
+	                             batches=[(record, allele_map, 3)])
+	assert(ro.GetCalledAlleles() == set([0, 1]))
+	assert(ro.GetSampleString("S2") == "gangstr=.")
+	# Calls of other ploidies are skipped too
+	genotypes, phased = recordcluster.GetDiploidGenotypes(np.array([[0, 1, -2, 1], [2, -2, -2, 0], [1, 1, 2, 0]]))
+	assert(genotypes.tolist() == [[0, 1], [-1, -1], [-1, -1]])
+	assert(phased.tolist() == [True, False, False])
+
+class FakeAllele:
+	def __init__(self, vcf_type, allele_size):
+		self.vcf_type = vcf_type
+		self.allele_size = allele_size
+	def GetVCFType(self):
+		return self.vcf_type
+
+def test_ClusterGraphComponents():
+	alleles = [FakeAllele(trh.VcfTypes.hipstr, 0), FakeAllele(trh.VcfTypes.hipstr, 2),
+	           FakeAllele(trh.VcfTypes.hipstr, 2), FakeAllele(trh.VcfTypes.gangstr, 0),
+	           FakeAllele(trh.VcfTypes.gangstr, 4), FakeAllele(trh.VcfTypes.eh, 0)]
+	graph = recordcluster.ClusterGraph.__new__(recordcluster.ClusterGraph)
+	graph.alleles = alleles
+	components = graph.GetComponents()
+	# Same size from several callers are connected, same size from a single caller are not
+	assert(components == [[alleles[0], alleles[3], alleles[5]], [alleles[1]], [alleles[2]], [alleles[4]]])
+
+def test_HipSTRAlleleFrequency(mergevcfs):
+	# Only the first record object of a cluster gives the frequencies
+	for vcfs, first_hipstr in [(mergevcfs["vcfs"], False), (mergevcfs["vcfs"][::-1], True)]:
+		readers = vcfio.Readers(vcfs, Fasta(mergevcfs["ref"]))
+		rc = readers.getMergableCalls().RecordClusters[0]
+		assert([ro.vcf_type.name for ro in rc.record_objs] == \
+			(["hipstr", "gangstr"] if first_hipstr else ["gangstr", "hipstr"]))
+		hipstr_ro = [ro for ro in rc.record_objs if ro.vcf_type.name == "hipstr"][0]
+		if first_hipstr:
+			assert(rc.hipstr_allele_frequency == rc.GetHipSTR_freqs(hipstr_ro))
+			assert(sum(rc.hipstr_allele_frequency.values()) > 0)
+		else:
+			assert(rc.hipstr_allele_frequency == {})
+
+def test_RecordResolverSampleDicts(mergevcfs):
+	readers = vcfio.Readers(mergevcfs["vcfs"], Fasta(mergevcfs["ref"]))
+	resolver = recordcluster.RecordResolver(readers.getMergableCalls().RecordClusters[0])
+	assert(resolver.sample_to_info == {})
+	assert(resolver.Resolve())
+	samples = resolver.record_cluster.samples
+	for name in ["resolved_prealleles", "resolution_score", "resolution_method",
+	             "allele_support", "sample_to_info", "empty_call"]:
+		assert(list(getattr(resolver, name).keys()) == samples)
+	for sample in samples:
+		assert(resolver.sample_to_info[sample]["GT"] == resolver.GetSampleGT(sample))
+		assert(resolver.sample_to_info[sample]["NCOPY"] == resolver.GetSampleNCOPY(sample))
+		score = resolver.resolution_score[sample]
+		assert(resolver.GetSampleScore(sample) == \
+			("." if score == -1 or resolver.empty_call[sample] else str(score)))
+	assert(len(set(resolver.resolution_score.values())) > 1)
+	resolver.Release()
+	assert(resolver.resolution_score == {})
+
+def scoresEqual(scores, i, j):
+	return all(caller_scores[i] == caller_scores[j] or \
+		(np.isnan(caller_scores[i]) and np.isnan(caller_scores[j])) for caller_scores in scores)
+
+def test_SignatureCache(mergevcfs, monkeypatch):
+	readers = vcfio.Readers(mergevcfs["vcfs"], Fasta(mergevcfs["ref"]))
+	rc = readers.getMergableCalls().RecordClusters[0]
+	graph = recordcluster.ClusterGraph(rc)
+	calls, scores = rc.GetCallArrays()
+	signatures = [tuple(row) for row in np.concatenate(calls, axis=1).tolist()]
+	num_signatures = len(set(signatures))
+	assert(1 < num_signatures < len(rc.samples))
+	table = recordcluster.ResolutionTable(graph, rc)
+	results = table.ResolveSamples(rc.samples, calls, scores)
+	assert(len(table.signature_cache) == num_signatures)
+	# Samples with the same calls get the same allele support, and
+	# the same result if their scores are also the same
+	pairs = [(i, j) for i in range(len(rc.samples)) for j in range(i) if signatures[i] == signatures[j]]
+	assert(len(pairs) > 0)
+	for i, j in pairs:
+		assert(results[i][3] == results[j][3])
+		if scoresEqual(scores, i, j):
+			assert(results[i] == results[j])
+	# Each sample resolved alone, without the cache
+	monkeypatch.setattr(recordcluster, "MAX_SIGNATURE_CACHE", 0)
+	uncached = recordcluster.ResolutionTable(graph, rc)
+	for i, sample in enumerate(rc.samples):
+		assert(uncached.ResolveSamples([sample], calls, scores, i) == [results[i]])
+	assert(uncached.signature_cache == {})
+	# A full cache still resolves new signatures, without adding them
+	monkeypatch.setattr(recordcluster, "MAX_SIGNATURE_CACHE", 2)
+	capped = recordcluster.ResolutionTable(graph, rc)
+	assert(capped.ResolveSamples(rc.samples, calls, scores) == results)
+	assert(len(capped.signature_cache) == 2)
+	assert(len(set(signatures) - set(capped.signature_cache)) == num_signatures - 2)
+	assert(capped.ResolveSamples(rc.samples, calls, scores) == results)
+	assert(len(capped.signature_cache) == 2)
@@ -0,0 +1,43 @@
+from .. import recordcluster
+from .. import samplepool
+from .. import vcfio
+
+import numpy as np
+from pyfaidx import Fasta
+
+def getRecordClusters(readers):
+	while not readers.done:
+		rc_list = readers.getMergableCalls().RecordClusters
+		rc_list.sort(key=lambda x: x.first_pos)
+		for rc in rc_list:
+			yield rc
+			readers.goToNext(rc.vcf_types)
+
+def test_SamplePool(mergevcfs):
+	# 12 samples in blocks of 5, the last block is shorter
+	pool = samplepool.SamplePool(2, 5)
+	readers = vcfio.Readers(mergevcfs["vcfs"], Fasta(mergevcfs["ref"]))
+	assert(len(readers.samples) == 12)
+	num_loci = 0
+	try:
+		for rc in getRecordClusters(readers):
+			resolver = recordcluster.RecordResolver(rc)
+			assert(resolver.Resolve())
+			table = recordcluster.ResolutionTable(resolver.rc_graph, rc)
+			calls, scores = rc.GetCallArrays()
+			assert(pool.ShouldShard(len(rc.samples)))
+			# Each locus replaces the tables of the previous one in the workers
+			assert(pool.ResolveSamples(table, rc.samples, calls, scores) == \
+				table.ResolveSamples(rc.samples, calls, scores))
+			pooled = recordcluster.RecordResolver(rc, pool)
+			assert(pooled.Resolve())
+			assert(pooled.GetFormatColumns() == resolver.GetFormatColumns())
+			columns = resolver.GetNumericColumns()
+			pooled_columns = pooled.GetNumericColumns()
+			for key in columns:
+				assert(np.array_equal(pooled_columns[key], columns[key], equal_nan=True))
+			num_loci += 1
+	finally:
+		pool.Close()
+	assert(num_loci == 8)
+	assert(pool.num_loci == 16)
@@ -3,4 +3,14 @@ import pytest
 
 def test_EHScore():
 	score = utils.GetEHScore("14-14/14-14", "14/14", 2)
-	assert(score == 1)
\ No newline at end of file
+	assert(score == 1)
+
+def test_EHScores():
+	conf_invs = ["14-14/14-14", "10-12/14-14", "1-200/3-3", "x-1/2-2"]
+	CNs = ["14/14", "11/14", "2/3", "1/2"]
+	scores = utils.GetEHScores(conf_invs[:3], CNs[:3], 2)
+	assert(scores[0] == 1)
+	assert(scores[1] == utils.CalcEHGenotypeScore(conf_invs[1], CNs[1], 2))
+	assert(scores[2] == 0.2)
+	with pytest.raises(ValueError):
+		utils.GetEHScores(conf_invs[3:], CNs[3:], 2)
@@ -0,0 +1,322 @@
+from .. import main
+from .. import vcfio
+
+import cyvcf2
+import json
+import numpy as np
+import os
+from pyfaidx import Fasta
+
+def test_GetRegionString():
+	assert(vcfio.GetRegionString(("chr1", 1, 100)) == "chr1:1-100")
+	assert(vcfio.GetRegionString(("chr1", 5000, None)) == "chr1:5000-")
+
+def test_GetMergeRegions(mergevcfs):
+	readers = vcfio.Readers(mergevcfs["vcfs"], Fasta(mergevcfs["ref"]))
+	vcffiles = [cyvcf2.VCF(vcfpath) for vcfpath in mergevcfs["vcfs"]]
+	spans = [(rec.CHROM, rec.POS, vcfio.GetRecordReach(rec, vcftype)) \
+		for vcffile, vcftype in zip(vcffiles, readers.file_vcftypes) for rec in vcffile]
+	# The first boundary of 38bp regions falls between the starts of the HipSTR
+	# and GangSTR records at chr2:38-121
+	region_size = 38
+	boundary_spans = [span for span in spans if span[0] == "chr2" and span[1] <= region_size + 1 <= span[2]]
+	assert(len(boundary_spans) > 0)
+	regions = vcfio.GetMergeRegions(mergevcfs["vcfs"], readers.file_vcftypes, readers.chroms,
+		readers.ref_genome, region_size)
+	assert([region[0] for region in regions][0] == "chr2")
+	assert(len([region for region in regions if region[0] == "chr2"]) > 2)
+	assert(regions[1][1] > max(span[2] for span in boundary_spans))
+	for chrom, start, end in regions:
+		assert(not any(span[0] == chrom and span[1] < start <= span[2] for span in spans))
+	# Regions of each chromosome are contiguous, the last one is open-ended
+	for chrom in readers.chroms:
+		chrom_regions = [region for region in regions if region[0] == chrom]
+		assert(chrom_regions[0][1] == 1 and chrom_regions[-1][2] is None)
+		assert(all(prev[2] + 1 == cur[1] for prev, cur in zip(chrom_regions, chrom_regions[1:])))
+
+def test_ReferenceCache(tmp_path):
+	fasta = os.path.join(str(tmp_path), "ref.fa")
+	with open(fasta, "w") as f:
+		f.write(">chr1\nacgtACGTac\ngtACGTACGT\n")
+	cache = vcfio.ReferenceCache(Fasta(fasta), window_size=8)
+	assert(cache.GetSequence("chr1", 2, 6) == "GTAC")
+	assert(cache.GetSequence("chr1", 4, 10) == "ACGTAC")
+	assert((cache.hits, cache.misses) == (1, 1))
+	assert(cache.GetSequence("chr1", 9, 12) == "CGT")
+	assert(cache.GetSequence("chr1", 16, 30) == "ACGT")
+	assert((cache.hits, cache.misses) == (1, 3))
+
+def test_GetSharedSamples():
+	samples = vcfio.GetSharedSamples([["S3", "S1", "S2"], ["S2", "S3"], ["S1", "S2", "S3", "S4"]])
+	assert(samples == ["S3", "S2"])
+	assert(vcfio.GetSharedSamples([["S1", "S2"]]) == ["S1", "S2"])
+	assert(list(vcfio.GetSampleColumns(samples, {"S2": 0, "S3": 1})) == [1, 0])
+
+class FakeRecord:
+	def __init__(self, chrom, pos, ref):
+		self.CHROM = chrom
+		self.POS = pos
+		self.REF = ref
+
+class FakeIndexedReader:
+	def __init__(self, records):
+		self.records = records
+		self.seqnames = sorted(set(rec.CHROM for rec in records))
+
+	def __call__(self, regstr):
+		chrom, start, end = vcfio.ParseRegion(regstr)
+		return [rec for rec in self.records if rec.CHROM == chrom and \
+		        rec.POS <= end and rec.POS + len(rec.REF) - 1 >= start]
+
+def test_GetTargetRecords(tmp_path):
+	assert(vcfio.ParseRegion("chr1:1,000-2,000") == ("chr1", 1000, 2000))
+	assert(vcfio.ParseRegion("chrX") == ("chrX", 1, None))
+	bed = os.path.join(str(tmp_path), "regions.bed")
+	with open(bed, "w") as f:
+		f.write("track name=test\nchr2\t0\t10\nchr1\t100\t200\n")
+	assert(vcfio.LoadRegionsFile(bed) == [("chr2", 1, 10), ("chr1", 101, 200)])
+	ranks = {"chr1": 0, "chr2": 1}
+	targets = vcfio.CoalesceRegions([("chr2", 5, 8), ("chr1", 30, 40), ("chr3", 1, 5),
+	                                 ("chr1", 10, 20), ("chr1", 21, 25), ("chr1", 15, 22)], ranks)
+	assert(targets == [("chr1", 10, 25), ("chr1", 30, 40), ("chr2", 5, 8)])
+	assert(vcfio.HasTargets(("chr1", 26, 29), targets) is False)
+	assert(vcfio.HasTargets(("chr1", 26, None), targets) is True)
+	reader = FakeIndexedReader([FakeRecord("chr1", 5, "A"*10), FakeRecord("chr1", 20, "A"*15),
+	                            FakeRecord("chr1", 28, "A"), FakeRecord("chr1", 38, "A"),
+	                            FakeRecord("chr2", 7, "A")])
+	# The record spanning both chr1 regions is only returned once
+	assert([(rec.CHROM, rec.POS) for rec in vcfio.GetTargetRecords(reader, targets)] == \
+	       [("chr1", 5), ("chr1", 20), ("chr1", 38), ("chr2", 7)])
+	assert([rec.POS for rec in vcfio.GetTargetRecords(reader, targets, region=("chr1", 10, 30))] == [20])
+	assert([rec.POS for rec in vcfio.GetTargetRecords(reader, targets, start=("chr1", 21))] == [38, 7])
+
+def test_GetBatchRecords():
+	file1 = [FakeRecord("chr1", 10, "AC"), FakeRecord("chr1", 20, "G"), FakeRecord("chr2", 5, "T")]
+	file2 = [FakeRecord("chr1", 10, "AC"), FakeRecord("chr1", 20, "GA"), FakeRecord("chr2", 5, "T")]
+	groups = list(vcfio.GetBatchRecords([iter(file1), iter(file2)], {"chr1": 0, "chr2": 1}))
+	assert([[rec is not None for rec in group] for group in groups] == \
+		[[True, True], [True, False], [False, True], [True, True]])
+	assert(groups[0] == [file1[0], file2[0]])
+	assert(groups[3] == [file1[2], file2[2]])
+	# Interleaved records, chr10 after chr2 as in the headers
+	file1 = [FakeRecord("chr2", 5, "A"), FakeRecord("chr2", 30, "AC"), FakeRecord("chr10", 2, "T")]
+	file2 = [FakeRecord("chr2", 10, "G"), FakeRecord("chr10", 1, "T"), FakeRecord("chr10", 2, "T")]
+	file3 = [FakeRecord("chr2", 30, "AC"), FakeRecord("chr10", 40, "C")]
+	groups = list(vcfio.GetBatchRecords([iter(file1), iter(file2), iter(file3)], {"chr2": 0, "chr10": 1}))
+	assert([[(rec.CHROM, rec.POS) if rec is not None else None for rec in group] for group in groups] == \
+		[[("chr2", 5), None, None], [None, ("chr2", 10), None], [("chr2", 30), None, ("chr2", 30)],
+		 [None, ("chr10", 1), None], [("chr10", 2), ("chr10", 2), None], [None, None, ("chr10", 40)]])
+
+def test_ReadersRecordHeap(tmp_path):
+	# chr10 comes after chr2 in the headers
+	refseqs = {"chr2": "GT"*4 + "AC"*5 + "GT"*40 + "T" + "AC"*4 + "AATAAT" + "GT"*20,
+	           "chr10": "GTGT" + "AC"*3 + "GT"*10 + "GTCAC" + "ACAC" + "GT"*5 + "AC"*4 + "GT"*10}
+	ref = os.path.join(str(tmp_path), "ref.fa")
+	with open(ref, "w") as f:
+		for chrom in ["chr2", "chr10"]:
+			f.write(">%s\n%s\n"%(chrom, refseqs[chrom]))
+	header = "##fileformat=VCFv4.2\n##contig=<ID=chr2,length=200>\n##contig=<ID=chr10,length=200>\n%s" + \
+		'##FORMAT=<ID=GT,Number=1,Type=String,Description="">\n' + \
+		"#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1\n"
+	gangstr = os.path.join(str(tmp_path), "gangstr.vcf")
+	with open(gangstr, "w") as f:
+		f.write(header%("##command=GangSTR\n" + \
+			'##INFO=<ID=END,Number=1,Type=Integer,Description="">\n' + \
+			'##INFO=<ID=RU,Number=1,Type=String,Description="">\n' + \
+			'##INFO=<ID=PERIOD,Number=1,Type=Integer,Description="">\n' + \
+			'##INFO=<ID=REF,Number=1,Type=Float,Description="">\n'))
+		for chrom, pos, copies in [("chr2", 9, 5), ("chr2", 100, 4), ("chr10", 5, 3), ("chr10", 44, 4)]:
+			f.write("%s\t%d\t.\t%s\t.\t.\t.\tEND=%d;RU=AC;PERIOD=2;REF=%d\tGT\t0/0\n"%(
+				chrom, pos, "AC"*copies, pos + 2*copies - 1, copies))
+	hipstr = os.path.join(str(tmp_path), "hipstr.vcf")
+	with open(hipstr, "w") as f:
+		f.write(header%("##command=HipSTR\n" + \
+			'##INFO=<ID=START,Number=1,Type=Integer,Description="">\n' + \
+			'##INFO=<ID=END,Number=1,Type=Integer,Description="">\n' + \
+			'##INFO=<ID=PERIOD,Number=1,Type=Integer,Description="">\n'))
+		# HipSTR records include 2bp of flank: the AAT repeat starts after the
+		# AC repeat at chr2:100 although its record starts before it
+		for chrom, pos, ref_allele, period in [("chr2", 7, "GT" + "AC"*5, 2), ("chr2", 99, "CA" + "CACAAATAAT", 3),
+		                                       ("chr10", 30, "AC" + "ACAC", 2)]:
+			f.write("%s\t%d\t%s_%d\t%s\t.\t.\t.\tSTART=%d;END=%d;PERIOD=%d\tGT\t0|0\n"%(
+				chrom, pos, chrom, pos + 2, ref_allele, pos + 2, pos + len(ref_allele) - 1, period))
+	readers = vcfio.Readers([gangstr, hipstr], Fasta(ref))
+	assert(readers.chroms == ["chr2", "chr10"])
+	clusters = []
+	num_stale = 0
+	while not readers.done:
+		rc_list = readers.getMergableCalls().RecordClusters
+		rc_list.sort(key=lambda x: x.first_pos)
+		for rc in rc_list:
+			clusters.append((rc.chrom, rc.first_pos, sorted(ro.vcf_type.name for ro in rc.record_objs)))
+			readers.goToNext(rc.vcf_types)
+			# Entries of readers that moved on stay in the heap until they reach the top
+			stale = [entry for entry in readers.record_heap if not readers.isCurrentEntry(entry)]
+			num_stale += len(stale)
+			if readers.done:
+				continue
+			assert(readers.isCurrentEntry(readers.record_heap[0]))
+			# Stale entries are skipped, only current records are in range
+			assert(len(set(readers.overlap_readers)) == len(readers.overlap_readers))
+			for i in readers.overlap_readers:
+				record = readers.current_tr_records[i].vcfrecord
+				assert(record.CHROM == readers.cur_range_chrom)
+				assert(readers.cur_range_start_pos <= record.POS <= readers.cur_range_end_pos)
+	assert(num_stale > 0)
+	assert(clusters == [("chr2", 9, ["gangstr", "hipstr"]), ("chr2", 100, ["gangstr"]),
+		("chr2", 101, ["hipstr"]), ("chr10", 5, ["gangstr"]), ("chr10", 32, ["hipstr"]),
+		("chr10", 44, ["gangstr"])])
+
+def test_SortedCompressedWriter(tmp_path):
+	out_path = os.path.join(str(tmp_path), "out.vcf.gz")
+	writer = vcfio.Writer(out_path, ["S1"], "test", chroms=["chr2", "chr1"],
+		sort_buffer_size=2, index="tbi")
+	records = [("chr1", 500), ("chr2", 300), ("chr1", 20), ("chr2", 100000), ("chr2", 40)]
+	writer.WriteRecords(["%s\t%d\t.\tAC\tACAC\t.\t.\t.\tGT\t0/1\n"%rec for rec in records])
+	assert(writer.sort_buffer.num_spilled > 0)
+	writer.Close()
+	assert(os.path.exists(out_path + ".tbi"))
+	reader = cyvcf2.VCF(out_path)
+	assert([(rec.CHROM, rec.POS) for rec in reader] == \
+		[("chr2", 40), ("chr2", 300), ("chr2", 100000), ("chr1", 20), ("chr1", 500)])
+	reader = cyvcf2.VCF(out_path)
+	assert([rec.POS for rec in reader("chr2:200-100000")] == [300, 100000])
+	assert([rec.POS for rec in reader("chr1:1-100")] == [20])
+
+def test_InputsMode(tmp_path):
+	headers = {}
+	for mode in vcfio.INPUTS_MODES:
+		out_path = os.path.join(str(tmp_path), "%s.vcf"%mode)
+		vcfio.Writer(out_path, ["S1"], "test", inputs_mode=mode).Close()
+		with open(out_path) as f:
+			headers[mode] = [line for line in f if "ID=INPUTS" in line]
+	assert("Raw calls\"" in headers["full"][0])
+	assert("allele indices" in headers["compact"][0])
+	assert(headers["none"] == [])
+
+def writeCallerVCFs(tmpdir):
+	ref = os.path.join(tmpdir, "ref.fa")
+	refseq = "GATTGCTCAG"*5 + "AC"*5 + "TGGTCAATGC"*5
+	with open(ref, "w") as f:
+		f.write(">chr1\n%s\n"%refseq)
+	header = "##fileformat=VCFv4.2\n##contig=<ID=chr1,length=%d>\n%s" + \
+		'##FORMAT=<ID=GT,Number=1,Type=String,Description="">\n' + \
+		'##FORMAT=<ID=Q,Number=1,Type=Float,Description="">\n' + \
+		"#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1\tS2\tS3\n"
+	gangstr = os.path.join(tmpdir, "gangstr.vcf")
+	with open(gangstr, "w") as f:
+		f.write(header%(len(refseq), "##command=GangSTR\n" + \
+			'##INFO=<ID=END,Number=1,Type=Integer,Description="">\n' + \
+			'##INFO=<ID=RU,Number=1,Type=String,Description="">\n' + \
+			'##INFO=<ID=PERIOD,Number=1,Type=Integer,Description="">\n' + \
+			'##INFO=<ID=REF,Number=1,Type=Float,Description="">\n'))
+		f.write("chr1\t51\t.\t%s\t%s,%s\t.\t.\tEND=60;RU=AC;PERIOD=2;REF=5\tGT:Q\t0/1:1\t./.:.\t2/2:0.9\n"%(
+			"AC"*5, "AC"*6, "AC"*3))
+	# HipSTR includes 2bp of flank
+	hipstr = os.path.join(tmpdir, "hipstr.vcf")
+	with open(hipstr, "w") as f:
+		f.write(header%(len(refseq), "##command=HipSTR\n" + \
+			'##INFO=<ID=START,Number=1,Type=Integer,Description="">\n' + \
+			'##INFO=<ID=END,Number=1,Type=Integer,Description="">\n' + \
+			'##INFO=<ID=PERIOD,Number=1,Type=Integer,Description="">\n'))
+		f.write("chr1\t49\tchr1_51\t%s\t%s\t.\t.\tSTART=51;END=60;PERIOD=2\tGT:Q\t1|1:1\t0|1:0.8\t.|.:.\n"%(
+			"AG" + "AC"*5, "AG" + "AC"*6))
+	return [gangstr, hipstr], ref
+
+def test_InputsModeRecords(tmp_path):
+	vcfs, ref = writeCallerVCFs(str(tmp_path))
+	records = {}
+	for mode in vcfio.INPUTS_MODES:
+		readers = vcfio.Readers(vcfs, Fasta(ref))
+		out_path = os.path.join(str(tmp_path), "%s.vcf"%mode)
+		writer = vcfio.Writer(out_path, readers.samples, "test", inputs_mode=mode)
+		main.MergeRecords(readers, writer)
+		writer.Close()
+		with open(out_path) as f:
+			records[mode] = [line.rstrip("\n").split("\t") for line in f if not line.startswith("#")]
+	assert(len(records["full"]) == 1)
+	assert(records["full"][0][8].endswith(":ALS:INPUTS"))
+	assert(records["full"][0][9].split(":")[-1] == "gangstr=5.0,6.0|hipstr=6.0,6.0")
+	# Allele indices of each input record, in the order of METHODS (HipSTR first)
+	assert(records["compact"][0][7].endswith("METHODS=0|0|1|1"))
+	assert(records["compact"][0][8] == records["full"][0][8])
+	assert([sample.split(":")[-1] for sample in records["compact"][0][9:]] == \
+		["1,1|0,1", "0,1|.", ".|2,2"])
+	# No INPUTS, the other fields are unchanged
+	assert(records["none"][0][8] == records["full"][0][8][0:-len(":INPUTS")])
+	assert([sample.count(":") for sample in records["none"][0][9:]] == [6, 6, 6])
+	assert([sample.rsplit(":", 1)[0] for sample in records["full"][0][9:]] == records["none"][0][9:])
+	assert(records["none"][0][0:8] == records["full"][0][0:8])
+
+def test_WriterHeader(tmp_path):
+	# A given header is written as is, before the sorted records
+	header = "##fileformat=VCFv4.2\n##FILTER=<ID=PASS,Description=\"All filters passed\">\n" + \
+		"##contig=<ID=chr1>\n" + \
+		'##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n' + \
+		"#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1\n"
+	line = "chr1\t%d\t.\tAC\t.\t.\t.\t.\tGT\t0/0\n"
+	for out_name in ["out.vcf", "out.vcf.gz"]:
+		out_path = os.path.join(str(tmp_path), out_name)
+		writer = vcfio.Writer(out_path, None, None, chroms=["chr1"], header=header,
+			index="tbi" if out_name.endswith(".gz") else None)
+		writer.WriteRecords([line%30, line%10])
+		writer.Close()
+		reader = cyvcf2.VCF(out_path)
+		assert(reader.raw_header == header)
+		assert([rec.POS for rec in reader] == [10, 30])
+
+def test_WriterResume(tmp_path):
+	out_path = os.path.join(str(tmp_path), "out.vcf.gz")
+	line = "chr1\t%d\t.\t%s\t.\t.\t.\t.\tGT\t0/0\n"
+	writer = vcfio.Writer(out_path, ["S1"], "test", chroms=["chr1"], index="tbi")
+	writer.WriteRecords([line%(10, "AC"), line%(10, "ACG")])
+	writer.FlushUpTo()
+	assert(writer.IsFlushed())
+	# The state is saved as JSON in the checkpoint journal
+	state = json.loads(json.dumps(writer.Sync()))
+	assert(state["last_positions"] == {"chr1": 10})
+	assert(state["blocks"]["compressed_size"] == state["offset"])
+	assert(state["index"]["extents"][0][2] == 2)
+	# Records written after the checkpoint are dropped on resume
+	writer.WriteRecords([line%(30, "AC")])
+	writer.FlushUpTo()
+	writer.vcf_writer.Sync()
+	writer = vcfio.Writer(out_path, ["S1"], "test", chroms=["chr1"], index="tbi", resume=state)
+	assert(writer.tabix_index.GetState() == state["index"])
+	assert(writer.vcf_writer.GetState() == state["blocks"])
+	writer.WriteRecords([line%(10, "ACGT"), line%(50, "AC")])
+	writer.Close()
+	reader = cyvcf2.VCF(out_path)
+	assert([(rec.POS, rec.REF) for rec in reader] == \
+		[(10, "AC"), (10, "ACG"), (10, "ACGT"), (50, "AC")])
+	reader = cyvcf2.VCF(out_path)
+	assert([rec.REF for rec in reader("chr1:10-10")] == ["AC", "ACG", "ACGT"])
+
+	# Resume reading after records at the same position
+	wrapper = vcfio.VCFWrapper([cyvcf2.VCF(out_path)], None)
+	wrapper.LoadRecords({"chr1": 0})
+	wrapper.NextRecords()
+	assert(wrapper.NextRecords()[0].REF == "ACG")
+	assert(wrapper.GetResumePosition() == ["chr1", 10, 1])
+	resumed = vcfio.VCFWrapper([cyvcf2.VCF(out_path)], None)
+	resumed.LoadRecords({"chr1": 0}, wrapper.GetResumePosition())
+	assert([recs[0].REF for recs in [resumed.NextRecords(), resumed.NextRecords()]] == ["ACG", "ACGT"])
+
+def test_Sidecar(tmp_path):
+	path = os.path.join(str(tmp_path), "sidecar")
+	sidecar = vcfio.SidecarWriter(path, ["S1", "S2"], chunk_size=2)
+	for i in range(3):
+		columns = {"gt": np.array([[0, 1], [-1, -1]], dtype=np.int16) + i,
+			"gb": np.zeros((2, 2), dtype=np.int32),
+			"ncopy": np.full((2, 2), i, dtype=np.float32),
+			"score": np.array([1, np.nan], dtype=np.float32),
+			"gts": np.array([5, 0], dtype=np.uint8)}
+		sidecar.AddRow(("chr1", 100*i, 100*i + 9, "AC", columns))
+	sidecar.Close()
+	manifest, loci, arrays = vcfio.OpenSidecar(path)
+	assert(manifest["num_loci"] == 3 and manifest["samples"] == ["S1", "S2"])
+	assert(loci[2] == ("chr1", 200, 209, "AC"))
+	assert([chunk.shape for chunk in arrays["gt"]] == [(2, 2, 2), (1, 2, 2)])
+	assert(isinstance(arrays["ncopy"][1], np.memmap))
+	assert(arrays["gt"][1][0].tolist() == [[2, 3], [1, 1]])
+	assert(np.isnan(arrays["score"][0][1, 1]))
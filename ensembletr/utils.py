@@ -2,7 +2,11 @@
 Various utilities used by EnsembleTR
 """
 
+import logging
 import math
+import numpy as np
+
+log = logging.getLogger(__name__)
 
 def GetEHScore(conf_invs, CNs, ru_len):
     r"""
@@ -17,6 +21,76 @@ def GetEHScore(conf_invs, CNs, ru_len):
     ru_len : int
         Repeat unit length (bp)
 
+    Returns
+    -------
+    score : float
+        Confidence score. 0=low, 1=high
+    """
+    return float(GetEHScores([conf_invs], [CNs], ru_len)[0])
+
+def GetEHScores(conf_invs, CNs, ru_len):
+    r"""
+    Compute confidence scores for the EH genotypes
+    of many samples at once
+
+    Well-formed entries ("low-high/low-high" and "CN/CN")
+    are parsed and scored with numpy. Other entries
+    are scored one by one with CalcEHGenotypeScore.
+
+    Parameters
+    ----------
+    conf_invs : list of str
+        FORMAT/REPCI field from EH for each sample
+    CNs : list of str
+        FORMAT/REPCN field from EH for each sample
+    ru_len : int
+        Repeat unit length (bp)
+
+    Returns
+    -------
+    scores : np.ndarray
+        Confidence score of each sample. 0=low, 1=high
+    """
+    conf_invs = np.asarray(conf_invs, dtype=str)
+    CNs = np.asarray(CNs, dtype=str)
+    scores = np.zeros(len(CNs), dtype=np.float64)
+    simple = (np.char.count(CNs, "/") == 1) & \
+             (np.char.count(conf_invs, "/") == 1) & \
+             (np.char.count(conf_invs, "-") == 2)
+    simple_idx = np.flatnonzero(simple)
+    other_idx = np.flatnonzero(~simple)
+    if len(simple_idx) > 0:
+        try:
+            alleles = np.array("/".join(CNs[simple_idx]).split("/")).astype(np.int64)
+            bounds = np.array("/".join(conf_invs[simple_idx]).replace("-", "/").split("/")).astype(np.int64)
+        except ValueError:
+            # Malformed numbers, fall back to scoring one by one
+            other_idx = np.arange(len(CNs))
+        else:
+            alleles = alleles.reshape(-1, 2) * ru_len
+            bounds = bounds.reshape(-1, 4)
+            dists = np.abs(bounds[:, [0, 2]] - bounds[:, [1, 3]])
+            allele_scores = CalcEHAlleleScores(dists, alleles)
+            scores[simple_idx] = 0.8 * np.min(allele_scores, axis=1) + \
+                                 0.2 * np.max(allele_scores, axis=1)
+    for i in other_idx:
+        scores[i] = CalcEHGenotypeScore(conf_invs[i], CNs[i], ru_len)
+    return scores
+
+def CalcEHGenotypeScore(conf_invs, CNs, ru_len):
+    r"""
+    Compute a confidence score for an EH genotype
+    by parsing its fields one at a time
+
+    Parameters
+    ----------
+    conf_invs : str
+        FORMAT/REPCI field from EH
+    CNs : str
+        FORMAT/REPCN field from EH
+    ru_len : int
+        Repeat unit length (bp)
+
     Returns
     -------
     score : float
@@ -27,12 +101,43 @@ def GetEHScore(conf_invs, CNs, ru_len):
     try:
         CNs = [(int(CN) * ru_len) for CN in CNs]
     except:
-        print(f"Invalid copy numbers or intervals: {CNs}, {conf_invs}")
+        log.warning("Invalid copy numbers or intervals: %s, %s", CNs, conf_invs)
         return 0
     score1 = CalcEHAlleleScore(conf_invs[0], CNs[0])
     score2 = CalcEHAlleleScore(conf_invs[1], CNs[1])
     return 0.8 * min(score1, score2) + 0.2 * max(score1, score2)
 
+def CalcEHAlleleScores(dists, alleles):
+    r"""
+    Compute allele-specific scores for
+    EH genotypes, same as CalcEHAlleleScore
+
+    Parameters
+    ----------
+    dists : np.ndarray
+       Width of the confidence interval of each allele
+    alleles : np.ndarray
+       Inferred allele (bp) of each allele
+
+    Returns
+    -------
+    scores : np.ndarray
+       Confidence score of each allele. 0=low, 1=high
+    """
+    scores = np.zeros(dists.shape, dtype=np.float64)
+    keep = dists <= 100
+    dists = dists[keep]
+    alleles = alleles[keep]
+    exponents = np.where(alleles == 0, 4 * dists, 0).astype(np.float64)
+    nonzero = alleles != 0
+    exponents[nonzero] = (4 * dists[nonzero]) / alleles[nonzero]
+    # Only a handful of distinct values, use math.exp on each
+    # of them to get exactly the same scores as CalcEHAlleleScore
+    values, inverse = np.unique(exponents, return_inverse=True)
+    values = np.array([1/math.exp(value) for value in values.tolist()], dtype=np.float64)
+    scores[keep] = values[inverse.reshape(-1)]
+    return scores
+
 def CalcEHAlleleScore(conf_inv, allele):
     r"""
     Compute an allele-specific score for
@@ -5,12 +5,26 @@ VCF files.
 
 import trtools.utils.common as common
 import trtools.utils.utils as utils
-import trtools.utils.mergeutils as mergeutils
 import trtools.utils.tr_harmonizer as trh
+from array import array
+import bisect
+import gzip
+from concurrent.futures import ThreadPoolExecutor
 import cyvcf2
+import heapq
+import json
+import logging
+import numpy as np
+import os
+import pickle
+import struct
+import tempfile
+import zlib
 
+from . import profiling as profiling
 from . import recordcluster as recordcluster
 
+log = logging.getLogger(__name__)
 
 convert_type_to_idx = {trh.VcfTypes.advntr: 0,
                        trh.VcfTypes.eh: 1,
@@ -18,6 +32,47 @@ convert_type_to_idx = {trh.VcfTypes.advntr: 0,
                        trh.VcfTypes.gangstr: 3,
                        }
 
+# Records starting this far before a candidate split position
+# are checked for overlap with it
+SPLIT_MARGIN = 10000
+# Initial window (bp) searched for a split position
+SPLIT_SEARCH_SIZE = 10000
+# Size (bp) of the reference sequence kept in memory
+REF_WINDOW_SIZE = 100000
+# Output records kept in memory for sorting before spilling to disk
+SORT_BUFFER_SIZE = 100000
+# Fewest buffered output records spilled to disk when over the memory budget
+SPILL_MIN_RECORDS = 100
+# Size (bytes) of the buffer of the output file
+OUTPUT_BUFFER_SIZE = 4*1024*1024
+# Uncompressed size of a BGZF block (as in htslib)
+BGZF_BLOCK_SIZE = 0xff00
+# Empty BGZF block marking the end of the file
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+# Encodings of the INPUTS FORMAT field (see Writer)
+INPUTS_MODES = ["full", "compact", "none"]
+# Loci per chunk of the binary sidecar
+SIDECAR_CHUNK_SIZE = 1000
+# Arrays of the binary sidecar (see recordcluster.RecordResolver.GetNumericColumns)
+SIDECAR_ARRAYS = ["gt", "gb", "ncopy", "score", "gts"]
+SIDECAR_ARRAYS_INFO = {
+    "gt": {"dtype": "int16", "shape": ["loci", "samples", 2], "missing": -1,
+           "description": "Allele indices of the consensus genotype (GT)"},
+    "gb": {"dtype": "int32", "shape": ["loci", "samples", 2], "missing": int(recordcluster.GB_MISSING),
+           "description": "Base pair difference of each allele from the reference (GB)"},
+    "ncopy": {"dtype": "float32", "shape": ["loci", "samples", 2], "missing": "nan",
+              "description": "Copy number of each allele (NCOPY)"},
+    "score": {"dtype": "float32", "shape": ["loci", "samples"], "missing": "nan",
+              "description": "Score of the consensus call (SCORE)"},
+    "gts": {"dtype": "uint8", "shape": ["loci", "samples"], "missing": 0,
+            "description": "Bitmask of the methods supporting the consensus call (GTS), "
+                           "bit i for methods[i]"},
+}
+# Binning scheme of tabix (.tbi) and CSI indexes
+INDEX_MIN_SHIFT = 14
+TBI_DEPTH = 5
+CSI_DEPTH = 6
+
 ##################################################
 #
 #       Reader classes
@@ -29,23 +84,525 @@ class VCFWrapper:
     Simple class to keep track of VCF files and
     associated attributes
 
+    A caller can be split into several VCF files with
+    disjoint samples (e.g. one file per batch of samples).
+    Their records are merged on the fly.
+
     Parameters
     ----------
-    reader : cyvcf2.VCF
-       VCF Reader
+    readers : list of cyvcf2.VCF
+       VCF Readers of the caller
     vcftype : trh.TRRecordHarmonizer.vcftype
        Type of the VCF file (e.g. Hipstr, GangSTR, etc.)
+    region : (str, int, int), optional
+       Only iterate over records starting in this region
 
     Attributes
     ----------
     vcfreader : cyvcf2.VCF
-       VCF Reader
+       First VCF Reader
+    vcfreaders : list of cyvcf2.VCF
+       All VCF Readers of the caller
     vcftype : trh.TRRecordHarmonizer.vcftype
        Type of the VCF file (e.g. Hipstr, GangSTR, etc.)
+    samples : list of str
+       Samples of all readers, concatenated in reader order
+    batch_sizes : list of int
+       Number of samples of each reader
+    records : iterator of list of cyvcf2.Variant
+       Records to be merged, one entry per reader (None if the
+       reader has no record at that locus). Either the whole files
+       or only the records starting in a region. Set by LoadRecords.
+    head_locus : (str, int)
+       CHROM and POS of the last records returned by NextRecords
+    head_skip : int
+       Number of records returned by NextRecords at head_locus
+       before the last ones
     """
-    def __init__(self, reader, vcftype):
-        self.vcfreader = reader
+    def __init__(self, readers, vcftype, region=None):
+        self.vcfreaders = readers
+        self.vcfreader = readers[0]
         self.vcftype = vcftype
+        self.region = region
+        self.samples = [sample for reader in readers for sample in reader.samples]
+        self.batch_sizes = [len(reader.samples) for reader in readers]
+        self.records = None
+        self.head_locus = None
+        self.head_skip = 0
+
+    def LoadRecords(self, chrom_ranks, start=None, targets=None):
+        r"""
+        Start iterating over the records
+
+        Parameters
+        ----------
+        chrom_ranks : dict of str: int
+           Merge order of each chromosome
+        start : (str, int, int), optional
+           Resume from a position returned by GetResumePosition
+           (chrom, pos, records to skip at pos). Requires indexed VCFs.
+        targets : list of (str, int, int), optional
+           Only iterate over records overlapping these regions,
+           coalesced and in merge order (see CoalesceRegions).
+           Requires indexed VCFs.
+        """
+        if targets is not None:
+            iterators = [GetTargetRecords(reader, targets, self.region, start) \
+                         for reader in self.vcfreaders]
+        elif start is not None:
+            chroms = sorted(chrom_ranks, key=chrom_ranks.get)
+            iterators = [GetRecordsFrom(reader, chroms, start[0], start[1]) \
+                         for reader in self.vcfreaders]
+        elif self.region is None:
+            iterators = self.vcfreaders
+        else:
+            iterators = [GetRegionRecords(reader, self.region) for reader in self.vcfreaders]
+        if len(iterators) == 1:
+            self.records = ([rec] for rec in iterators[0])
+        else:
+            self.records = GetBatchRecords(iterators, chrom_ranks)
+        if start is not None:
+            for i in range(start[2]):
+                self.NextRecords()
+
+    def NextRecords(self):
+        r"""
+        Get the records of the next locus
+
+        Returns
+        -------
+        records : list of cyvcf2.Variant
+           Records of each reader (None if the reader
+           has no record at that locus)
+
+        Raises
+        ------
+        StopIteration
+           At the end of the files
+        """
+        records = next(self.records)
+        rec = next(rec for rec in records if rec is not None)
+        if self.head_locus == (rec.CHROM, rec.POS):
+            self.head_skip += 1
+        else:
+            self.head_locus = (rec.CHROM, rec.POS)
+            self.head_skip = 0
+        return records
+
+    def GetResumePosition(self):
+        r"""
+        Get the position to resume from to return the
+        last records of NextRecords again
+
+        Returns
+        -------
+        start : [str, int, int]
+           Chrom, pos and number of records to skip at pos
+           (see LoadRecords)
+        """
+        return [self.head_locus[0], self.head_locus[1], self.head_skip]
+
+def GetBatchRecords(iterators, chrom_ranks):
+    r"""
+    Merge sorted records of VCF files with different samples
+
+    Records at the same locus (CHROM, POS and REF) in
+    several files are returned together.
+
+    Parameters
+    ----------
+    iterators : list of iterator of cyvcf2.Variant
+       Sorted records of each file
+    chrom_ranks : dict of str: int
+       Merge order of each chromosome
+
+    Returns
+    -------
+    records : iterator of list of cyvcf2.Variant
+       Records of each locus, one entry per file
+       (None if the file has no record at the locus)
+    """
+    heap = []
+    counter = 0
+    def push(i):
+        nonlocal counter
+        rec = next(iterators[i], None)
+        if rec is not None:
+            # Unknown chromosomes come last, Readers reports them
+            rank = chrom_ranks.get(rec.CHROM, len(chrom_ranks))
+            heapq.heappush(heap, (rank, rec.POS, rec.REF, i, counter, rec))
+            counter += 1
+    for i in range(len(iterators)):
+        push(i)
+    while len(heap) > 0:
+        entry = heapq.heappop(heap)
+        group = [None] * len(iterators)
+        group[entry[3]] = entry[5]
+        push(entry[3])
+        while len(heap) > 0 and heap[0][0:3] == entry[0:3]:
+            if group[heap[0][3]] is not None:
+                break # same locus twice in one file
+            other = heapq.heappop(heap)
+            group[other[3]] = other[5]
+            push(other[3])
+        yield group
+
+def GetRegionString(region):
+    r"""
+    Get a region string usable for indexed VCF queries
+
+    Parameters
+    ----------
+    region : (str, int, int)
+       Chromosome, 1-based start and inclusive end of the region.
+       End may be None to go to the end of the chromosome.
+
+    Returns
+    -------
+    regstr : str
+       Region in chrom:start-end format
+    """
+    chrom, start, end = region
+    if end is None:
+        return "%s:%d-"%(chrom, start)
+    return "%s:%d-%d"%(chrom, start, end)
+
+def ParseRegion(regstr):
+    r"""
+    Parse a region given on the command line
+
+    Parameters
+    ----------
+    regstr : str
+       Region as chrom:start-end (1-based, inclusive)
+       or chrom for a whole chromosome
+
+    Returns
+    -------
+    region : (str, int, int)
+       Chromosome, 1-based start and inclusive end of the region.
+       End is None for a whole chromosome.
+    """
+    if ":" not in regstr:
+        return (regstr, 1, None)
+    chrom, coords = regstr.rsplit(":", 1)
+    try:
+        start, end = [int(coord.replace(",", "")) for coord in coords.split("-")]
+    except ValueError:
+        common.WARNING("Error: invalid region %s, expected chrom:start-end"%regstr)
+        raise ValueError('Invalid region.')
+    if len(chrom) == 0 or start < 1 or end < start:
+        common.WARNING("Error: invalid region %s, expected chrom:start-end"%regstr)
+        raise ValueError('Invalid region.')
+    return (chrom, start, end)
+
+def LoadRegionsFile(path):
+    r"""
+    Load regions from a BED file (may be gzipped)
+
+    Parameters
+    ----------
+    path : str
+       Path to the BED file. Only the first three columns are used.
+
+    Returns
+    -------
+    regions : list of (str, int, int)
+       Chromosome, 1-based start and inclusive end of each region
+    """
+    regions = []
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt") as f:
+        for linenum, line in enumerate(f, 1):
+            if line.strip() == "" or line.startswith(("#", "track", "browser")):
+                continue
+            fields = line.split("\t")
+            try:
+                chrom, start, end = fields[0], int(fields[1]), int(fields[2])
+            except (IndexError, ValueError):
+                common.WARNING("Error: line %d of %s is not a BED record"%(linenum, path))
+                raise ValueError('Invalid BED file.')
+            if start < 0 or end <= start:
+                common.WARNING("Error: line %d of %s has an empty or negative interval"%(linenum, path))
+                raise ValueError('Invalid BED file.')
+            # BED is 0-based, end exclusive
+            regions.append((chrom, start + 1, end))
+    return regions
+
+def CoalesceRegions(regions, chrom_ranks):
+    r"""
+    Sort regions in merge order and join overlapping
+    or adjacent ones
+
+    Parameters
+    ----------
+    regions : list of (str, int, int)
+       Chromosome, 1-based start and inclusive end (None for the
+       end of the chromosome) of each region
+    chrom_ranks : dict of str: int
+       Merge order of each chromosome. Regions on other
+       chromosomes are dropped.
+
+    Returns
+    -------
+    coalesced : list of (str, int, int)
+       Disjoint, non-adjacent regions in merge order
+    """
+    unknown = sorted(set(region[0] for region in regions if region[0] not in chrom_ranks))
+    if len(unknown) > 0:
+        log.warning("Ignoring regions on chromosomes absent from the inputs: %s", ", ".join(unknown))
+    coalesced = []
+    for chrom, start, end in sorted([region for region in regions if region[0] in chrom_ranks],
+                                    key=lambda region: (chrom_ranks[region[0]], region[1])):
+        if len(coalesced) > 0 and coalesced[-1][0] == chrom and \
+           (coalesced[-1][2] is None or start <= coalesced[-1][2] + 1):
+            prev_end = coalesced[-1][2]
+            if prev_end is not None and (end is None or end > prev_end):
+                coalesced[-1] = (chrom, coalesced[-1][1], end)
+            continue
+        coalesced.append((chrom, start, end))
+    return coalesced
+
+def HasTargets(region, targets):
+    r"""
+    Check if a region overlaps any target region
+
+    Parameters
+    ----------
+    region : (str, int, int)
+       Chromosome, 1-based start and inclusive end
+       (None for the end of the chromosome)
+    targets : list of (str, int, int)
+       Target regions, same format
+
+    Returns
+    -------
+    overlaps : bool
+       True if a target overlaps the region
+    """
+    chrom, start, end = region
+    for target_chrom, target_start, target_end in targets:
+        if target_chrom == chrom and (target_end is None or target_end >= start) and \
+           (end is None or target_start <= end):
+            return True
+    return False
+
+def GetRegionRecords(reader, region):
+    r"""
+    Iterate over records starting inside a region
+
+    Indexed queries also return records that start before the region
+    but overlap it. Those are skipped so that every record is
+    assigned to exactly one region.
+
+    Parameters
+    ----------
+    reader : cyvcf2.VCF
+       Indexed VCF reader
+    region : (str, int, int)
+       Chromosome, 1-based start and inclusive end of the region
+
+    Returns
+    -------
+    records : iterator of cyvcf2.Variant
+       Records with POS inside the region
+    """
+    chrom, start, end = region
+    if chrom not in reader.seqnames:
+        return
+    for rec in reader(GetRegionString(region)):
+        if rec.POS < start:
+            continue
+        if end is not None and rec.POS > end:
+            break
+        yield rec
+
+def GetRecordsFrom(reader, chroms, chrom, pos):
+    r"""
+    Iterate over records starting at or after a position
+
+    Parameters
+    ----------
+    reader : cyvcf2.VCF
+       Indexed VCF reader
+    chroms : list of str
+       Chromosomes in the order of the file
+    chrom : str
+       Chromosome of the first record
+    pos : int
+       Smallest POS of records of chrom
+
+    Returns
+    -------
+    records : iterator of cyvcf2.Variant
+       Records from the position to the end of the file
+    """
+    first = chroms.index(chrom)
+    for i in range(first, len(chroms)):
+        yield from GetRegionRecords(reader, (chroms[i], pos if i == first else 1, None))
+
+def GetTargetRecords(reader, targets, region=None, start=None):
+    r"""
+    Iterate over records overlapping target regions
+
+    Each region is fetched with an indexed query. A record overlapping
+    several regions is only returned by the first one: regions are
+    disjoint and sorted, so it is one that starts at or before the
+    end of the previous region.
+
+    Parameters
+    ----------
+    reader : cyvcf2.VCF
+       Indexed VCF reader
+    targets : list of (str, int, int)
+       Coalesced regions in merge order (see CoalesceRegions)
+    region : (str, int, int), optional
+       Only return records starting inside this region
+    start : (str, int, ...), optional
+       Only return records at or after this chromosome and
+       position, e.g. to resume a merge
+
+    Returns
+    -------
+    records : iterator of cyvcf2.Variant
+       Records overlapping the target regions, in file order
+    """
+    prev_chrom, prev_end = None, None
+    started = start is None
+    for target in targets:
+        chrom, target_start, target_end = target
+        if not started:
+            if chrom != start[0]:
+                continue
+            started = True
+        if region is not None and (chrom != region[0] or \
+           (target_end is not None and target_end < region[1]) or \
+           (region[2] is not None and target_start > region[2])):
+            continue
+        if chrom not in reader.seqnames:
+            continue
+        for rec in reader(GetRegionString(target)):
+            if chrom == prev_chrom and rec.POS <= prev_end:
+                continue
+            if region is not None and rec.POS < region[1]:
+                continue
+            if region is not None and region[2] is not None and rec.POS > region[2]:
+                break
+            if start is not None and chrom == start[0] and rec.POS < start[1]:
+                continue
+            yield rec
+        prev_chrom, prev_end = chrom, target_end
+
+class ReaderRecord:
+    """
+    Current record of a VCF reader. It is harmonized once
+    and reused until the reader moves to its next record.
+
+    Parameters
+    ----------
+    vcfrecords : list of cyvcf2.Variant
+       Raw VCF records of the locus, one per file of the caller
+       (None for files without the locus)
+    vcftype : trh.VcfTypes
+       Type of the VCF file
+    batch_sizes : list of int
+       Number of samples of each file
+
+    Attributes
+    ----------
+    vcfrecord : cyvcf2.Variant
+       Raw VCF record (first file with the locus)
+    hm_record : trh.TRRecord
+       Harmonized record. With several files,
+       holds the alleles of all of them
+    batches : list of (cyvcf2.Variant, np.ndarray, int)
+       With several files, record, allele index map and number
+       of samples of each file (see recordcluster.RecordObj).
+       None with a single file.
+    canonical_motif : str
+       Canonical repeat motif
+    pos : int
+       1-based start position of the harmonized record
+    """
+    @profiling.Timed("harmonize")
+    def __init__(self, vcfrecords, vcftype, batch_sizes):
+        self.batches = None
+        if len(vcfrecords) == 1:
+            self.vcfrecord = vcfrecords[0]
+            self.hm_record = trh.HarmonizeRecord(vcftype, self.vcfrecord)
+        else:
+            hm_records = [None if rec is None else trh.HarmonizeRecord(vcftype, rec) \
+                          for rec in vcfrecords]
+            self.hm_record, allele_maps = recordcluster.MergeBatchRecords(hm_records)
+            self.vcfrecord = self.hm_record.vcfrecord
+            self.batches = list(zip(vcfrecords, allele_maps, batch_sizes))
+        self.canonical_motif = utils.GetCanonicalMotif(self.hm_record.motif)
+        self.pos = recordcluster.GetHarmonizedPosition(self.hm_record, vcftype)
+
+class ReferenceCache:
+    """
+    Serves reference sequence slices from a window of
+    decoded sequence kept in memory.
+
+    Records are visited in sorted order, so the window only
+    moves forward: a slice outside of it loads a new window
+    starting at the slice.
+
+    Parameters
+    ----------
+    ref_genome : pyfaidx.Fasta
+       Reference genome
+    window_size : int
+       Size (bp) of the window loaded on a miss
+
+    Attributes
+    ----------
+    hits : int
+       Number of slices served from the window
+    misses : int
+       Number of slices that loaded a new window
+    """
+    def __init__(self, ref_genome, window_size=REF_WINDOW_SIZE):
+        self.ref_genome = ref_genome
+        self.window_size = window_size
+        self.chrom = None
+        self.window_start = 0
+        self.window_end = 0
+        self.window_seq = ''
+        self.hits = 0
+        self.misses = 0
+
+    @profiling.Timed("reference_fetch")
+    def GetSequence(self, chrom, start, end):
+        r"""
+        Get an uppercase slice of the reference genome
+
+        Parameters
+        ----------
+        chrom : str
+           Chromosome
+        start : int
+           0-based start of the slice
+        end : int
+           0-based end of the slice (exclusive)
+
+        Returns
+        -------
+        seq : str
+           Uppercase reference sequence
+        """
+        if start < 0 or end < start:
+            return self.ref_genome[chrom][start:end].seq.upper()
+        if chrom == self.chrom and start >= self.window_start and end <= self.window_end:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.chrom = chrom
+            self.window_start = start
+            self.window_seq = self.ref_genome[chrom][start:max(end, start + self.window_size)].seq.upper()
+            # Shorter than requested at the end of the chromosome
+            self.window_end = start + len(self.window_seq)
+        return self.window_seq[start - self.window_start:end - self.window_start]
 
 class Readers:
     """
@@ -57,161 +614,288 @@ class Readers:
        List of paths to each of the input VCF files
     ref_genome : pyfaidx.Fasta
        Reference genome
+    region : (str, int, int), optional
+       Only merge records starting in this region
+       (chrom, 1-based start, inclusive end). Requires indexed VCFs.
+    samples : list of str, optional
+       Samples to load. By default the samples shared by all callers.
+    ref_window_size : int, optional
+       Size (bp) of the reference window kept in memory
+    resume_positions : list, optional
+       Resume from positions returned by GetResumePositions
+       instead of the start of the files. Requires indexed VCFs.
+    targets : list of (str, int, int), optional
+       Only merge records overlapping these regions (chrom, 1-based
+       start, inclusive end). Each input is queried through its index
+       for each region. Regions may overlap and come in any order.
 
     Attributes
     ----------
     ref_genome : pyfaidx.Fasta
        Reference genome
+    ref_cache : ReferenceCache
+       Cached access to the reference genome used by record clusters
     vcfwrappers : list of VCFWrapper
-       VCF wrappers for each input VCF 
+       VCF wrappers for each caller. Input VCFs of the
+       same caller must have disjoint samples.
+    file_vcftypes : list of trh.VcfTypes
+       Type of each input VCF
     samples : list of str
-       Samples shared by input VCF files
+       Samples shared by all callers, in the order of the first caller.
+       This is the order of the output columns.
+    sample_columns_list : list of np.ndarray
+       For each caller, column of each output sample in its VCFs
+    chroms : list of str
+       Contigs of all input VCF files, in the order they
+       first appear in the headers
+    targets : list of (str, int, int)
+       Target regions, coalesced and in merge order
+       (see CoalesceRegions). None to merge everything.
     """
-    def __init__(self, vcfpaths, ref_genome):
+    def __init__(self, vcfpaths, ref_genome, region=None, samples=None,
+                 ref_window_size=REF_WINDOW_SIZE, resume_positions=None, targets=None):
         self.ref_genome = ref_genome
+        self.ref_cache = ReferenceCache(ref_genome, ref_window_size)
         self.vcfwrappers = []
         self.samples = []
 
-        # first pass, determine shared samples across all vcf files
-        for invcf in vcfpaths:
-            vcffile = cyvcf2.VCF(invcf)
-            hm = trh.TRRecordHarmonizer(vcffile)
-            if len(self.samples) == 0:
-                self.samples = vcffile.samples
-            else:
-                # setting sample list to overlap of sample lists
-                self.samples = list(set(self.samples).intersection(set(vcffile.samples)))
-        # Second pass, only load the shared samples
-        for invcf in vcfpaths:
-            vcffile = cyvcf2.VCF(invcf, samples = self.samples)
-            hm = trh.TRRecordHarmonizer(vcffile)
-            self.vcfwrappers.append(VCFWrapper(vcffile, hm.vcftype))
+        # Open each file once. Samples are taken from the headers
+        vcffiles = [cyvcf2.VCF(invcf) for invcf in vcfpaths]
+        self.file_vcftypes = [trh.TRRecordHarmonizer(vcffile).vcftype for vcffile in vcffiles]
+        # Files of the same caller hold different samples
+        # and are merged on the fly
+        type_files = {}
+        for vcffile, vcftype in zip(vcffiles, self.file_vcftypes):
+            type_files.setdefault(vcftype, []).append(vcffile)
+        caller_samples = []
+        for vcftype, files in type_files.items():
+            batch_samples = [sample for vcffile in files for sample in vcffile.samples]
+            if len(set(batch_samples)) != len(batch_samples):
+                common.WARNING("Error: found the same sample in several VCF files of %s"%vcftype.name)
+                raise ValueError('Duplicate samples in VCF files of the same caller.')
+            caller_samples.append(batch_samples)
+        if samples is not None:
+            self.samples = samples
+        else:
+            self.samples = GetSharedSamples(caller_samples)
+        shared = set(self.samples)
+        for vcftype, files in type_files.items():
+            for vcffile in files:
+                # Only decode the shared samples
+                file_samples = [sample for sample in vcffile.samples if sample in shared]
+                if len(file_samples) != len(vcffile.samples):
+                    vcffile.set_samples(file_samples)
+            self.vcfwrappers.append(VCFWrapper(files, vcftype, region))
         # Get chroms and check if valid
+        # Keep header order so that records are always
+        # visited in the same order
         self.chroms = []
+        seen_chroms = set()
         for wrapp in self.vcfwrappers:
-            if len(self.chroms) == 0:
-                self.chroms = utils.GetContigs(wrapp.vcfreader)
-            else:
-                self.chroms = list(set(self.chroms) | set(utils.GetContigs(wrapp.vcfreader)))
+            for reader in wrapp.vcfreaders:
+                for chrom in utils.GetContigs(reader):
+                    if chrom not in seen_chroms:
+                        seen_chroms.add(chrom)
+                        self.chroms.append(chrom)
+        self.chrom_ranks = {chrom: i for i, chrom in enumerate(self.chroms)}
+        self.targets = None
+        if targets is not None:
+            self.targets = CoalesceRegions(targets, self.chrom_ranks)
 
         # Load current records
         self.current_tr_records = []
         self.samples_list = []
-        for wrapper in self.vcfwrappers:
-            self.samples_list.append(wrapper.vcfreader.samples)
-            try:
-                new_record = trh.HarmonizeRecord(wrapper.vcftype, next(wrapper.vcfreader))
-                self.current_tr_records.append(new_record)
-            except StopIteration:
+        self.sample_index_list = []
+        self.sample_columns_list = []
+        for i, wrapper in enumerate(self.vcfwrappers):
+            sample_index = recordcluster.GetSampleIndex(wrapper.samples)
+            self.samples_list.append(wrapper.samples)
+            self.sample_index_list.append(sample_index)
+            self.sample_columns_list.append(GetSampleColumns(self.samples, sample_index))
+            if resume_positions is None:
+                wrapper.LoadRecords(self.chrom_ranks, targets=self.targets)
+            elif resume_positions[i] is None:
+                # The reader was done
                 self.current_tr_records.append(None)
+                continue
+            else:
+                wrapper.LoadRecords(self.chrom_ranks, resume_positions[i], self.targets)
+            self.current_tr_records.append(self.readNextRecord(wrapper))
 
-        if not self.areChromsValid():
-            raise ValueError('Invalid CHROM detected in record.')
+        # Priority queue of the current record of each reader,
+        # keyed on (contig rank, position). Entries of readers
+        # that moved on are skipped (see isCurrentEntry).
+        self.record_heap = []
+        self.record_versions = [0] * len(self.vcfwrappers)
+        self.type_readers = {}
+        for i, wrapper in enumerate(self.vcfwrappers):
+            self.type_readers.setdefault(wrapper.vcftype, []).append(i)
+        for i in range(len(self.vcfwrappers)):
+            self.pushRecord(i)
+        self.updateCurrentRange()
+
+    def readNextRecord(self, wrapper):
+        r"""
+        Read the next record of a VCF reader
+
+        Parameters
+        ----------
+        wrapper : VCFWrapper
+           Wrapper of the VCF reader
 
-        self.done = all([item.vcfrecord is None for item in self.current_tr_records if item])
-        self.is_min_pos_list = mergeutils.GetMinRecords(self.getCurrentRecordVCFRecs(),
-                                                        self.chroms)
-        self.cur_range_chrom, self.cur_range_start_pos, self.cur_range_end_pos = \
-            self.getCurrentRange()
-        self.is_overlap_min = self.getOverlapMinRecords()
+        Returns
+        -------
+        record : ReaderRecord
+           The next record, or None at the end of the file
+        """
+        try:
+            return ReaderRecord(wrapper.NextRecords(), wrapper.vcftype, wrapper.batch_sizes)
+        except StopIteration:
+            return None
 
-    def areChromsValid(self):
+    def GetResumePositions(self):
         r"""
-        Check if chromosomes of current records are valid
+        Get the position of the current record of each reader
+
+        A Readers created with these resume_positions continues
+        the merge from the current records.
 
         Returns
         -------
+        positions : list of [str, int, int]
+           Resume position of each reader (see VCFWrapper.GetResumePosition),
+           None for readers that are done
+        """
+        positions = []
+        for record, wrapper in zip(self.current_tr_records, self.vcfwrappers):
+            if record is None:
+                positions.append(None)
+            else:
+                positions.append(wrapper.GetResumePosition())
+        return positions
 
-        is_valid : bool
-           Equal to true if all are valid, else False
+    def pushRecord(self, idx):
+        r"""
+        Add the current record of a reader to the priority queue
+
+        Parameters
+        ----------
+        idx : int
+           Index of the reader
         """
-        is_valid = True
-        for r, wrapper in zip(self.current_tr_records, self.vcfwrappers):
-            if r is None or r.vcfrecord is None:
-                continue
-            if r.vcfrecord.CHROM not in self.chroms:
-                common.WARNING((
-                                   "Error: found a record in file {} with "
-                                    "chromosome '{}' which was not found in the contig list "
-                                    "({})".format(wrapper.vcftype.name, r.vcfrecord.CHROM,
-                                                  ", ".join(self.chroms))))
-                is_valid = False
-        return is_valid
+        record = self.current_tr_records[idx]
+        if record is None or record.vcfrecord is None:
+            return
+        chrom = record.vcfrecord.CHROM
+        if chrom not in self.chrom_ranks:
+            common.WARNING((
+                               "Error: found a record in file {} with "
+                                "chromosome '{}' which was not found in the contig list "
+                                "({})".format(self.vcfwrappers[idx].vcftype.name, chrom,
+                                              ", ".join(self.chroms))))
+            raise ValueError('Invalid CHROM detected in record.')
+        heapq.heappush(self.record_heap, (self.chrom_ranks[chrom], record.vcfrecord.POS,
+                                          idx, self.record_versions[idx]))
 
-    def getCurrentRecordVCFRecs(self):
+    def isCurrentEntry(self, entry):
         r"""
-        Get list of the current records for each VCF reader
+        Check if a priority queue entry is the current record of its reader
+
+        Parameters
+        ----------
+        entry : tuple
+           (contig rank, position, reader index, version)
 
         Returns
         -------
-        ret : list of trh.TRRecord
-           List of VCF records for each reader
+        is_current : bool
+           False if the reader moved on since the entry was added
         """
-        ret = []
-        for i in range(len(self.current_tr_records)):
-            item = self.current_tr_records[i]
-            if item is None or item.vcfrecord is None:
-                ret.append(None)
-            else:
-               ret.append(item.vcfrecord)
-        return ret
+        return self.record_versions[entry[2]] == entry[3]
 
-    def getCurrentRange(self):
+    def getEntriesUpTo(self, rank, pos):
         r"""
-        Get range (chrom, start, end) of current records
+        Get readers whose current record is at or before a position
+
+        Only visits the part of the heap with smaller keys,
+        so the cost depends on the number of records found.
+
+        Parameters
+        ----------
+        rank : int
+           Contig rank
+        pos : int
+           Position
 
         Returns
         -------
+        readers : list of int
+           Indices of the readers, in increasing order
+        """
+        readers = []
+        heap = self.record_heap
+        stack = [0] if len(heap) > 0 else []
+        while len(stack) > 0:
+            i = stack.pop()
+            entry = heap[i]
+            if (entry[0], entry[1]) > (rank, pos):
+                continue # children are larger
+            if self.isCurrentEntry(entry):
+                readers.append(entry[2])
+            for child in [2*i + 1, 2*i + 2]:
+                if child < len(heap):
+                    stack.append(child)
+        readers.sort()
+        return readers
 
-        chrom : str
-            Chromosome of current range
-        start_pos : int
-            Start position of the list of records
-        end_pos : int
-            Largest end position of the group of records
+    def updateCurrentRange(self):
+        r"""
+        Find the records with the smallest position (min records),
+        the range (chrom, start, end) they cover and the
+        records starting in that range (overlapping records)
         """
-        start_pos = None
+        # Drop entries of readers that moved on
+        while len(self.record_heap) > 0 and not self.isCurrentEntry(self.record_heap[0]):
+            heapq.heappop(self.record_heap)
+        self.done = len(self.record_heap) == 0
+        if self.done:
+            self.min_readers = []
+            self.overlap_readers = []
+            self.cur_range_chrom, self.cur_range_start_pos, self.cur_range_end_pos = None, None, -1
+            return
+        rank, start_pos = self.record_heap[0][0], self.record_heap[0][1]
+        self.min_readers = self.getEntriesUpTo(rank, start_pos)
         end_pos = -1
-        chrom = None
-        for i in range(len(self.is_min_pos_list)):
-            if self.is_min_pos_list[i]:
-                chrom = self.current_tr_records[i].vcfrecord.CHROM
-                start_pos = self.current_tr_records[i].vcfrecord.POS
-                end = start_pos + len(trh.HarmonizeRecord(self.vcfwrappers[i].vcftype,
-                                                          self.current_tr_records[i].vcfrecord).ref_allele)
-                if end > end_pos:
-                    end_pos = end
-        return chrom, start_pos, end_pos
+        for i in self.min_readers:
+            end = start_pos + len(self.current_tr_records[i].hm_record.ref_allele)
+            if end > end_pos:
+                end_pos = end
+        self.cur_range_chrom = self.chroms[rank]
+        self.cur_range_start_pos = start_pos
+        self.cur_range_end_pos = end_pos
+        # Records are sorted, so a record overlaps the range
+        # if and only if it starts before the range ends
+        self.overlap_readers = self.getEntriesUpTo(rank, end_pos)
 
-    def getOverlapMinRecords(self):
+    def getCurrentRecordVCFRecs(self):
         r"""
-        Check of each record overlaps the min record
+        Get list of the current records for each VCF reader
 
         Returns
         -------
-        is_overlap_min : list of bool
-           One entry for each VCF reader. Set to True
-           if the current record for that reader overlaps
-           the min record
+        ret : list of cyvcf2.Variant
+           List of VCF records for each reader
         """
-        # Set is_overlap_min for anything overlapping
-        is_overlap_min = []
+        ret = []
         for i in range(len(self.current_tr_records)):
-            if self.current_tr_records[i] is None:
-                is_overlap_min.append(False)
-                continue
-            if self.current_tr_records[i].vcfrecord.CHROM != self.cur_range_chrom:
-                is_overlap_min.append(False)
-                continue
-            start_pos = self.current_tr_records[i].vcfrecord.POS
-            end = start_pos + len(self.current_tr_records[i].vcfrecord.REF)
-            if (self.cur_range_start_pos <= start_pos <= self.cur_range_end_pos) or \
-                    (self.cur_range_start_pos <= end <= self.cur_range_end_pos):
-                is_overlap_min.append(True)
+            item = self.current_tr_records[i]
+            if item is None or item.vcfrecord is None:
+                ret.append(None)
             else:
-                is_overlap_min.append(False)
-        return is_overlap_min
+               ret.append(item.vcfrecord)
+        return ret
 
+    @profiling.Timed("cluster_build")
     def getMergableCalls(self):
         r"""
         Determine which calls are mergeable
@@ -222,56 +906,209 @@ class Readers:
         ov_region : recordcluster.OverlappingRegion
            contains VCF records in an overlapping region
         """
-        record_cluster_list = []
-        for i in range(len(self.current_tr_records)):
-            if self.is_overlap_min[i] and self.current_tr_records[i] is not None:
-                curr_ro = recordcluster.RecordObj(self.current_tr_records[i].vcfrecord, self.vcfwrappers[i].vcftype,
-                                                  self.samples_list[i])
-                canon_motif = utils.GetCanonicalMotif(curr_ro.hm_record.motif)
-                added = False
-                for rc in record_cluster_list:
-                    if rc.canonical_motif == canon_motif:
-                        rc.AppendRecordObject(curr_ro)
-                        added = True
-                if not added:
-                    record_cluster_list.append(recordcluster.RecordCluster([curr_ro], self.ref_genome,
-                                                                           canon_motif, self.samples))
+        # Group records by motif first so each cluster is built once
+        motif_to_ros = {}
+        for i in self.overlap_readers:
+            record = self.current_tr_records[i]
+            curr_ro = recordcluster.RecordObj(record.vcfrecord, self.vcfwrappers[i].vcftype,
+                                              self.samples_list[i], self.sample_index_list[i],
+                                              hm_record=record.hm_record,
+                                              canonical_motif=record.canonical_motif,
+                                              sample_columns=self.sample_columns_list[i],
+                                              batches=record.batches)
+            canon_motif = record.canonical_motif
+            motif_to_ros.setdefault(canon_motif, []).append(curr_ro)
+        record_cluster_list = [recordcluster.RecordCluster(ros, self.ref_cache, canon_motif, self.samples) \
+                               for canon_motif, ros in motif_to_ros.items()]
         ov_region = recordcluster.OverlappingRegion(record_cluster_list)
         return ov_region
 
+    @profiling.Timed("reader_advance")
     def goToNext(self, vcf_list):
         r"""
         Get next records for each reader
+
+        Parameters
+        ----------
+        vcf_list : list of bool
+           Readers of the VCF types set to True move to their next record
         """
-        prev_records = self.current_tr_records
-        new_records = []
-        for idx, rec in enumerate(prev_records):
-            if vcf_list[convert_type_to_idx[self.vcfwrappers[idx].vcftype]]:
-                try:
-                    new_records.append(trh.HarmonizeRecord(self.vcfwrappers[idx].vcftype,
-                                                     next(self.vcfwrappers[idx].vcfreader)))
+        for vcftype, readers in self.type_readers.items():
+            if not vcf_list[convert_type_to_idx[vcftype]]:
+                continue
+            for idx in readers:
+                if self.current_tr_records[idx] is None:
+                    continue
+                self.current_tr_records[idx] = self.readNextRecord(self.vcfwrappers[idx])
+                self.record_versions[idx] += 1
+                self.pushRecord(idx)
+        self.updateCurrentRange()
 
-                except StopIteration:
-                    new_records.append(None)
-            else:
-                if prev_records[idx] is None:
-                    new_records.append(None)
-                else:
-                    new_records.append(
-                        trh.HarmonizeRecord(self.vcfwrappers[idx].vcftype,
-                                            prev_records[idx].vcfrecord)
-                    )
-        self.current_tr_records = new_records
-
-
-        # Update
-        if not self.areChromsValid():
-            raise ValueError('Invalid CHROM detected in record.')
-        self.done = all([item is None or item.vcfrecord is None for item in self.current_tr_records])
-        self.is_min_pos_list = mergeutils.GetMinRecords(self.getCurrentRecordVCFRecs(), self.chroms)
-        self.cur_range_chrom, self.cur_range_start_pos, self.cur_range_end_pos = \
-            self.getCurrentRange()
-        self.is_overlap_min = self.getOverlapMinRecords()
+def GetSharedSamples(sample_lists):
+    r"""
+    Get the samples present in all input files
+
+    Parameters
+    ----------
+    sample_lists : list of list of str
+       Samples of each input file
+
+    Returns
+    -------
+    samples : list of str
+       Shared samples, in the order of the first file
+    """
+    if len(sample_lists) == 0:
+        return []
+    other_samples = [set(sample_list) for sample_list in sample_lists[1:]]
+    return [sample for sample in sample_lists[0] \
+            if all(sample in sample_set for sample_set in other_samples)]
+
+def GetSampleColumns(samples, sample_index):
+    r"""
+    Map output samples to the columns of a reader
+
+    Parameters
+    ----------
+    samples : list of str
+       Output samples
+    sample_index : dict of str: int
+       Column of each sample in the reader
+
+    Returns
+    -------
+    columns : np.ndarray
+       Column of each output sample in the reader
+    """
+    return np.array([sample_index[sample] for sample in samples], dtype=np.intp)
+
+def GetRecordReach(rec, vcftype):
+    r"""
+    Get the last position a record can be merged with
+
+    Records starting at or before this position may end up in the
+    same record cluster as rec.
+
+    Parameters
+    ----------
+    rec : cyvcf2.Variant
+       VCF record
+    vcftype : trh.TRRecordHarmonizer.vcftype
+       Type of the VCF file
+
+    Returns
+    -------
+    reach : int
+       Last position overlapped by the record
+    """
+    ref_len = len(trh.HarmonizeRecord(vcftype, rec).ref_allele)
+    return max(rec.POS + ref_len, rec.POS + len(rec.REF), rec.end)
+
+def FindSplitPosition(vcffiles, vcftypes, chrom, target, chrom_len):
+    r"""
+    Find a position where the input can be split into
+    independent regions
+
+    Parameters
+    ----------
+    vcffiles : list of cyvcf2.VCF
+       Indexed VCF readers
+    vcftypes : list of trh.TRRecordHarmonizer.vcftype
+       Type of each VCF file
+    chrom : str
+       Chromosome to split
+    target : int
+       Desired split position
+    chrom_len : int
+       Length of the chromosome
+
+    Returns
+    -------
+    split_pos : int
+       Smallest position >= target such that no record starting
+       before it reaches it. None if there is no such position
+       before the end of the chromosome.
+    """
+    split_pos = target
+    win_start = max(1, target - SPLIT_MARGIN)
+    search_size = SPLIT_SEARCH_SIZE
+    while split_pos <= chrom_len:
+        win_end = split_pos + search_size
+        intervals = []
+        for vcffile, vcftype in zip(vcffiles, vcftypes):
+            if chrom not in vcffile.seqnames:
+                continue
+            for rec in vcffile(GetRegionString((chrom, win_start, win_end))):
+                intervals.append((rec.POS, GetRecordReach(rec, vcftype)))
+        intervals.sort()
+        max_reach = 0
+        i = 0
+        while split_pos <= win_end:
+            while i < len(intervals) and intervals[i][0] < split_pos:
+                max_reach = max(max_reach, intervals[i][1])
+                i += 1
+            if max_reach < split_pos:
+                return split_pos
+            split_pos = max_reach + 1
+        search_size *= 2
+    return None
+
+def GetMergeRegions(vcfpaths, vcftypes, chroms, ref_genome, region_size):
+    r"""
+    Split the input into regions that can be merged independently
+
+    Regions never cut through a record cluster, so merging each
+    region separately and concatenating the results in order gives
+    the same output as merging the whole files at once.
+
+    Parameters
+    ----------
+    vcfpaths : list of str
+       Paths to the indexed input VCF files
+    vcftypes : list of trh.TRRecordHarmonizer.vcftype
+       Type of each VCF file
+    chroms : list of str
+       Chromosomes in the order they should be merged
+    ref_genome : pyfaidx.Fasta
+       Reference genome, used to get chromosome lengths
+    region_size : int
+       Approximate size of each region (bp)
+
+    Returns
+    -------
+    regions : list of (str, int, int)
+       Regions (chrom, start, end) in merge order.
+       The last region of each chromosome has end=None.
+    """
+    vcffiles = [cyvcf2.VCF(invcf, samples=[]) for invcf in vcfpaths]
+    data_chroms = set()
+    for vcffile, invcf in zip(vcffiles, vcfpaths):
+        for chrom in vcffile.seqnames:
+            if chrom not in chroms:
+                common.WARNING("Error: found chromosome '{}' in file {} which was "
+                               "not found in the contig list".format(chrom, invcf))
+                raise ValueError('Invalid CHROM detected in record.')
+            data_chroms.add(chrom)
+
+    regions = []
+    for chrom in chroms:
+        if chrom not in data_chroms:
+            continue
+        chrom_len = None
+        if chrom in ref_genome:
+            chrom_len = len(ref_genome[chrom])
+        start = 1
+        while True:
+            split_pos = None
+            if chrom_len is not None and start + region_size <= chrom_len:
+                split_pos = FindSplitPosition(vcffiles, vcftypes, chrom,
+                                              start + region_size, chrom_len)
+            if split_pos is None:
+                regions.append((chrom, start, None))
+                break
+            regions.append((chrom, start, split_pos - 1))
+            start = split_pos
+    return regions
 
 ##################################################
 #
@@ -279,10 +1116,578 @@ class Readers:
 #
 ##################################################
 
+class SortBuffer:
+    r"""
+    Reorder buffer for output records
+
+    Records are pushed with a sort key and popped in key order
+    once no record with a smaller key can be pushed anymore.
+    When more than max_records records are held, they are
+    written to a sorted temporary file (run) and merged back
+    when popped.
+
+    Parameters
+    ----------
+    max_records : int
+       Number of records kept in memory
+    tmpdir : str, optional
+       Directory of the temporary files
+
+    Attributes
+    ----------
+    records : list of (tuple, object)
+       Heap of (key, record) held in memory
+    runs : list of list
+       Spilled runs, as [file, key of next record, next record]
+    num_spilled : int
+       Number of records spilled to disk
+    """
+    def __init__(self, max_records=SORT_BUFFER_SIZE, tmpdir=None):
+        self.max_records = max_records
+        self.tmpdir = tmpdir
+        self.records = []
+        self.runs = []
+        self.num_spilled = 0
+
+    def Push(self, key, record):
+        r"""
+        Add a record
+
+        Parameters
+        ----------
+        key : tuple of int
+           Sort key. Keys must be unique.
+        record : object
+           Record, must be picklable
+        """
+        heapq.heappush(self.records, (key, record))
+        if len(self.records) > self.max_records:
+            self.Spill()
+
+    def Spill(self):
+        r"""
+        Write the records held in memory to a new run
+        """
+        run_file = tempfile.TemporaryFile(dir=self.tmpdir)
+        self.records.sort(key=lambda item: item[0])
+        for item in self.records:
+            pickle.dump(item, run_file, pickle.HIGHEST_PROTOCOL)
+        run_file.seek(0)
+        log.debug("Spilled %d output records to a temporary file", len(self.records))
+        self.num_spilled += len(self.records)
+        self.records = []
+        run = [run_file, None, None]
+        if self.readRun(run):
+            self.runs.append(run)
+
+    def readRun(self, run):
+        r"""
+        Load the next record of a run
+
+        Parameters
+        ----------
+        run : list
+           [file, key of next record, next record]
+
+        Returns
+        -------
+        has_record : bool
+           False (and the file is closed) at the end of the run
+        """
+        try:
+            run[1], run[2] = pickle.load(run[0])
+        except EOFError:
+            run[0].close()
+            return False
+        return True
+
+    def Pop(self, bound=None):
+        r"""
+        Remove records in key order
+
+        Parameters
+        ----------
+        bound : tuple of int, optional
+           Only remove records whose key starts with a
+           prefix not greater than bound. All records by default.
+
+        Returns
+        -------
+        records : iterator of object
+           Records in key order
+        """
+        while True:
+            key = None
+            source = None
+            if len(self.records) > 0:
+                key = self.records[0][0]
+            for run in self.runs:
+                if key is None or run[1] < key:
+                    key = run[1]
+                    source = run
+            if key is None or (bound is not None and key[0:len(bound)] > bound):
+                return
+            if source is None:
+                yield heapq.heappop(self.records)[1]
+            else:
+                yield source[2]
+                if not self.readRun(source):
+                    self.runs.remove(source)
+
+    def Close(self):
+        r"""
+        Remove the temporary files
+        """
+        for run in self.runs:
+            run[0].close()
+        self.runs = []
+
+def CompressBGZFBlock(data, level):
+    r"""
+    Compress data into a single BGZF block
+
+    Parameters
+    ----------
+    data : bytes
+       At most BGZF_BLOCK_SIZE bytes
+    level : int
+       zlib compression level
+
+    Returns
+    -------
+    block : bytes
+       gzip member with the BGZF extra field
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    header = struct.pack("<BBBBIBBHBBHH", 31, 139, 8, 4, 0, 0, 255, 6,
+                         66, 67, 2, len(cdata) + 25)
+    return header + cdata + struct.pack("<II", zlib.crc32(data), len(data))
+
+class BGZFWriter:
+    r"""
+    Write a BGZF (blocked gzip) file, as produced by bgzip
+
+    Blocks are compressed in a pool of threads and
+    written in order.
+
+    Parameters
+    ----------
+    path : str
+       Output path
+    threads : int, optional
+       Number of compression threads
+    level : int, optional
+       zlib compression level
+    buffer_size : int, optional
+       Size (bytes) of the buffer of the compressed file
+    resume : dict, optional
+       State returned by GetState after a Sync. Blocks are added
+       to the file, which must be truncated to the synced size.
+
+    Attributes
+    ----------
+    block_offsets : array of int
+       Offset in the compressed file of each block written
+    block_starts : array of int
+       Offset in the uncompressed data of each block written
+    uncompressed_size : int
+       Number of bytes written so far (before compression)
+    """
+    def __init__(self, path, threads=1, level=6, buffer_size=-1, resume=None):
+        self.path = path
+        self.out = open(path, "wb" if resume is None else "ab", buffering=buffer_size)
+        self.level = level
+        self.buffer = bytearray()
+        self.block_offsets = array("Q")
+        self.block_starts = array("Q")
+        self.blocked_size = 0
+        self.compressed_size = 0
+        self.uncompressed_size = 0
+        if resume is not None:
+            self.block_offsets.extend(resume["block_offsets"])
+            self.block_starts.extend(resume["block_starts"])
+            self.blocked_size = self.uncompressed_size = resume["uncompressed_size"]
+            self.compressed_size = resume["compressed_size"]
+        self.executor = None
+        self.pending = []
+        self.max_pending = 4 * threads
+        if threads > 1:
+            self.executor = ThreadPoolExecutor(threads)
+
+    def write(self, text):
+        r"""
+        Write text
+
+        Parameters
+        ----------
+        text : str
+           Text to compress
+        """
+        self.writeBytes(text.encode())
+
+    def writeBytes(self, data):
+        r"""
+        Write raw bytes
+
+        Parameters
+        ----------
+        data : bytes
+           Data to compress
+        """
+        self.buffer += data
+        self.uncompressed_size += len(data)
+        while len(self.buffer) >= BGZF_BLOCK_SIZE:
+            self.writeBlock(bytes(self.buffer[:BGZF_BLOCK_SIZE]))
+            del self.buffer[:BGZF_BLOCK_SIZE]
+
+    def writeBlock(self, data):
+        r"""
+        Compress a block, in the thread pool if there is one
+
+        Parameters
+        ----------
+        data : bytes
+           Uncompressed content of the block
+        """
+        self.block_starts.append(self.blocked_size)
+        self.blocked_size += len(data)
+        if self.executor is None:
+            self.writeCompressed(CompressBGZFBlock(data, self.level))
+            return
+        self.pending.append(self.executor.submit(CompressBGZFBlock, data, self.level))
+        while len(self.pending) > self.max_pending:
+            self.writeCompressed(self.pending.pop(0).result())
+
+    def writeCompressed(self, block):
+        r"""
+        Write a compressed block and record its offset
+
+        Parameters
+        ----------
+        block : bytes
+           Compressed BGZF block
+        """
+        self.block_offsets.append(self.compressed_size)
+        self.out.write(block)
+        self.compressed_size += len(block)
+
+    def flushBlocks(self):
+        r"""
+        Compress the buffered data, even if shorter than
+        a block, and write all pending blocks
+        """
+        if len(self.buffer) > 0:
+            self.writeBlock(bytes(self.buffer))
+            self.buffer = bytearray()
+        for future in self.pending:
+            self.writeCompressed(future.result())
+        self.pending = []
+
+    def GetVirtualOffset(self, offset):
+        r"""
+        Convert an uncompressed offset to a BGZF virtual offset
+
+        Parameters
+        ----------
+        offset : int
+           Offset in the uncompressed data, at most
+           the size of the data flushed by close
+
+        Returns
+        -------
+        voffset : int
+           Offset of the block in the compressed file << 16
+           | offset in the uncompressed block
+        """
+        if offset >= self.blocked_size:
+            return self.compressed_size << 16
+        block = bisect.bisect_right(self.block_starts, offset) - 1
+        return (self.block_offsets[block] << 16) | (offset - self.block_starts[block])
+
+    def Sync(self):
+        r"""
+        Write everything written so far to disk, ending the last block
+
+        Returns
+        -------
+        offset : int
+           Size of the compressed file. Truncating it to this
+           size gives a file that can be appended to.
+        """
+        self.flushBlocks()
+        self.out.flush()
+        os.fsync(self.out.fileno())
+        return self.compressed_size
+
+    def GetState(self):
+        r"""
+        Get the blocks written so far, call it after Sync
+
+        Returns
+        -------
+        state : dict
+           Offsets of the blocks and size of the data.
+           Pass it as resume to a new BGZFWriter to
+           add blocks after them.
+        """
+        return {"block_offsets": self.block_offsets.tolist(),
+                "block_starts": self.block_starts.tolist(),
+                "compressed_size": self.compressed_size,
+                "uncompressed_size": self.uncompressed_size}
+
+    def close(self):
+        r"""
+        Write the remaining data and the end-of-file marker
+        """
+        self.flushBlocks()
+        if self.executor is not None:
+            self.executor.shutdown()
+        self.out.write(BGZF_EOF)
+        self.out.close()
+
+def GetIndexBin(beg, end, min_shift, depth):
+    r"""
+    Get the smallest bin containing an interval (as hts_reg2bin)
+
+    Parameters
+    ----------
+    beg : int
+       0-based start of the interval
+    end : int
+       0-based end (exclusive) of the interval
+    min_shift : int
+       Log2 of the size of the smallest bins
+    depth : int
+       Number of levels below the root bin
+
+    Returns
+    -------
+    bin : int
+       Bin number
+    """
+    end -= 1
+    level, shift = depth, min_shift
+    first = ((1 << depth*3) - 1) // 7
+    while level > 0:
+        if beg >> shift == end >> shift:
+            return first + (beg >> shift)
+        level -= 1
+        shift += 3
+        first -= 1 << level*3
+    return 0
+
+def GetBinStartWindow(bin_num, depth):
+    r"""
+    Get the first linear index window of a bin (as hts_bin_bot)
+
+    Parameters
+    ----------
+    bin_num : int
+       Bin number
+    depth : int
+       Number of levels below the root bin
+
+    Returns
+    -------
+    window : int
+       Index of the first smallest-size window covered by the bin
+    """
+    level = 0
+    parent = bin_num
+    while parent > 0:
+        level += 1
+        parent = (parent - 1) >> 3
+    return (bin_num - ((1 << level*3) - 1) // 7) << (depth - level)*3
+
+class TabixIndex:
+    r"""
+    Build a tabix (.tbi) or CSI (.csi) index of a sorted
+    BGZF-compressed VCF file while it is written
+
+    Offsets are recorded in the uncompressed data and
+    converted to virtual offsets when the index is written.
+
+    Parameters
+    ----------
+    csi : bool, optional
+       Build a CSI index instead of a tabix index
+    resume : dict, optional
+       State returned by GetState. Records are added after
+       the ones indexed then.
+
+    Attributes
+    ----------
+    depth : int
+       Number of levels below the root bin
+    chroms : list of str
+       Chromosomes in the order of the file
+    bins : list of dict of int: list of [int, int]
+       Per chromosome, chunks (start and end offsets) of each bin
+    windows : list of dict of int: int
+       Per chromosome, offset of the first record
+       overlapping each smallest-size window
+    extents : list of [int, int, int]
+       Per chromosome, start offset of the first record,
+       end offset of the last record and number of records
+    """
+    def __init__(self, csi=False, resume=None):
+        self.csi = csi
+        self.depth = CSI_DEPTH if csi else TBI_DEPTH
+        self.chroms = []
+        self.bins = []
+        self.windows = []
+        self.extents = []
+        if resume is not None:
+            self.chroms = list(resume["chroms"])
+            self.bins = [{bin_num: [list(chunk) for chunk in chunks] for bin_num, chunks in bins} \
+                         for bins in resume["bins"]]
+            self.windows = [dict(windows) for windows in resume["windows"]]
+            self.extents = [list(extent) for extent in resume["extents"]]
+
+    def AddRecord(self, chrom, beg, end, start_offset, end_offset):
+        r"""
+        Add a record
+
+        Parameters
+        ----------
+        chrom : str
+           Chromosome of the record
+        beg : int
+           0-based start of the record
+        end : int
+           0-based end (exclusive) of the record
+        start_offset : int
+           Uncompressed offset of the record in the file
+        end_offset : int
+           Uncompressed offset of the end of the record
+        """
+        if len(self.chroms) == 0 or self.chroms[-1] != chrom:
+            if chrom in self.chroms:
+                common.WARNING("Error: chromosome {} is not contiguous in the sorted "
+                               "output".format(chrom))
+                raise ValueError('Cannot index unsorted output.')
+            self.chroms.append(chrom)
+            self.bins.append({})
+            self.windows.append({})
+            self.extents.append([start_offset, end_offset, 0])
+        end = max(end, beg + 1)
+        if end > (1 << (INDEX_MIN_SHIFT + self.depth*3)):
+            common.WARNING("Error: record {}:{} is beyond the maximum position of a "
+                           "{} index".format(chrom, beg + 1, "CSI" if self.csi else "tabix"))
+            raise ValueError('Position too large to be indexed.')
+        chunks = self.bins[-1].setdefault(GetIndexBin(beg, end, INDEX_MIN_SHIFT, self.depth), [])
+        if len(chunks) > 0 and chunks[-1][1] == start_offset:
+            chunks[-1][1] = end_offset
+        else:
+            chunks.append([start_offset, end_offset])
+        windows = self.windows[-1]
+        for window in range(beg >> INDEX_MIN_SHIFT, ((end - 1) >> INDEX_MIN_SHIFT) + 1):
+            if window not in windows:
+                windows[window] = start_offset
+        self.extents[-1][1] = end_offset
+        self.extents[-1][2] += 1
+
+    def GetState(self):
+        r"""
+        Get the records indexed so far
+
+        Returns
+        -------
+        state : dict
+           Chromosomes, bins, windows and extents, as lists
+           (e.g. to be saved as JSON). Pass it as resume to a
+           new TabixIndex to add records after them.
+        """
+        return {"chroms": list(self.chroms),
+                "bins": [[[bin_num, [list(chunk) for chunk in bins[bin_num]]] for bin_num in sorted(bins)] \
+                         for bins in self.bins],
+                "windows": [[[window, windows[window]] for window in sorted(windows)] \
+                            for windows in self.windows],
+                "extents": [list(extent) for extent in self.extents]}
+
+    def GetLinearIndex(self, i, voffset):
+        r"""
+        Get the linear index of a chromosome
+
+        Parameters
+        ----------
+        i : int
+           Index of the chromosome
+        voffset : function
+           Converts uncompressed offsets to virtual offsets
+
+        Returns
+        -------
+        linear : list of int
+           Virtual offset of the first record overlapping each
+           window. Empty windows take the offset of the previous
+           window (as htslib).
+        """
+        windows = self.windows[i]
+        linear = []
+        last = voffset(self.extents[i][0])
+        for window in range(max(windows) + 1):
+            if window in windows:
+                last = voffset(windows[window])
+            linear.append(last)
+        return linear
+
+    def Write(self, path, voffset):
+        r"""
+        Write the index
+
+        Parameters
+        ----------
+        path : str
+           Path to the index file
+        voffset : function
+           Converts uncompressed offsets of the
+           indexed file to virtual offsets
+        """
+        names = b"".join(chrom.encode() + b"\0" for chrom in self.chroms)
+        # VCF preset: format, sequence, begin and end columns, meta char, skip
+        conf = struct.pack("<iiiiiii", 2, 1, 2, 0, ord("#"), 0, len(names)) + names
+        # Bin holding the extent and number of records of each chromosome
+        meta_bin = ((1 << (self.depth + 1)*3) - 1) // 7 + 1
+        index = BGZFWriter(path)
+        if self.csi:
+            index.writeBytes(b"CSI\1" + struct.pack("<iii", INDEX_MIN_SHIFT, self.depth, len(conf))
+                             + conf + struct.pack("<i", len(self.chroms)))
+        else:
+            index.writeBytes(b"TBI\1" + struct.pack("<i", len(self.chroms)) + conf)
+        for i in range(len(self.chroms)):
+            linear = self.GetLinearIndex(i, voffset)
+            bins = self.bins[i]
+            out = bytearray(struct.pack("<i", len(bins) + 1))
+            for bin_num in sorted(bins):
+                out += struct.pack("<I", bin_num)
+                if self.csi:
+                    window = GetBinStartWindow(bin_num, self.depth)
+                    out += struct.pack("<Q", linear[window] if window < len(linear) else 0)
+                out += struct.pack("<i", len(bins[bin_num]))
+                for start_offset, end_offset in bins[bin_num]:
+                    out += struct.pack("<QQ", voffset(start_offset), voffset(end_offset))
+            start_offset, end_offset, num_records = self.extents[i]
+            out += struct.pack("<I", meta_bin)
+            if self.csi:
+                out += struct.pack("<Q", 0)
+            out += struct.pack("<iQQQQ", 2, voffset(start_offset), voffset(end_offset),
+                               num_records, 0)
+            if not self.csi:
+                out += struct.pack("<i%dQ"%len(linear), len(linear), *linear)
+            index.writeBytes(bytes(out))
+        index.writeBytes(struct.pack("<Q", 0)) # records without coordinates
+        index.close()
+
 class Writer:
     """
     Class to write the merged VCF file
 
+    Records are kept in a reorder buffer (see SortBuffer) and
+    written in coordinate order. Outputs ending with .gz are
+    BGZF-compressed and can be indexed in the same pass.
+
     Parameters
     ----------
     out_path : str
@@ -291,15 +1696,104 @@ class Writer:
           IDs of samples to be included in the output
     command : str
           Command used to invoke this tool
+    write_header : bool, optional
+          If False, only write records. Used for
+          partial outputs that are concatenated later.
+    chroms : list of str, optional
+          Chromosomes in output order. Records of other
+          chromosomes come last. By default records are
+          written in the order they are given.
+    sort_buffer_size : int, optional
+          Number of records kept in memory for sorting
+          before spilling to temporary files
+    tmpdir : str, optional
+          Directory of the temporary files
+    compress_threads : int, optional
+          Number of threads compressing a .gz output
+    index : str, optional
+          Index of a .gz output to build: "tbi", "csi" or None
+    buffer_size : int, optional
+          Size (bytes) of the buffer of the output file
+    sidecar : SidecarWriter, optional
+          Also write the consensus calls as numpy arrays
+    row_path : str, optional
+          Also write the consensus calls of each record to this file,
+          to be passed to the WriteRecords of another writer. Used for
+          partial outputs that are concatenated later.
+    resume : dict, optional
+          Output state returned by Sync. The output is truncated
+          to that state and records are appended to it.
+    inputs_mode : str, optional
+          Encoding of the INPUTS field, one of INPUTS_MODES:
+          copy numbers of each caller (full), allele indices of the
+          input records (compact) or no INPUTS field (none)
+    header : str, optional
+          VCF header text to write as is instead of the EnsembleTR
+          header (samples and command are then not used). Used by
+          tools rewriting records of another VCF.
 
     Attributes
     ----------
     vcf_writer : file
           Writeable file object to write VCF file to
+    sort_buffer : SortBuffer
+          Records waiting to be written (None if not sorting)
+    tabix_index : TabixIndex
+          Index of the output (None if not indexing)
+    last_positions : dict of str: int
+          Position of the last record written on each chromosome
     """
     
-    def __init__(self, out_path, samples, command):
-        self.vcf_writer = open(out_path, "w")
+    def __init__(self, out_path, samples, command, write_header=True, chroms=None,
+                 sort_buffer_size=SORT_BUFFER_SIZE, tmpdir=None, compress_threads=1,
+                 index=None, buffer_size=OUTPUT_BUFFER_SIZE, sidecar=None, row_path=None,
+                 resume=None, inputs_mode="full", header=None):
+        self.out_path = out_path
+        self.inputs_mode = inputs_mode
+        self.compressed = out_path.endswith(".gz")
+        if resume is not None:
+            os.truncate(out_path, resume["offset"])
+        if self.compressed:
+            self.vcf_writer = BGZFWriter(out_path, compress_threads, buffer_size=buffer_size,
+                                         resume=None if resume is None else resume["blocks"])
+        else:
+            self.vcf_writer = open(out_path, "w" if resume is None else "a", buffering=buffer_size)
+        self.last_positions = {}
+        self.chrom_ranks = None
+        self.sort_buffer = None
+        if chroms is not None:
+            self.chrom_ranks = {chrom: i for i, chrom in enumerate(chroms)}
+            self.sort_buffer = SortBuffer(sort_buffer_size, tmpdir)
+        self.num_records = 0
+        self.index = index
+        self.tabix_index = None
+        if self.compressed and index is not None:
+            self.tabix_index = TabixIndex(csi=(index == "csi"),
+                                          resume=None if resume is None else resume["index"])
+        self.sidecar = sidecar
+        self.row_writer = None
+        if row_path is not None:
+            self.row_writer = open(row_path, "wb")
+        self.keep_rows = sidecar is not None or row_path is not None
+        if resume is not None:
+            self.last_positions = dict(resume["last_positions"])
+        elif write_header:
+            if header is not None:
+                self.vcf_writer.write(header)
+            else:
+                self.WriteHeader(samples, command)
+
+    def WriteHeader(self, samples, command):
+        r"""
+        Write the VCF header
+
+        Parameters
+        ----------
+        samples : list of str
+              IDs of samples to be included in the output
+        command : str
+              Command used to invoke this tool
+        """
         self.vcf_writer.write('##fileformat=VCFv4.1\n')
         self.vcf_writer.write('##command=%s\n'%command)
         self.vcf_writer.write('##INFO=<ID=START,Number=1,Type=Integer,Description="First position in all alleles">\n')
@@ -314,9 +1808,14 @@ class Writer:
         self.vcf_writer.write('##FORMAT=<ID=SCORE,Number=1,Type=Float,Description="Score of the consensus call based on gentoypes">\n')
         self.vcf_writer.write('##FORMAT=<ID=GTS,Number=1,Type=String,Description="Method(s) that support the consensus call (AdVNTR, EH, HipSTR, GangSTR)">\n')
         self.vcf_writer.write('##FORMAT=<ID=ALS,Number=1,Type=String,Description="Number of times each bp difference was seen across all calls">\n')
-        self.vcf_writer.write('##FORMAT=<ID=INPUTS,Number=1,Type=String,Description="Raw calls">\n')
+        if self.inputs_mode == "full":
+            self.vcf_writer.write('##FORMAT=<ID=INPUTS,Number=1,Type=String,Description="Raw calls">\n')
+        elif self.inputs_mode == "compact":
+            self.vcf_writer.write('##FORMAT=<ID=INPUTS,Number=1,Type=String,Description="Raw calls as allele '
+                                  'indices of the input records, in the order of METHODS">\n')
         self.vcf_writer.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t' + '\t'.join(samples) + '\n')
 
+    @profiling.Timed("write")
     def WriteRecord(self, rcres):
         r"""
         Write a VCF record for the record cluster
@@ -346,28 +1845,390 @@ class Writer:
                      'RU': rcres.record_cluster.canonical_motif,
                      'METHODS': "|".join([str(int(item)) for item in rcres.record_cluster.vcf_types])}
         INFO = ";".join(["%s=%s"%(key, INFO_DICT[key]) for key in INFO_DICT])
-        FORMAT = ['GT','GB', 'NCOPY','EXP','SCORE','GTS','ALS','INPUTS']
-
-        SAMPLE_DATA=[]
-        raw_calls = rcres.record_cluster.GetRawCalls()
-        for sample in rcres.record_cluster.samples:
-            SAMPLE_DATA.append(':'.join(
-                [rcres.GetSampleGT(sample),
-                 rcres.GetSampleGB(sample),
-                 rcres.GetSampleNCOPY(sample),
-                 rcres.GetExpandedFlag(sample),
-                 rcres.GetSampleScore(sample),
-                 rcres.GetSampleGTS(sample),
-                 rcres.GetSampleALS(sample),
-                 raw_calls[sample]
-                ]
-                ))
-        self.vcf_writer.write('\t'.join([CHROM, str(POS), RECID,
+        FORMAT = ['GT','GB', 'NCOPY','EXP','SCORE','GTS','ALS']
+        if self.inputs_mode != "none":
+            FORMAT.append('INPUTS')
+
+        # Format each field for all samples at once, then intern
+        # identical sample strings (e.g. hom-ref with the same score)
+        sample_strings = {}
+        SAMPLE_DATA = []
+        for fields in zip(*rcres.GetFormatColumns(self.inputs_mode)):
+            sample_data = sample_strings.get(fields)
+            if sample_data is None:
+                sample_data = ':'.join(fields)
+                sample_strings[fields] = sample_data
+            SAMPLE_DATA.append(sample_data)
+        row = None
+        if self.keep_rows:
+            row = (CHROM, POS, INFO_DICT['END'], INFO_DICT['RU'], rcres.GetNumericColumns())
+        self.AddRecord(CHROM, POS, '\t'.join([CHROM, str(POS), RECID,
             REF, ",".join(ALTS), QUAL, FILTER, INFO,
             ':'.join(FORMAT),
-            '\t'.join(SAMPLE_DATA)]) + '\n')
+            '\t'.join(SAMPLE_DATA)]) + '\n', row)
+
+    @profiling.Timed("write")
+    def WriteRecords(self, lines, rows=None):
+        r"""
+        Write records that are already formatted,
+        e.g. the partial output of a worker
+
+        Parameters
+        ----------
+        lines : iterator of str
+            VCF records, each ending with a newline
+        rows : iterator of tuple, optional
+            Consensus calls of each record (see ReadRows)
+        """
+        for line in lines:
+            fields = line.split('\t', 2)
+            row = None
+            if rows is not None:
+                row = next(rows)
+            self.AddRecord(fields[0], int(fields[1]), line, row)
+
+    def AddRecord(self, chrom, pos, line, row=None):
+        r"""
+        Add a record to the reorder buffer,
+        or write it right away if not sorting
+
+        Parameters
+        ----------
+        chrom : str
+            Chromosome of the record
+        pos : int
+            Position of the record
+        line : str
+            VCF record ending with a newline
+        row : tuple, optional
+            Consensus calls of the record
+            (chrom, start, end, motif, dict of np.ndarray)
+        """
+        if self.sort_buffer is None:
+            self.writeLine(line, row)
+            return
+        # Records of unexpected chromosomes come last
+        rank = self.chrom_ranks.get(chrom, len(self.chrom_ranks))
+        self.sort_buffer.Push((rank, pos, self.num_records), (line, row))
+        self.num_records += 1
+
+    @profiling.Timed("write")
+    def FlushUpTo(self, chrom=None, pos=None):
+        r"""
+        Write the buffered records that come before any record
+        still to be added
+
+        Parameters
+        ----------
+        chrom : str, optional
+            Chromosome of the next record to be added.
+            All records are written if None.
+        pos : int, optional
+            Lower bound on the position of records still to be added
+        """
+        if self.sort_buffer is None:
+            return
+        bound = None
+        if chrom is not None:
+            bound = (self.chrom_ranks.get(chrom, len(self.chrom_ranks)), pos)
+        for line, row in self.sort_buffer.Pop(bound):
+            self.writeLine(line, row)
+
+    def writeLine(self, line, row=None):
+        r"""
+        Write a record to the output, adding it
+        to the index and to the consensus calls
+
+        Parameters
+        ----------
+        line : str
+            VCF record ending with a newline
+        row : tuple, optional
+            Consensus calls of the record
+        """
+        if self.sidecar is not None:
+            self.sidecar.AddRow(row)
+        if self.row_writer is not None:
+            pickle.dump(row, self.row_writer, pickle.HIGHEST_PROTOCOL)
+        fields = line.split('\t', 2)
+        self.last_positions[fields[0]] = int(fields[1])
+        if self.tabix_index is None:
+            self.vcf_writer.write(line)
+            return
+        start_offset = self.vcf_writer.uncompressed_size
+        self.vcf_writer.write(line)
+        self.indexLine(line, start_offset, self.vcf_writer.uncompressed_size)
+
+    def indexLine(self, line, start_offset, end_offset):
+        r"""
+        Add a record to the index
+
+        Parameters
+        ----------
+        line : str
+            VCF record
+        start_offset : int
+            Offset of the record in the uncompressed output
+        end_offset : int
+            Offset of the end of the record in the uncompressed output
+        """
+        fields = line.split('\t', 4)
+        beg = int(fields[1]) - 1
+        self.tabix_index.AddRecord(fields[0], beg, beg + len(fields[3]), start_offset, end_offset)
+
+    def SpillBuffer(self):
+        r"""
+        Spill the records of the reorder buffer to disk
+        to free memory, e.g. when over the memory budget.
+        Small buffers are left in memory.
+
+        Returns
+        -------
+        num_spilled : int
+            Number of records spilled
+        """
+        if self.sort_buffer is None or len(self.sort_buffer.records) < SPILL_MIN_RECORDS:
+            return 0
+        num_spilled = len(self.sort_buffer.records)
+        self.sort_buffer.Spill()
+        return num_spilled
+
+    def IsFlushed(self):
+        r"""
+        Check if all records added so far were written
+
+        Returns
+        -------
+        flushed : bool
+            True if no record is waiting in the reorder buffer
+        """
+        return self.sort_buffer is None or \
+            (len(self.sort_buffer.records) == 0 and len(self.sort_buffer.runs) == 0)
+
+    def Sync(self):
+        r"""
+        Write the records written so far to disk
+
+        Only records that left the reorder buffer are synced,
+        call it when IsFlushed is True.
+
+        Returns
+        -------
+        state : dict
+            Output offset, last position of each chromosome,
+            blocks and index of a .gz output and state of the
+            sidecar. Pass it as resume to a new Writer to
+            continue writing after these records.
+        """
+        if self.compressed:
+            offset = self.vcf_writer.Sync()
+        else:
+            self.vcf_writer.flush()
+            os.fsync(self.vcf_writer.fileno())
+            offset = self.vcf_writer.tell()
+        state = {"offset": offset, "last_positions": dict(self.last_positions)}
+        if self.compressed:
+            state["blocks"] = self.vcf_writer.GetState()
+        if self.tabix_index is not None:
+            state["index"] = self.tabix_index.GetState()
+        if self.sidecar is not None:
+            state["sidecar"] = self.sidecar.Sync()
+        return state
+
     def Close(self):
         r"""
-        Close the writer file object
+        Write the remaining records, close the
+        writer file object and write the index
         """
+        self.FlushUpTo()
+        if self.sort_buffer is not None:
+            self.sort_buffer.Close()
         self.vcf_writer.close()
+        if self.tabix_index is not None:
+            self.tabix_index.Write(self.out_path + "." + self.index,
+                                   self.vcf_writer.GetVirtualOffset)
+        if self.row_writer is not None:
+            self.row_writer.close()
+        if self.sidecar is not None:
+            self.sidecar.Close()
+
+def ReadRows(row_path):
+    r"""
+    Read the consensus calls written by a Writer with row_path
+
+    Parameters
+    ----------
+    row_path : str
+        Path to the file of consensus calls
+
+    Returns
+    -------
+    rows : iterator of tuple
+        Consensus calls of each record, in output order
+    """
+    with open(row_path, "rb") as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+class SidecarWriter:
+    """
+    Write the consensus calls as memory-mappable numpy arrays
+
+    The output directory holds:
+
+    - manifest.json: samples, arrays, chunks and missing values
+    - loci.tsv: chrom, start, end and motif of each locus
+    - <array>.<chunk>.npy: one file per array and chunk of loci,
+      with loci as rows and samples as columns
+
+    Arrays are those of recordcluster.RecordResolver.GetNumericColumns.
+    Loci are in the order of the VCF records.
+
+    Parameters
+    ----------
+    path : str
+        Output directory
+    samples : list of str
+        Samples, in the order of the columns
+    chunk_size : int, optional
+        Number of loci of each chunk
+    resume : dict, optional
+        State returned by Sync. Loci written after it are dropped.
+
+    Attributes
+    ----------
+    num_loci : int
+        Number of loci written so far
+    chunks : list of dict
+        First locus, number of loci and files of each chunk written
+    """
+    def __init__(self, path, samples, chunk_size=SIDECAR_CHUNK_SIZE, resume=None):
+        self.path = path
+        self.samples = samples
+        self.chunk_size = chunk_size
+        os.makedirs(path, exist_ok=True)
+        loci_path = os.path.join(path, "loci.tsv")
+        self.pending = {name: [] for name in SIDECAR_ARRAYS}
+        if resume is not None:
+            os.truncate(loci_path, resume["loci_offset"])
+            self.loci_writer = open(loci_path, "a")
+            self.num_loci = resume["num_loci"]
+            self.chunks = resume["chunks"]
+            self.num_synced = len(self.chunks)
+            return
+        self.loci_writer = open(loci_path, "w")
+        self.loci_writer.write("#chrom\tstart\tend\tmotif\n")
+        self.num_loci = 0
+        self.chunks = []
+        self.num_synced = 0
+
+    def AddRow(self, row):
+        r"""
+        Add the consensus calls of a locus
+
+        Parameters
+        ----------
+        row : tuple
+            (chrom, start, end, motif, dict of np.ndarray)
+        """
+        chrom, start, end, motif, columns = row
+        self.loci_writer.write("%s\t%d\t%d\t%s\n"%(chrom, start, end, motif))
+        for name in SIDECAR_ARRAYS:
+            self.pending[name].append(columns[name])
+        self.num_loci += 1
+        if len(self.pending[SIDECAR_ARRAYS[0]]) == self.chunk_size:
+            self.writeChunk()
+
+    def writeChunk(self):
+        r"""
+        Write the pending loci as a new chunk
+        """
+        files = {}
+        num_loci = len(self.pending[SIDECAR_ARRAYS[0]])
+        for name in SIDECAR_ARRAYS:
+            files[name] = "%s.%05d.npy"%(name, len(self.chunks))
+            np.save(os.path.join(self.path, files[name]), np.stack(self.pending[name]))
+            self.pending[name] = []
+        self.chunks.append({"start": self.num_loci - num_loci,
+                            "num_loci": num_loci, "files": files})
+
+    def Sync(self):
+        r"""
+        Write the pending loci as a (possibly short) chunk
+        and the loci written so far to disk
+
+        Returns
+        -------
+        state : dict
+            Number of loci, chunks and size of loci.tsv.
+            Pass it as resume to a new SidecarWriter
+            to continue writing after these loci.
+        """
+        if len(self.pending[SIDECAR_ARRAYS[0]]) > 0:
+            self.writeChunk()
+        self.loci_writer.flush()
+        os.fsync(self.loci_writer.fileno())
+        for chunk in self.chunks[self.num_synced:]:
+            for filename in chunk["files"].values():
+                with open(os.path.join(self.path, filename), "rb") as f:
+                    os.fsync(f.fileno())
+        self.num_synced = len(self.chunks)
+        return {"num_loci": self.num_loci, "chunks": list(self.chunks),
+                "loci_offset": self.loci_writer.tell()}
+
+    def Close(self):
+        r"""
+        Write the last chunk and the manifest
+        """
+        if len(self.pending[SIDECAR_ARRAYS[0]]) > 0:
+            self.writeChunk()
+        self.loci_writer.close()
+        manifest = {"format": "ensembletr-sidecar",
+                    "version": 1,
+                    "samples": self.samples,
+                    "num_loci": self.num_loci,
+                    "chunk_size": self.chunk_size,
+                    "loci": "loci.tsv",
+                    "methods": ["advntr", "eh", "hipstr", "gangstr"],
+                    "arrays": SIDECAR_ARRAYS_INFO,
+                    "chunks": self.chunks}
+        with open(os.path.join(self.path, "manifest.json"), "w") as f:
+            json.dump(manifest, f, indent=1)
+
+def OpenSidecar(path, mmap_mode="r"):
+    r"""
+    Open the arrays written by a SidecarWriter without copying them
+
+    Parameters
+    ----------
+    path : str
+        Sidecar directory
+    mmap_mode : str, optional
+        Memory-map mode of the arrays (see np.load)
+
+    Returns
+    -------
+    manifest : dict
+        Content of manifest.json
+    loci : list of (str, int, int, str)
+        Chrom, start, end and motif of each locus
+    arrays : dict of str: list of np.ndarray
+        Memory-mapped chunks of each array
+    """
+    with open(os.path.join(path, "manifest.json"), "r") as f:
+        manifest = json.load(f)
+    loci = []
+    with open(os.path.join(path, manifest["loci"]), "r") as f:
+        for line in f:
+            if line.startswith("#"):
+                continue
+            chrom, start, end, motif = line.rstrip("\n").split("\t")
+            loci.append((chrom, int(start), int(end), motif))
+    arrays = {name: [] for name in manifest["arrays"]}
+    for chunk in manifest["chunks"]:
+        for name, filename in chunk["files"].items():
+            arrays[name].append(np.load(os.path.join(path, filename), mmap_mode=mmap_mode))
+    return manifest, loci, arrays
@@ -42,11 +42,11 @@ setup(name=NAME,
       license_file="LICENSE.txt",
       entry_points={
           'console_scripts': [
-              'EnsembleTR=ensembletr.main:run'
+              'EnsembleTR=ensembletr.main:run',
+              'HipSTRCorrection=ensembletr.hipstr_correction:run'
           ],
       },
       install_requires=['cyvcf2',
-                        'networkx',
                         'numpy',
                         'pyfaidx',
 			'trtools'],